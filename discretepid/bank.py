@@ -0,0 +1,110 @@
+"""
+Bank of discrete PID controllers updated together with NumPy.
+
+PIDBank holds the gains and state of n controllers in arrays and steps all
+of them in one update() call. Every controller computes exactly what a PID
+with the same parameters and inputs would: the same float operations are
+done in the same order, element-wise.
+"""
+import numpy as np
+
+
+class PIDBank(object):
+    """
+    n discrete PID controllers.
+
+    The arguments are those of PID, each either a scalar shared by all
+    controllers or a sequence of n values. With preserve_integrator a
+    setpoint change keeps the integrator instead of resetting it to 0; the
+    derivator is reset either way, as in PID.
+    """
+
+    def __init__(self, n, P=2.0, I=0.0, D=1.0, Derivator=0, Integrator=0,
+                 Integrator_max=500, Integrator_min=-500, preserve_integrator=False):
+        self.n = n
+        self.Kp = self._Array(P)
+        self.Ki = self._Array(I)
+        self.Kd = self._Array(D)
+        self.Derivator = self._Array(Derivator)
+        self.Integrator = self._Array(Integrator)
+        self.Integrator_max = self._Array(Integrator_max)
+        self.Integrator_min = self._Array(Integrator_min)
+        self.preserve_integrator = preserve_integrator
+
+        self.set_point = np.zeros(n)
+        self.error = np.zeros(n)
+        self.P_value = np.zeros(n)
+        self.I_value = np.zeros(n)
+        self.D_value = np.zeros(n)
+        self._pid = np.zeros(n)
+        self._changed = np.zeros(n, dtype=bool)
+
+    def _Array(self, value):
+        array = np.empty(self.n)
+        array[:] = value
+        return array
+
+    def __len__(self):
+        return self.n
+
+    def update(self, current_values):
+        """
+        Calculate the PID output values for the given feedback values
+        """
+        error = self.error
+        np.subtract(self.set_point, current_values, out=error)
+
+        np.multiply(self.Kp, error, out=self.P_value)
+        np.subtract(error, self.Derivator, out=self.D_value)
+        np.multiply(self.Kd, self.D_value, out=self.D_value)
+        self.Derivator[:] = error
+
+        np.add(self.Integrator, error, out=self.Integrator)
+        # PID clamps to the max first, then to the min.
+        np.minimum(self.Integrator, self.Integrator_max, out=self.Integrator)
+        np.maximum(self.Integrator, self.Integrator_min, out=self.Integrator)
+
+        np.multiply(self.Integrator, self.Ki, out=self.I_value)
+
+        pid = self._pid
+        np.add(self.P_value, self.I_value, out=pid)
+        np.add(pid, self.D_value, out=pid)
+        return pid.copy()
+
+    def setPoint(self, set_points):
+        """
+        Set the setpoints, resetting the state of the controllers whose setpoint moved
+        """
+        changed = self._changed
+        np.not_equal(self.set_point, set_points, out=changed)
+        self.set_point[:] = set_points
+        if not self.preserve_integrator:
+            self.Integrator[changed] = 0
+        self.Derivator[changed] = 0
+
+    def setIntegrator(self, Integrator):
+        self.Integrator[:] = Integrator
+
+    def setDerivator(self, Derivator):
+        self.Derivator[:] = Derivator
+
+    def setKp(self, P):
+        self.Kp[:] = P
+
+    def setKi(self, I):
+        self.Ki[:] = I
+
+    def setKd(self, D):
+        self.Kd[:] = D
+
+    def getPoint(self):
+        return self.set_point
+
+    def getError(self):
+        return self.error
+
+    def getIntegrator(self):
+        return self.Integrator
+
+    def getDerivator(self):
+        return self.Derivator
@@ -0,0 +1,57 @@
+'''
+Tests for PIDBank.
+'''
+import random
+import unittest
+
+from discretepid import PID
+from discretepid.bank import PIDBank
+
+
+class PIDBankTest(unittest.TestCase):
+
+    def testMatchesScalarPid(self):
+        rand = random.Random(1)
+        n = 7
+        gains = [(rand.uniform(-2, 2), rand.uniform(-0.1, 0.1), rand.uniform(-1, 1))
+                 for _ in range(n)]
+        # Small integrator limits so the clamping is exercised.
+        pids = [PID(P=p, I=i, D=d, Integrator_max=3, Integrator_min=-2)
+                for p, i, d in gains]
+        bank = PIDBank(n, P=[g[0] for g in gains], I=[g[1] for g in gains],
+                       D=[g[2] for g in gains], Integrator_max=3, Integrator_min=-2)
+        set_points = [22.5] * n
+        for step in range(500):
+            if step % 37 == 0:
+                # Move some of the setpoints, as the hysteresis offset does.
+                set_points = [sp + rand.choice([0, 0, 0.25, -0.25]) for sp in set_points]
+                for pid, sp in zip(pids, set_points):
+                    pid.setPoint(sp)
+                bank.setPoint(set_points)
+            values = [rand.uniform(15, 30) for _ in range(n)]
+            expected = [pid.update(v) for pid, v in zip(pids, values)]
+            # Exact, not almost equal.
+            self.assertEqual(expected, bank.update(values).tolist())
+            self.assertEqual([pid.getIntegrator() for pid in pids],
+                             bank.getIntegrator().tolist())
+            self.assertEqual([pid.getDerivator() for pid in pids],
+                             bank.getDerivator().tolist())
+
+    def testPreserveIntegrator(self):
+        bank = PIDBank(2, P=1, I=0.5, D=0, preserve_integrator=True)
+        bank.setPoint([20, 20])
+        bank.update([19, 18])
+        self.assertEqual([1, 2], bank.getIntegrator().tolist())
+        bank.setPoint([21, 20])
+        self.assertEqual([1, 2], bank.getIntegrator().tolist())
+        self.assertEqual([0, 2], bank.getDerivator().tolist())
+
+        resetting = PIDBank(2, P=1, I=0.5, D=0)
+        resetting.setPoint([20, 20])
+        resetting.update([19, 18])
+        resetting.setPoint([21, 20])
+        self.assertEqual([0, 2], resetting.getIntegrator().tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
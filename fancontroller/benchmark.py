@@ -0,0 +1,429 @@
+'''
+Benchmark suite for the control stack with a regression gate.
+
+Times the hot paths of a control cycle (order statistic structures, median
+filters, PID, Thermostat, GPIO writes, sensor parsing, forecast parsing,
+planning, report decimation) and prints the time per call. Results can be saved as a JSON
+baseline; --compare exits with status 1 if any benchmark got slower than
+the baseline by more than --threshold. Baselines are only comparable on the same machine.
+
+  PYTHONPATH=. python fancontroller/benchmark.py --save baseline.json
+  PYTHONPATH=. python fancontroller/benchmark.py --compare baseline.json
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+from collections import deque
+
+import numpy as np
+
+import running_median
+from discretepid import PID
+from discretepid.bank import PIDBank
+from fancontroller.collector import Collector, LoadLines
+from fancontroller.eventlog import EventLog, DECISION
+from fancontroller.fan_controller import NoaaForecast, Thermostat, _TempSensorReader, STATE_OFF
+from fancontroller.fan_gpio import FakeBackend, FakeFanGpio, SysfsBackend
+from fancontroller.filters import FilterBank, MedianFilter
+from fancontroller.forecast import ForecastIndex
+from fancontroller.planner import Plan, Planner
+from fancontroller.report import MinMaxDecimator, CHUNK
+
+NOAA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'noaa.json')
+SIZES = [10, 100, 1000, 10000]
+WINDOWS = [6, 60, 720]
+BANK_SIZES = [1, 64, 1024]
+GPIO_BANK_SIZES = [2, 8]
+FLEET_SIZES = [100, 5000]
+# A benchmark regresses if it is this much slower than the baseline.
+THRESHOLD = 0.25
+# Minimum duration of one timed repeat, in seconds.
+_MIN_REPEAT_TIME = 0.05
+_REPEAT = 5
+_SENSOR_FILE = ('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+                '72 01 4b 46 7f ff 0e 10 57 t=23125\n')
+
+
+def _Temperatures(n):
+    rand = random.Random(0)
+    return [20 + rand.random() * 5 for _ in range(n)]
+
+
+def _Cycle(values):
+    """Returns a function returning the next value of values, wrapping around."""
+    state = {'i': 0}
+    n = len(values)
+
+    def Next():
+        i = state['i']
+        state['i'] = i + 1 if i + 1 < n else 0
+        return values[i]
+    return Next
+
+
+def _OrderedInsertRemove(backend, size):
+    # Steady state window update: insert one value, remove the oldest.
+    ordered = backend(expected_size=size)
+    values = _Temperatures(size * 2)
+    for v in values[:size]:
+        ordered.insert(v)
+    window = deque(values[:size])
+    incoming = _Cycle(values)
+
+    def Run():
+        v = incoming()
+        ordered.insert(v)
+        window.append(v)
+        ordered.remove(window.popleft())
+    return Run
+
+
+def _OrderedGetItem(backend, size):
+    ordered = backend(expected_size=size)
+    for v in _Temperatures(size):
+        ordered.insert(v)
+    middle = size // 2
+    return lambda: ordered[middle]
+
+
+def _MedianFilterAdd(window):
+    median_filter = MedianFilter(window)
+    values = _Temperatures(window * 2)
+    median_filter.addMany(values[:window])
+    incoming = _Cycle(values)
+    add = median_filter.add
+    return lambda: add(incoming())
+
+
+def _MedianFilterGetMedian(window):
+    median_filter = MedianFilter(window)
+    median_filter.addMany(_Temperatures(window))
+    return median_filter.getMedian
+
+
+def _FilterBankAdd():
+    # The windows of a minute, ten minutes and an hour of 5 second samples.
+    bank = FilterBank(WINDOWS, sample_period=5, spike_threshold=5)
+    values = _Temperatures(WINDOWS[-1] * 2)
+    for value in values[:WINDOWS[-1]]:
+        bank.add(value)
+    incoming = _Cycle(values)
+    add = bank.add
+    return lambda: add(incoming())
+
+
+def _FilterBankStats():
+    bank = FilterBank(WINDOWS, sample_period=5)
+    for value in _Temperatures(WINDOWS[-1]):
+        bank.add(value)
+
+    def Run():
+        for window in WINDOWS:
+            bank.getPercentile(90, window)
+            bank.getMad(window)
+            bank.getTrimmedMean(0.1, window)
+            bank.getRate(window)
+    return Run
+
+
+def _CollectorIngest(devices):
+    # One report of every device of the fleet, a new bucket every 6 reports.
+    collector = Collector(resolution=60)
+    reports = [''.join(LoadLines(devices, 10.0 * i)) for i in range(12)]
+    state = {'i': 0}
+
+    def Run():
+        i = state['i']
+        if i == 0:
+            # Back in the past, the samples would all be late: new series.
+            collector._series.clear()
+        state['i'] = (i + 1) % len(reports)
+        collector.IngestLines(reports[i])
+    return Run
+
+
+def _PidUpdate():
+    pid = PID(*Thermostat.PID_GAINS)
+    pid.setPoint(22.5)
+    incoming = _Cycle(_Temperatures(1000))
+    return lambda: pid.update(incoming())
+
+
+def _PidBankUpdate(n):
+    bank = PIDBank(n, *Thermostat.PID_GAINS)
+    bank.setPoint([22.5] * n)
+    values = np.array(_Temperatures(n))
+    return lambda: bank.update(values)
+
+
+def _Thermostat(window=60):
+    thermostat = Thermostat(22.5, outside_window=window, inside_window=window,
+                            hysteresis=0.5, min_outside_diff=0.5, gpio=FakeFanGpio())
+    for inside, outside in zip(_Temperatures(window), _Temperatures(window)):
+        thermostat.RecordIndoorMeasurement(inside)
+        thermostat.RecordOutdoorMeasurement(outside - 5)
+    return thermostat
+
+
+def _RecomputeState():
+    thermostat = _Thermostat()
+    incoming = _Cycle(_Temperatures(1000))
+    return lambda: thermostat._RecomputeState(incoming(), 18.0, STATE_OFF)
+
+
+def _RecomputeStateEventLog():
+    thermostat = _Thermostat()
+    thermostat.SetEventLog(EventLog(capacity=1000))
+    incoming = _Cycle(_Temperatures(1000))
+    return lambda: thermostat._RecomputeState(incoming(), 18.0, STATE_OFF)
+
+
+def _EventLogRecord():
+    events = EventLog(capacity=1000)
+    record = events.Record
+    return lambda: record(DECISION, 0, 1, 0, 22.75, 22.5, 23.1, 18.0, 0.5, timestamp=1.0)
+
+
+def _ControlLoop():
+    thermostat = _Thermostat()
+    indoor = _Cycle(_Temperatures(1000))
+    outdoor = _Cycle(_Temperatures(997))
+
+    def Run():
+        thermostat.RecordIndoorMeasurement(indoor())
+        thermostat.RecordOutdoorMeasurement(outdoor() - 5)
+        thermostat.ControlLoop()
+    return Run
+
+
+class _SensorRead(object):
+    """_TempSensorReader.Read against a w1_slave file in a temporary directory."""
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp()
+        path = os.path.join(self._dir, 'w1_slave')
+        with open(path, 'w') as f:
+            f.write(_SENSOR_FILE)
+        self._reader = _TempSensorReader('benchmark')
+        self._reader.path = path
+
+    def __call__(self):
+        return self._reader.Read()
+
+    def Close(self):
+        self._reader.Close()
+        shutil.rmtree(self._dir)
+
+
+def _GpioToggle():
+    backend = FakeBackend()
+    level = _Cycle([0, 1])
+    return lambda: backend.Write(17, level())
+
+
+def _GpioCoalesced():
+    backend = FakeBackend()
+    backend.Write(17, 1)
+    return lambda: backend.Write(17, 1)
+
+
+def _GpioBank(n):
+    backend = FakeBackend()
+    levels = _Cycle([dict((pin, level) for pin in range(n)) for level in (0, 1)])
+    return lambda: backend.WriteBank(levels())
+
+
+class _SysfsToggle(object):
+    """SysfsBackend.Write against value files in a temporary directory."""
+
+    def __init__(self):
+        self._dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self._dir, 'gpio17'))
+        open(os.path.join(self._dir, 'gpio17', 'value'), 'w').close()
+        self._backend = SysfsBackend(self._dir)
+        self._level = _Cycle([0, 1])
+
+    def __call__(self):
+        self._backend.Write(17, self._level())
+
+    def Close(self):
+        self._backend.Close()
+        shutil.rmtree(self._dir)
+
+
+def _NoaaParse():
+    with open(NOAA_FILE) as f:
+        text = f.read()
+    return lambda: ForecastIndex.FromDocument(json.loads(text))
+
+
+def _NoaaQuery():
+    noaa = NoaaForecast()
+    with open(NOAA_FILE) as f:
+        noaa._cache = json.load(f)
+
+    def Run():
+        noaa.GetCurrentTemp()
+        noaa.GetTomorrowsHigh()
+    return Run
+
+
+def _ReportDecimate():
+    # One chunk of a trace per call, the buffers merge as the trace grows.
+    decimator = MinMaxDecimator()
+    values = np.array(_Temperatures(CHUNK))
+    state = {'start': 0}
+
+    def Run():
+        start = state['start']
+        decimator.Add(np.arange(start, start + CHUNK, dtype=float), values)
+        state['start'] = start + CHUNK
+    return Run
+
+
+def _PlannerPlan():
+    with open(NOAA_FILE) as f:
+        index = ForecastIndex.FromDocument(json.load(f))
+    planner = Planner(22.5, 0.5, 0.5)
+    start = index.extremes[0][0]
+    return lambda: planner.Plan(start, 23.0, index)
+
+
+def _PlanLookup():
+    plan = Plan(0, [22.5] * 144, [22.5] * 144)
+    now = _Cycle(_Temperatures(1000))
+    return lambda: plan.GetTarget(now() * 3000)
+
+
+def Benchmarks():
+    """Returns a list of (name, factory), factory() returns the function to time."""
+    benchmarks = []
+    for backend, name in [(running_median.IndexableSkiplist, 'skiplist'),
+                          (running_median.IndexableSortedList, 'sorted_list')]:
+        for size in SIZES:
+            benchmarks.append(('%s.insert_remove[%d]' % (name, size),
+                               lambda b=backend, s=size: _OrderedInsertRemove(b, s)))
+            benchmarks.append(('%s.getitem[%d]' % (name, size),
+                               lambda b=backend, s=size: _OrderedGetItem(b, s)))
+    for window in WINDOWS:
+        benchmarks.append(('median_filter.add[%d]' % window,
+                           lambda w=window: _MedianFilterAdd(w)))
+        benchmarks.append(('median_filter.get_median[%d]' % window,
+                           lambda w=window: _MedianFilterGetMedian(w)))
+    benchmarks.append(('filter_bank.add', _FilterBankAdd))
+    benchmarks.append(('filter_bank.stats', _FilterBankStats))
+    benchmarks.append(('pid.update', _PidUpdate))
+    for n in BANK_SIZES:
+        benchmarks.append(('pid_bank.update[%d]' % n, lambda n=n: _PidBankUpdate(n)))
+    for n in FLEET_SIZES:
+        benchmarks.append(('collector.ingest[%d]' % n, lambda n=n: _CollectorIngest(n)))
+    for n in GPIO_BANK_SIZES:
+        benchmarks.append(('gpio.fake.write_bank[%d]' % n, lambda n=n: _GpioBank(n)))
+    benchmarks += [
+        ('thermostat.recompute_state', _RecomputeState),
+        ('thermostat.recompute_state.event_log', _RecomputeStateEventLog),
+        ('event_log.record', _EventLogRecord),
+        ('thermostat.control_loop', _ControlLoop),
+        ('sensor.read', _SensorRead),
+        ('gpio.fake.write', _GpioToggle),
+        ('gpio.fake.write_coalesced', _GpioCoalesced),
+        ('gpio.sysfs.write', _SysfsToggle),
+        ('noaa.parse', _NoaaParse),
+        ('noaa.query', _NoaaQuery),
+        ('planner.plan', _PlannerPlan),
+        ('plan.get_target', _PlanLookup),
+        ('report.decimate', _ReportDecimate),
+    ]
+    return benchmarks
+
+
+def Time(fn, min_repeat_time=_MIN_REPEAT_TIME, repeat=_REPEAT):
+    """Returns the best of repeat measurements of fn, in seconds per call."""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(fn, number=number)
+        if elapsed >= min_repeat_time:
+            break
+        number *= 10 if elapsed < min_repeat_time / 10 else 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        best = min(best, timeit.timeit(fn, number=number))
+    return best / number
+
+
+def Run(name_filter=None, min_repeat_time=_MIN_REPEAT_TIME, repeat=_REPEAT):
+    """Runs the benchmarks whose name contains name_filter, returns name -> seconds."""
+    results = {}
+    for name, factory in Benchmarks():
+        if name_filter and name_filter not in name:
+            continue
+        fn = factory()
+        try:
+            results[name] = Time(fn, min_repeat_time, repeat)
+        finally:
+            if hasattr(fn, 'Close'):
+                fn.Close()
+    return results
+
+
+def Compare(results, baseline, threshold=THRESHOLD):
+    """Returns the (name, baseline seconds, seconds) of the regressed benchmarks.
+
+    Benchmarks missing from either side are ignored.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name in baseline and results[name] > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def Save(path, results):
+    with open(path, 'w') as f:
+        json.dump({'machine': platform.platform(),
+                   'python': platform.python_version(),
+                   'results': results}, f, indent=2, sort_keys=True)
+
+
+def Load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='allowed slowdown, 0.25 is 25%% slower')
+    args = parser.parse_args(argv)
+
+    baseline = Load(args.compare) if args.compare else {}
+    results = Run(args.filter)
+    print('%-36s %12s %12s %8s' % ('benchmark', 'us/call', 'baseline', 'change'))
+    for name in sorted(results):
+        line = '%-36s %12.3f' % (name, results[name] * 1e6)
+        if name in baseline:
+            line += ' %12.3f %+7.1f%%' % (baseline[name] * 1e6,
+                                         (results[name] / baseline[name] - 1) * 100)
+        print(line)
+    if args.save:
+        Save(args.save, results)
+    regressions = Compare(results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print('REGRESSION %s: %.3fus -> %.3fus' % (name, before * 1e6, after * 1e6))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    # The Thermostat logs every decision, keep that out of the timings' output.
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
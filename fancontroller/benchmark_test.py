@@ -0,0 +1,37 @@
+'''
+Tests for the benchmark suite's regression gate.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fancontroller import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def testCompare(self):
+        baseline = {'a': 1.0, 'b': 1.0, 'gone': 1.0}
+        results = {'a': 1.2, 'b': 1.3, 'new': 5.0}
+        self.assertEqual([('b', 1.0, 1.3)],
+                         benchmark.Compare(results, baseline, threshold=0.25))
+
+    def testAllBenchmarksRun(self):
+        results = benchmark.Run(min_repeat_time=0, repeat=1)
+        self.assertEqual(sorted(name for name, _ in benchmark.Benchmarks()),
+                         sorted(results))
+        self.assertTrue(all(seconds >= 0 for seconds in results.values()))
+
+    def testSaveAndLoad(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'baseline.json')
+            benchmark.Save(path, {'pid.update': 1e-6})
+            self.assertEqual({'pid.update': 1e-6}, benchmark.Load(path))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
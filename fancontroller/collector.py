@@ -0,0 +1,449 @@
+'''
+Fleet collector for the measurements of many controllers.
+
+Instead of every controller posting each report to thingspeak, a
+CollectorUploader sends its GetMeasurements() samples as lines in UDP
+datagrams to one Collector on the local network:
+
+  device,timestamp,indoor_temp,outdoor_temp,pid,target_temp,zone
+
+The same lines can be POSTed in batches to /ingest. The Collector averages
+the samples of every device and zone into buckets of resolution seconds and
+keeps the last retention buckets of each series, served as JSON on
+/series?device=<device>. With an upstream uploader
+(fancontroller.metrics.BatchingUploader) every completed bucket is
+forwarded, so upstream gets one sample per series and bucket however many
+controllers report how often.
+
+  python -m fancontroller.collector serve [--udp-port 9106] [--http-port 9107]
+      [--forward --channel CHANNEL --key KEY]
+  python -m fancontroller.collector load --devices 2000 [--seconds 10]
+
+load is a load generator sending the samples of many simulated devices as
+fast as it can; the server logs its ingest rate.
+'''
+import argparse
+import errno
+import logging
+import select
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+from fancontroller.metrics import FIELDS, _FormatRecord, _ParseRecord
+from fancontroller.scheduler import Wakeup
+
+UDP_PORT = 9106
+HTTP_PORT = 9107
+# Seconds per bucket, and buckets kept per series: a day of minutes.
+RESOLUTION = 60
+RETENTION = 24 * 60
+# Datagrams of the load generator stay below a typical MTU.
+MAX_PAYLOAD = 1400
+# Seconds between the server's flushes of finished buckets and rate logs.
+STATS_PERIOD = 10
+_NAMES = [name for name, _ in FIELDS]
+
+
+def _CheckName(kind, name):
+    if ',' in name or '\n' in name:
+        raise ValueError('invalid %s name %r' % (kind, name))
+
+
+def FormatSample(device, timestamp, measurements):
+    """Returns the line of one sample, see the module doc.
+
+    Raises ValueError if the device or zone name would break the line up.
+    """
+    _CheckName('device', device)
+    _CheckName('zone', measurements.get('zone', ''))
+    return device + ',' + _FormatRecord(timestamp, measurements)
+
+
+def ParseSample(line):
+    """Returns (device, timestamp, measurements) of a line, raises ValueError if it is invalid."""
+    device, _, record = line.partition(',')
+    if not device or not record:
+        raise ValueError('no device in %r' % line)
+    timestamp, measurements = _ParseRecord(record)
+    return device, timestamp, measurements
+
+
+class _Series(object):
+    """The buckets of one device and zone."""
+    __slots__ = ('start', 'last', 'sums', 'counts', 'buckets')
+
+    def __init__(self, retention):
+        # Start of the open bucket, None if there is none, and of the last
+        # closed one.
+        self.start = None
+        self.last = None
+        self.sums = [0.0] * len(_NAMES)
+        self.counts = [0] * len(_NAMES)
+        self.buckets = deque(maxlen=retention)
+
+    def Close(self):
+        """Closes the open bucket, returns it as (start, measurements with the means)."""
+        means = {}
+        for i, name in enumerate(_NAMES):
+            means[name] = self.sums[i] / self.counts[i] if self.counts[i] else None
+            self.sums[i] = 0.0
+            self.counts[i] = 0
+        bucket = (self.start, means)
+        self.buckets.append(bucket)
+        self.last = self.start
+        self.start = None
+        return bucket
+
+
+class Collector(object):
+    """Per device and zone series of the ingested samples, see the module doc."""
+
+    def __init__(self, resolution=RESOLUTION, retention=RETENTION, upstream=None):
+        self.resolution = resolution
+        self._retention = retention
+        self._upstream = upstream
+        # (device, zone) -> _Series, zone is None for single zone controllers.
+        self._series = {}
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.errors = 0
+        # Samples for buckets that were closed already.
+        self.late = 0
+        self.forwarded = 0
+
+    def Ingest(self, device, timestamp, measurements):
+        with self._lock:
+            self._Add(device, timestamp, measurements)
+
+    def IngestLines(self, data):
+        """Ingests the sample lines in data, returns how many were valid."""
+        valid = 0
+        with self._lock:
+            for line in data.splitlines():
+                if not line:
+                    continue
+                try:
+                    device, timestamp, measurements = ParseSample(line)
+                except ValueError:
+                    self.errors += 1
+                    continue
+                self._Add(device, timestamp, measurements)
+                valid += 1
+        return valid
+
+    def _Add(self, device, timestamp, measurements):
+        key = (device, measurements.get('zone'))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(self._retention)
+        start = timestamp - timestamp % self.resolution
+        if series.start != start:
+            if (series.last is not None and start <= series.last or
+                    series.start is not None and start < series.start):
+                self.late += 1
+                return
+            if series.start is not None:
+                self._Forward(key, series.Close())
+            series.start = start
+        sums, counts = series.sums, series.counts
+        for i, name in enumerate(_NAMES):
+            value = measurements.get(name)
+            if value is not None:
+                sums[i] += value
+                counts[i] += 1
+        self.samples += 1
+
+    def _Forward(self, key, bucket):
+        if self._upstream is None:
+            return
+        start, measurements = bucket
+        measurements = dict(measurements)
+        device, zone = key
+        # Upstream tells the series apart by their zone.
+        measurements['zone'] = device if zone is None else '%s/%s' % (device, zone)
+        self._upstream.Upload(measurements, timestamp=start)
+        self.forwarded += 1
+
+    def Flush(self, now):
+        """Closes the buckets that ended more than one resolution before now, returns how many."""
+        closed = 0
+        with self._lock:
+            for key, series in self._series.items():
+                if series.start is not None and series.start + 2 * self.resolution <= now:
+                    self._Forward(key, series.Close())
+                    closed += 1
+        return closed
+
+    def GetDevices(self):
+        with self._lock:
+            return sorted(set(device for device, _ in self._series))
+
+    def GetSeries(self, device, zone=None):
+        """The closed buckets of a series oldest first, as (start, measurements with the means)."""
+        with self._lock:
+            series = self._series.get((device, zone))
+            return list(series.buckets) if series is not None else []
+
+
+def _ServerClasses():
+    # Only the collector needs the HTTP server.
+    import BaseHTTPServer
+    import SocketServer
+    import json
+    import urlparse
+
+    class IngestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def _Reply(self, status, body, content_type='text/plain'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.split('?')[0] != '/ingest':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.getheader('Content-Length'))
+            except (TypeError, ValueError):
+                self.send_error(411)
+                return
+            valid = self.server.collector.IngestLines(self.rfile.read(length))
+            self._Reply(200, 'ok %d\n' % valid)
+
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            collector = self.server.collector
+            if url.path == '/devices':
+                self._Reply(200, json.dumps(collector.GetDevices()), 'application/json')
+            elif url.path == '/series':
+                query = urlparse.parse_qs(url.query)
+                if 'device' not in query:
+                    self.send_error(400)
+                    return
+                series = collector.GetSeries(query['device'][0], query.get('zone', [None])[0])
+                self._Reply(200, json.dumps(series), 'application/json')
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    return Server, IngestHandler
+
+
+class CollectorServer(object):
+    """Feeds collector from UDP datagrams and HTTP posts, in background threads.
+
+    A http_port of None serves UDP only. Finished buckets are flushed every
+    STATS_PERIOD seconds.
+    """
+
+    def __init__(self, collector, host='', udp_port=UDP_PORT, http_port=HTTP_PORT):
+        self.collector = collector
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for a burst of datagrams from the whole fleet.
+        self._udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        self._udp.bind((host, udp_port))
+        self._udp.setblocking(False)
+        self.udp_port = self._udp.getsockname()[1]
+        self.datagrams = 0
+        self._stop = Wakeup()
+        self._threads = [threading.Thread(target=self._Run, name='collector-udp')]
+        self._http = None
+        if http_port is not None:
+            server_class, handler_class = _ServerClasses()
+            self._http = server_class((host, http_port), handler_class)
+            self._http.collector = collector
+            self.http_port = self._http.server_address[1]
+            self._threads.append(threading.Thread(target=self._http.serve_forever,
+                                                  name='collector-http'))
+        for thread in self._threads:
+            thread.daemon = True
+
+    def Start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def Stop(self):
+        self._stop.Set()
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._udp.close()
+
+    def _Run(self):
+        next_stats = time.time() + STATS_PERIOD
+        samples = self.collector.samples
+        while True:
+            readable = select.select([self._udp, self._stop], [], [],
+                                     max(0, next_stats - time.time()))[0]
+            if self._stop in readable:
+                break
+            if self._udp in readable:
+                self._Drain()
+            now = time.time()
+            if now >= next_stats:
+                self.collector.Flush(now)
+                logging.info('ingested %.0f samples/s from %d devices, %d errors, %d late',
+                             (self.collector.samples - samples) / float(STATS_PERIOD),
+                             len(self.collector.GetDevices()), self.collector.errors,
+                             self.collector.late)
+                samples = self.collector.samples
+                next_stats = now + STATS_PERIOD
+
+    def _Drain(self):
+        # All datagrams that are waiting, without a select() for each.
+        while True:
+            try:
+                data = self._udp.recv(65535)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.datagrams += 1
+            self.collector.IngestLines(data)
+
+
+class CollectorUploader(object):
+    """Drop-in replacement for BatchingUploader sending the samples to a Collector.
+
+    Every Upload() is one UDP datagram, sent right away; a sample lost on
+    the way is not sent again.
+    """
+
+    def __init__(self, host, port=UDP_PORT, device=None):
+        self._host = host
+        self._port = port
+        self.device = device or socket.gethostname()
+        _CheckName('device', self.device)
+        self._address = None
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sent = 0
+        self.failures = 0
+
+    def Upload(self, measurements, timestamp=None):
+        """Sends one GetMeasurements() sample, taken at timestamp or now."""
+        line = FormatSample(self.device, time.time() if timestamp is None else timestamp,
+                            measurements)
+        try:
+            if self._address is None:
+                # Resolved once, and again after a failure.
+                self._address = (socket.gethostbyname(self._host), self._port)
+            self._socket.sendto(line, self._address)
+        except socket.error as e:
+            logging.warn('Sending to collector %s failed: %s', self._host, e)
+            self._address = None
+            self.failures += 1
+            return
+        self.sent += 1
+
+    def Start(self):
+        pass
+
+    def Stop(self):
+        self._socket.close()
+
+
+def LoadLines(devices, timestamp, zones=1):
+    """The sample lines of devices simulated controllers at timestamp."""
+    lines = []
+    for device in range(devices):
+        for zone in range(zones):
+            measurements = {'indoor_temp': 20 + device % 7 + 0.1 * zone,
+                            'outdoor_temp': 10 + device % 13, 'pid': 0.5,
+                            'target_temp': 22.5}
+            if zones > 1:
+                measurements['zone'] = 'zone%d' % zone
+            lines.append(FormatSample('pi%05d' % device, timestamp, measurements))
+    return lines
+
+
+def GenerateLoad(host, port, devices, seconds, batch=1):
+    """Sends samples of devices controllers for seconds, batch lines per datagram.
+
+    Every round sends one sample of each device. Returns the samples sent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (socket.gethostbyname(host), port)
+    end = time.time() + seconds
+    sent = 0
+    try:
+        while time.time() < end:
+            lines = LoadLines(devices, time.time())
+            datagram = []
+            size = 0
+            for line in lines:
+                if datagram and (len(datagram) >= batch or size + len(line) > MAX_PAYLOAD):
+                    sock.sendto(''.join(datagram), address)
+                    datagram = []
+                    size = 0
+                datagram.append(line)
+                size += len(line)
+            if datagram:
+                sock.sendto(''.join(datagram), address)
+            sent += len(lines)
+    finally:
+        sock.close()
+    return sent
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='run the collector')
+    serve.add_argument('--host', default='')
+    serve.add_argument('--udp-port', type=int, default=UDP_PORT)
+    serve.add_argument('--http-port', type=int, default=HTTP_PORT)
+    serve.add_argument('--resolution', type=int, default=RESOLUTION,
+                       help='seconds per bucket')
+    serve.add_argument('--retention', type=int, default=RETENTION,
+                       help='buckets kept per series')
+    serve.add_argument('--forward', action='store_true',
+                       help='forward the buckets to thingspeak')
+    serve.add_argument('--channel', help='thingspeak channel to forward to')
+    serve.add_argument('--key', help='write API key of the channel')
+    serve.add_argument('--spool', help='spool file of the forwarded buckets while offline')
+    load = commands.add_parser('load', help='send the samples of simulated devices')
+    load.add_argument('--host', default='localhost')
+    load.add_argument('--port', type=int, default=UDP_PORT)
+    load.add_argument('--devices', type=int, default=1000)
+    load.add_argument('--seconds', type=float, default=10)
+    load.add_argument('--batch', type=int, default=1, help='samples per datagram')
+    args = parser.parse_args(argv)
+    if args.command == 'serve' and args.forward and not (args.channel and args.key):
+        parser.error('--forward needs --channel and --key')
+    if args.command == 'load':
+        sent = GenerateLoad(args.host, args.port, args.devices, args.seconds, args.batch)
+        print 'sent %d samples, %.0f/s' % (sent, sent / args.seconds)
+        return 0
+    upstream = None
+    if args.forward:
+        from fancontroller.metrics import BatchingUploader
+        upstream = BatchingUploader(channel=args.channel, key=args.key, spool_path=args.spool)
+        upstream.Start()
+    server = CollectorServer(Collector(args.resolution, args.retention, upstream),
+                             args.host, args.udp_port, args.http_port)
+    server.Start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.Stop()
+        if upstream is not None:
+            upstream.Stop()
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+'''
+Tests for the fleet collector.
+'''
+import StringIO
+import httplib
+import json
+import sys
+import time
+import unittest
+
+from fancontroller.collector import (Collector, CollectorServer, CollectorUploader,
+                                     FormatSample, GenerateLoad, LoadLines, ParseSample, main)
+
+
+class FakeUpstream(object):
+    def __init__(self):
+        self.uploads = []
+
+    def Upload(self, measurements, timestamp=None):
+        self.uploads.append((timestamp, measurements))
+
+
+def _Sample(indoor, zone=None):
+    measurements = {'indoor_temp': indoor, 'outdoor_temp': 10.0, 'pid': 0.5,
+                    'target_temp': 22.5}
+    if zone is not None:
+        measurements['zone'] = zone
+    return measurements
+
+
+class CollectorTest(unittest.TestCase):
+
+    def testLineRoundTrip(self):
+        line = FormatSample('pi1', 120.5, _Sample(21.0, zone='attic'))
+        self.assertEqual(('pi1', 120.5, _Sample(21.0, zone='attic')), ParseSample(line))
+        self.assertRaises(ValueError, ParseSample, 'pi1')
+        self.assertRaises(ValueError, ParseSample, 'pi1,1,2')
+        self.assertRaises(ValueError, FormatSample, 'pi,1', 1, _Sample(21.0))
+        self.assertRaises(ValueError, FormatSample, 'pi1', 1, _Sample(21.0, zone='a,b'))
+
+    def testDownsamplesAndForwards(self):
+        upstream = FakeUpstream()
+        collector = Collector(resolution=60, upstream=upstream)
+        for t, indoor in [(0, 20.0), (30, 22.0), (59, 24.0), (60, 30.0)]:
+            collector.Ingest('pi1', t, _Sample(indoor))
+        collector.Ingest('pi2', 10, _Sample(18.0, zone='attic'))
+        # The first bucket of pi1 was closed by the sample at 60.
+        (start, means), = collector.GetSeries('pi1')
+        self.assertEqual(0, start)
+        self.assertEqual(22.0, means['indoor_temp'])
+        self.assertEqual([(0, dict(means, zone='pi1'))], upstream.uploads)
+        # Too late for its bucket.
+        collector.Ingest('pi1', 50, _Sample(99.0))
+        self.assertEqual(1, collector.late)
+        self.assertEqual(2, collector.Flush(180))
+        self.assertEqual([0, 60], [start for start, _ in collector.GetSeries('pi1')])
+        self.assertEqual(18.0, collector.GetSeries('pi2', 'attic')[0][1]['indoor_temp'])
+        self.assertEqual(set(['pi1', 'pi2/attic']),
+                         set(measurements['zone'] for _, measurements in upstream.uploads[1:]))
+        self.assertEqual(['pi1', 'pi2'], collector.GetDevices())
+
+    def testIngestLines(self):
+        collector = Collector()
+        lines = LoadLines(100, 1000.0, zones=2)
+        self.assertEqual(200, collector.IngestLines(''.join(lines) + 'garbage\n'))
+        self.assertEqual(200, collector.samples)
+        self.assertEqual(1, collector.errors)
+        self.assertEqual(100, len(collector.GetDevices()))
+
+
+    def testForwardNeedsChannelAndKey(self):
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertRaises(SystemExit, main, ['serve', '--forward', '--channel', '1'])
+        finally:
+            sys.stderr = stderr
+
+
+class CollectorServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = Collector(resolution=60)
+        self.server = CollectorServer(self.collector, 'localhost', udp_port=0, http_port=0)
+        self.server.Start()
+
+    def tearDown(self):
+        self.server.Stop()
+
+    def _WaitForSamples(self, samples):
+        end = time.time() + 5
+        while self.collector.samples < samples and time.time() < end:
+            time.sleep(0.01)
+        return self.collector.samples
+
+    def testUdpAndHttp(self):
+        uploader = CollectorUploader('localhost', self.server.udp_port, device='pi7')
+        uploader.Upload(_Sample(21.0), timestamp=0)
+        uploader.Upload(_Sample(23.0), timestamp=30)
+        self.assertEqual(2, self._WaitForSamples(2))
+        self.assertEqual(2, uploader.sent)
+        uploader.Stop()
+        conn = httplib.HTTPConnection('localhost', self.server.http_port, timeout=5)
+        conn.request('POST', '/ingest', FormatSample('pi7', 60, _Sample(25.0)))
+        response = conn.getresponse()
+        self.assertEqual('ok 1\n', response.read())
+        conn.request('GET', '/series?device=pi7')
+        (start, means), = json.loads(conn.getresponse().read())
+        self.assertEqual(0, start)
+        self.assertEqual(22.0, means['indoor_temp'])
+        conn.request('GET', '/nothing')
+        self.assertEqual(404, conn.getresponse().status)
+        conn.close()
+
+    def testLoadGenerator(self):
+        sent = GenerateLoad('localhost', self.server.udp_port, 50, 0.05, batch=10)
+        self.assertGreaterEqual(sent, 50)
+        # UDP may drop datagrams under load, but not all of them locally.
+        self.assertGreater(self._WaitForSamples(sent), 0)
+        self.assertEqual(50, len(self.collector.GetDevices()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,356 @@
+'''
+Config loading and hot reload of a running controller.
+
+ConfigWatcher polls the config file's mtime and size and applies a changed
+config to the running Runtime: target_temp, hysteresis, min_outside_diff and
+the filter windows of every zone, period, report_period and upload_period.
+The new values are validated first; an invalid config is logged and the old
+one stays in effect. Thermostats keep their filter windows and PID state
+across a reload. Options that need a restart (sensors, GPIO ports, adding or
+removing zones) are reported instead of applied.
+
+ControlServer accepts the same updates over a local unix socket, one
+command per connection:
+
+  get                            the settings in effect, as JSON
+  set <zone|DEFAULT> <opt> <val> change one option of the running config
+  reload                         re-read the config file now
+
+  python -m fancontroller.config set bedroom target_temp 21
+'''
+import ConfigParser
+import argparse
+import logging
+import math
+import os
+import select
+import socket
+import sys
+import threading
+
+from fancontroller.eventlog import EVENT_LOG_FILE
+from fancontroller.instrumentation import PORT as METRICS_PORT
+from fancontroller.runtime import PeriodicTask, Wakeup
+from fancontroller.zones import GetZoneSections, GetZoneOption, ZONE_DEFAULTS, ZONE_PREFIX
+
+CONFIG_FILE = 'config.txt'
+SOCKET_PATH = '/var/tmp/fancontroller.sock'
+# Seconds between checks of the config file.
+POLL_PERIOD = 5
+# Seconds a control socket client may take to send its command.
+CLIENT_TIMEOUT = 5
+
+DEFAULTS = dict(ZONE_DEFAULTS)
+DEFAULTS.update({
+    'target_temp': 22.5,
+    'hysteresis': 0.5,
+    'min_outside_diff': 0.5,
+    'period': 5,
+    'sample_period': 0,
+    'report_period': 60,
+    'upload_period': 600,
+    'metrics_port': METRICS_PORT,
+    'trace_file': '',
+    'control_socket': SOCKET_PATH,
+    'precool': 0,
+    'gpio_backend': 'pigpio',
+    'spike_threshold': 0,
+    'event_log': EVENT_LOG_FILE,
+    'collector': '',
+    'device': '',
+    })
+
+# Options applied by a reload.
+RELOAD_OPTIONS = ['target_temp', 'hysteresis', 'min_outside_diff',
+                  'inside_window', 'outside_window', 'period', 'report_period',
+                  'upload_period']
+# Options that only take effect on a restart.
+RESTART_OPTIONS = ['indoor_sensor', 'outdoor_sensor', 'gpio_port', 'pwm', 'kp', 'ki', 'kd']
+RESTART_GLOBAL_OPTIONS = ['sample_period', 'metrics_port', 'trace_file', 'control_socket',
+                          'precool', 'gpio_backend', 'spike_threshold', 'event_log',
+                          'collector', 'device']
+
+
+def LoadConfig(path):
+    """Returns a RawConfigParser with DEFAULTS and the contents of path, if it exists."""
+    config = ConfigParser.RawConfigParser(DEFAULTS)
+    if os.path.isfile(path):
+        logging.info('reading config %s', path)
+        config.read(path)
+    else:
+        logging.info('config file not found, using defaults')
+        logging.info('current directory: %s, config file: %s', os.getcwd(), path)
+    return config
+
+
+def _Copy(config):
+    copy = ConfigParser.RawConfigParser()
+    for option, value in config.defaults().items():
+        copy.set('DEFAULT', option, value)
+    for section in config.sections():
+        copy.add_section(section)
+        for option, value in config.items(section):
+            # items() includes the defaults, only copy what the section sets.
+            if option not in config.defaults() or value != config.defaults()[option]:
+                copy.set(section, option, value)
+    return copy
+
+
+def _Float(name, option, value):
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError('%s: %s is not a number: %r' % (name, option, value))
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError('%s: %s must be finite' % (name, option))
+    return value
+
+
+def _Int(name, option, value, minimum):
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError('%s: %s is not an integer: %r' % (name, option, value))
+    if value < minimum:
+        raise ValueError('%s: %s must be at least %d' % (name, option, minimum))
+    return value
+
+
+def Validate(config, zone_names=None):
+    """Returns the settings of config that can be changed at runtime.
+
+    A dict with period, report_period, upload_period and zones, a dict of zone name to
+    Thermostat.Reconfigure() arguments. Raises ValueError if a value is
+    invalid or, with zone_names, if the config's zones differ from them.
+    """
+    zones = {}
+    for name, section in GetZoneSections(config):
+        def get(option):
+            return GetZoneOption(config, section, option)
+        hysteresis = _Float(name, 'hysteresis', get('hysteresis'))
+        if hysteresis < 0:
+            raise ValueError('%s: hysteresis must not be negative' % name)
+        zones[name] = {
+            'target_temp': _Float(name, 'target_temp', get('target_temp')),
+            'hysteresis': hysteresis,
+            'min_outside_diff': _Float(name, 'min_outside_diff', get('min_outside_diff')),
+            'inside_window': _Int(name, 'inside_window', get('inside_window'), 1),
+            'outside_window': _Int(name, 'outside_window', get('outside_window'), 1),
+        }
+    if zone_names is not None and sorted(zones) != sorted(zone_names):
+        raise ValueError('zones changed from %s to %s, restart to apply' %
+                         (', '.join(sorted(zone_names)), ', '.join(sorted(zones))))
+    return {'period': _Int('DEFAULT', 'period', config.get('DEFAULT', 'period'), 1),
+            'report_period': _Int('DEFAULT', 'report_period',
+                                  config.get('DEFAULT', 'report_period'), 1),
+            'upload_period': _Int('DEFAULT', 'upload_period',
+                                  config.get('DEFAULT', 'upload_period'), 1),
+            'zones': zones}
+
+
+def GetRestartChanges(old, new):
+    """Returns the options that differ between the configs but need a restart."""
+    changes = []
+    for option in RESTART_GLOBAL_OPTIONS:
+        if old.get('DEFAULT', option) != new.get('DEFAULT', option):
+            changes.append(option)
+    old_sections = dict(GetZoneSections(old))
+    for name, section in GetZoneSections(new):
+        if name not in old_sections:
+            continue
+        for option in RESTART_OPTIONS:
+            if (GetZoneOption(old, old_sections[name], option) !=
+                    GetZoneOption(new, section, option)):
+                changes.append('%s.%s' % (name, option))
+    return changes
+
+
+class ConfigWatcher(object):
+    """Applies changes of the config file at path to runtime (a fancontroller.runtime.Runtime).
+
+    config is the config runtime was built from, loaded from path if None.
+    """
+
+    def __init__(self, path, runtime, config=None, poll_period=POLL_PERIOD):
+        self._path = path
+        self._runtime = runtime
+        self.config = config if config is not None else LoadConfig(path)
+        self.reloads = 0
+        self.errors = 0
+        # Guards config, the watcher task and the control server both apply.
+        self._lock = threading.Lock()
+        self._stat = self._Stat()
+        self._task = PeriodicTask('config', self.Check, poll_period)
+
+    def _Stat(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def Check(self):
+        """Reloads the config file if it changed since the last check, returns True if it did."""
+        stat = self._Stat()
+        if stat == self._stat:
+            return False
+        self._stat = stat
+        if stat is None:
+            logging.warn('config %s removed, keeping the current config', self._path)
+            return False
+        try:
+            self.Reload()
+        except ValueError:
+            # Logged, the current config stays in effect until the next change.
+            pass
+        return True
+
+    def Reload(self):
+        """Reads the config file and applies it, see Apply()."""
+        config = ConfigParser.RawConfigParser(DEFAULTS)
+        try:
+            config.read(self._path)
+        except ConfigParser.Error as e:
+            self.errors += 1
+            logging.error('not reloading config %s: %s', self._path, e)
+            raise ValueError(str(e))
+        logging.info('reloading config %s', self._path)
+        return self.Apply(config)
+
+    def Apply(self, config):
+        """Validates config and applies it to the runtime, returns the applied settings.
+
+        Raises ValueError, leaving the current config in effect, if config is
+        invalid.
+        """
+        with self._lock:
+            try:
+                settings = Validate(config, [zone.name for zone in self._runtime.zones])
+            except ValueError as e:
+                self.errors += 1
+                logging.error('not applying config: %s', e)
+                raise
+            for option in GetRestartChanges(self.config, config):
+                logging.warn('config option %s changed, restart to apply', option)
+            self._runtime.Reconfigure(settings)
+            self.config = config
+            self.reloads += 1
+            return settings
+
+    def Set(self, zone, option, value):
+        """Sets option of zone (a zone name or DEFAULT) in the running config and applies it.
+
+        The change is not written to the config file, the next change of the
+        file replaces it.
+        """
+        if option not in RELOAD_OPTIONS:
+            raise ValueError('%s can not be changed at runtime' % option)
+        with self._lock:
+            config = _Copy(self.config)
+        if zone == 'DEFAULT':
+            section = zone
+        elif config.has_section(ZONE_PREFIX + zone):
+            section = ZONE_PREFIX + zone
+        elif zone in dict(GetZoneSections(config)):
+            # The zone of a config without zone sections lives in DEFAULT.
+            section = 'DEFAULT'
+        else:
+            raise ValueError('no zone %s' % zone)
+        config.set(section, option, value)
+        return self.Apply(config)
+
+    def GetSettings(self):
+        with self._lock:
+            return Validate(self.config)
+
+    def Start(self):
+        self._task.Start()
+
+    def Stop(self):
+        self._task.Stop()
+
+
+class ControlServer(object):
+    """Serves the control socket commands for watcher (a ConfigWatcher) from a background thread."""
+
+    def __init__(self, watcher, path=SOCKET_PATH):
+        self._watcher = watcher
+        self.path = path
+        if os.path.exists(path):
+            # Left behind by a previous process.
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        os.chmod(path, 0600)
+        self._socket.listen(5)
+        self._stop = Wakeup()
+        self._thread = threading.Thread(target=self._Run, name='control')
+        self._thread.daemon = True
+
+    def Start(self):
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.Set()
+        self._thread.join()
+        self._socket.close()
+        os.unlink(self.path)
+
+    def _Run(self):
+        while True:
+            readable = select.select([self._socket, self._stop], [], [])[0]
+            if self._stop in readable:
+                break
+            conn = self._socket.accept()[0]
+            try:
+                conn.settimeout(CLIENT_TIMEOUT)
+                f = conn.makefile('rb')
+                response = self.Handle(f.readline())
+                conn.sendall(response + '\n')
+            except socket.error as e:
+                logging.warn('control socket client failed: %s', e)
+            finally:
+                conn.close()
+
+    def Handle(self, line):
+        """Runs one command line, returns the response line."""
+        args = line.split()
+        try:
+            if args == ['get']:
+                import json
+                return 'ok ' + json.dumps(self._watcher.GetSettings(), sort_keys=True)
+            if len(args) == 4 and args[0] == 'set':
+                self._watcher.Set(args[1], args[2], args[3])
+                return 'ok'
+            if args == ['reload']:
+                self._watcher.Reload()
+                return 'ok'
+        except ValueError as e:
+            return 'error %s' % e
+        return 'error unknown command: %s' % line.strip()
+
+
+def SendCommand(command, path=SOCKET_PATH, timeout=CLIENT_TIMEOUT):
+    """Sends command to the control socket at path, returns the response line."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+        conn.sendall(command + '\n')
+        return conn.makefile('rb').readline().rstrip('\n')
+    finally:
+        conn.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('command', nargs='+', help='get, set <zone> <option> <value> or reload')
+    args = parser.parse_args(argv)
+    response = SendCommand(' '.join(args.command), args.socket)
+    print response
+    return 0 if response.startswith('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
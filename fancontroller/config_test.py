@@ -0,0 +1,124 @@
+'''
+Tests for config hot reload and the control socket.
+'''
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from fancontroller import config as fcconfig
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.runtime import Runtime
+from fancontroller.zones import LoadZones
+
+CONFIG = '''
+[DEFAULT]
+target_temp=22.5
+inside_window=5
+period=5
+
+[zone living]
+indoor_sensor=living_temp
+
+[zone bedroom]
+indoor_sensor=bedroom_temp
+target_temp=21
+'''
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config.txt')
+        self._WriteConfig(CONFIG)
+        self.config = fcconfig.LoadConfig(self.path)
+        self.zones = LoadZones(self.config, gpio_factory=lambda port: FakeFanGpio())
+        self.runtime = Runtime(self.zones, None)
+        self.watcher = fcconfig.ConfigWatcher(self.path, self.runtime, config=self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _WriteConfig(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def _Thermostat(self, name):
+        return [zone.thermostat for zone in self.zones if zone.name == name][0]
+
+    def testValidate(self):
+        settings = fcconfig.Validate(self.config)
+        self.assertEqual(5, settings['period'])
+        self.assertEqual(60, settings['report_period'])
+        self.assertEqual(600, settings['upload_period'])
+        self.assertEqual(21, settings['zones']['bedroom']['target_temp'])
+        self.assertEqual(22.5, settings['zones']['living']['target_temp'])
+        self.assertEqual(5, settings['zones']['living']['inside_window'])
+        for option, value in [('target_temp', 'warm'), ('target_temp', 'nan'),
+                              ('hysteresis', '-1'), ('inside_window', '0'),
+                              ('period', '0'), ('report_period', '1.5'),
+                              ('upload_period', '0')]:
+            config = fcconfig.LoadConfig(self.path)
+            config.set('DEFAULT', option, value)
+            self.assertRaises(ValueError, fcconfig.Validate, config)
+        self.assertRaises(ValueError, fcconfig.Validate, self.config, ['living'])
+
+    def testReloadKeepsFiltersAndPidWarm(self):
+        thermostat = self._Thermostat('living')
+        for temp in [24, 25, 26, 27]:
+            thermostat.RecordIndoorMeasurement(temp)
+            thermostat.RecordOutdoorMeasurement(15)
+            thermostat.ControlLoop()
+        integrator = thermostat.p.getIntegrator()
+        self._WriteConfig(CONFIG.replace('inside_window=5', 'inside_window=3')
+                          .replace('period=5', 'period=7') + 'hysteresis=1\n')
+        # mtime may not change within the same second, the size does.
+        self.assertTrue(self.watcher.Check())
+        self.assertFalse(self.watcher.Check())
+        self.assertEqual(1, self.watcher.reloads)
+        self.assertEqual([25, 26, 27], thermostat._inside_temp.getValues())
+        self.assertEqual(26, thermostat._inside_temp.getMedian())
+        self.assertEqual(integrator, thermostat.p.getIntegrator())
+        self.assertEqual(1, self._Thermostat('bedroom')._hysteresis)
+        self.assertEqual(7, [t for t in self.runtime.tasks if t.name == 'sensors'][0].period)
+
+    def testInvalidReloadKeepsCurrentConfig(self):
+        self._WriteConfig(CONFIG.replace('target_temp=21', 'target_temp=warm'))
+        self.assertTrue(self.watcher.Check())
+        self.assertEqual(1, self.watcher.errors)
+        self.assertEqual(21, self._Thermostat('bedroom')._target_temp)
+        # A zone can not be added without a restart.
+        self._WriteConfig(CONFIG + '\n[zone office]\n')
+        self.assertRaises(ValueError, self.watcher.Reload)
+        self.assertEqual(0, self.watcher.reloads)
+
+    def testControlSocket(self):
+        server = fcconfig.ControlServer(self.watcher, os.path.join(self.dir, 'control.sock'))
+        server.Start()
+        try:
+            self.assertEqual('ok', fcconfig.SendCommand('set bedroom target_temp 20.5',
+                                                        server.path))
+            self.assertEqual(20.5, self._Thermostat('bedroom')._target_temp)
+            self.assertEqual(22.5, self._Thermostat('living')._target_temp)
+            response = fcconfig.SendCommand('get', server.path)
+            self.assertTrue(response.startswith('ok '))
+            settings = json.loads(response[3:])
+            self.assertEqual(20.5, settings['zones']['bedroom']['target_temp'])
+            self.assertTrue(fcconfig.SendCommand('set bedroom gpio_port 4', server.path)
+                            .startswith('error'))
+            self.assertTrue(fcconfig.SendCommand('set attic target_temp 4', server.path)
+                            .startswith('error'))
+            self.assertTrue(fcconfig.SendCommand('frobnicate', server.path)
+                            .startswith('error'))
+            # The config file wins again on reload.
+            self.assertEqual('ok', fcconfig.SendCommand('reload', server.path))
+            self.assertEqual(21, self._Thermostat('bedroom')._target_temp)
+        finally:
+            server.Stop()
+        self.assertFalse(os.path.exists(server.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+'''
+Structured log of the controller's decisions.
+
+Every control step used to format a line of text whether or not anybody
+read it. An EventLog instead stores each decision as one fixed size binary
+record in a preallocated ring buffer, a memory-mapped file like
+fancontroller.history or memory only without a path. Recording is one
+struct.pack_into; the text is only made when a record is rendered, by
+Render() or on the command line:
+
+  python -m fancontroller.eventlog [path] [--kind decision] [--zone 0]
+      [--since TIMESTAMP] [--tail N] [--csv]
+
+Records are (timestamp, kind, zone, state, prev_state, target, target_temp,
+inside, outside, pid, value), see KINDS for what each kind stores.
+'''
+import argparse
+import collections
+import csv
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'FCEVNT01'
+VERSION = 1
+# magic, version, record size, capacity, head (records ever appended).
+_HEADER = struct.Struct('<8sIIQQ')
+_HEAD_OFFSET = 24
+HEADER_SIZE = 64
+_RECORD = struct.Struct('<d4B6f')
+FIELDS = ['timestamp', 'kind', 'zone', 'state', 'prev_state', 'target',
+          'target_temp', 'inside', 'outside', 'pid', 'value']
+EVENT_LOG_FILE = '/var/tmp/fancontroller-events.bin'
+# A week of control steps every 5 seconds.
+DEFAULT_CAPACITY = 7 * 24 * 3600 // 5
+
+NAN = float('nan')
+
+# A control step: the new fan state, the state before, the target after
+# hysteresis and outside temperature, the target_temp it was computed from
+# (lower while a plan pre-cools), the medians and the PID output.
+DECISION = 0
+# The fan was switched to state, pid is its speed.
+FAN_CHANGE = 1
+# A switch to state was suppressed, value is the seconds since the last one.
+FLAPPING = 2
+
+DECISION_FORMAT = ('%s:\tin_state: %d\tcomp_target %.2f\ttarget: %.2f\tin: %.2f\t'
+                    'out: %.2f\tdiff: %.2f\tpid:%.2f')
+
+
+def _RenderDecision(record):
+    (_, _, _, state, prev_state, target, target_temp, inside, outside, pid, _) = record
+    return DECISION_FORMAT % ('ON' if state else 'OFF', prev_state, target, target_temp,
+                               inside, outside, inside - target, pid)
+
+
+def _RenderFanChange(record):
+    return 'fan turned %s, speed %.2f' % ('on' if record[3] else 'off', record[9])
+
+
+def _RenderFlapping(record):
+    return 'fan %s suppressed, last change %d seconds ago' % (
+        'on' if record[3] else 'off', record[10])
+
+
+# kind -> (name, function rendering a record of that kind).
+KINDS = {
+    DECISION: ('decision', _RenderDecision),
+    FAN_CHANGE: ('fan_change', _RenderFanChange),
+    FLAPPING: ('flapping', _RenderFlapping),
+}
+KIND_NAMES = dict((name, kind) for kind, (name, _) in KINDS.items())
+
+
+def Render(record):
+    """Returns the text of a record, as the controller used to log it."""
+    kind = record[1]
+    if kind not in KINDS:
+        return 'unknown event %d' % kind
+    return KINDS[kind][1](record)
+
+
+class EventLog(object):
+    """Ring buffer of the last capacity event records, in the file at path if given."""
+
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self._file = None
+        if path is None:
+            self.capacity = capacity
+            self._head = 0
+            self._buffer = bytearray(HEADER_SIZE + capacity * _RECORD.size)
+            self._WriteHeader()
+            return
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, VERSION, _RECORD.size, capacity, 0))
+                f.truncate(HEADER_SIZE + capacity * _RECORD.size)
+        self._file = open(path, 'r+b')
+        self._buffer = mmap.mmap(self._file.fileno(), 0)
+        magic, version, record_size, self.capacity, self._head = _HEADER.unpack_from(self._buffer)
+        if magic != MAGIC or version != VERSION or record_size != _RECORD.size:
+            self.Close()
+            raise ValueError('%s is not a version %d event log' % (path, VERSION))
+        if len(self._buffer) < HEADER_SIZE + self.capacity * _RECORD.size:
+            self.Close()
+            raise ValueError('%s is truncated' % path)
+
+    def _WriteHeader(self):
+        _HEADER.pack_into(self._buffer, 0, MAGIC, VERSION, _RECORD.size, self.capacity,
+                          self._head)
+
+    def __len__(self):
+        return min(self._head, self.capacity)
+
+    def Record(self, kind, zone, state, prev_state, target=NAN, target_temp=NAN,
+               inside=NAN, outside=NAN, pid=NAN, value=NAN, timestamp=None):
+        """Appends one event, nothing is formatted."""
+        if timestamp is None:
+            timestamp = time.time()
+        head = self._head
+        _RECORD.pack_into(self._buffer, HEADER_SIZE + (head % self.capacity) * _RECORD.size,
+                          timestamp, kind, zone, state, prev_state, target, target_temp,
+                          inside, outside, pid, value)
+        # The head only moves once the record is in place.
+        self._head = head + 1
+        struct.pack_into('<Q', self._buffer, _HEAD_OFFSET, head + 1)
+
+    def Read(self, kinds=None, zone=None, since=None):
+        """Yields the records oldest first, optionally only those of kinds, zone and since."""
+        head = self._head
+        for index in range(head - len(self), head):
+            record = _RECORD.unpack_from(
+                self._buffer, HEADER_SIZE + (index % self.capacity) * _RECORD.size)
+            if kinds is not None and record[1] not in kinds:
+                continue
+            if zone is not None and record[2] != zone:
+                continue
+            if since is not None and record[0] < since:
+                continue
+            yield record
+
+    def Flush(self):
+        if self._file is not None:
+            self._buffer.flush()
+
+    def Close(self):
+        if self._file is not None:
+            self._buffer.close()
+            self._file.close()
+            self._file = None
+
+
+def _FormatTime(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def Dump(records, out, as_csv=False):
+    """Writes records as lines of text or as CSV with a header row."""
+    if as_csv:
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        for record in records:
+            row = list(record)
+            row[1] = KINDS[row[1]][0] if row[1] in KINDS else row[1]
+            writer.writerow(row)
+        return
+    for record in records:
+        out.write('%s zone %d %s\n' % (_FormatTime(record[0]), record[2], Render(record)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('path', nargs='?', default=EVENT_LOG_FILE)
+    parser.add_argument('--kind', action='append', choices=sorted(KIND_NAMES),
+                        help='only events of this kind, may be repeated')
+    parser.add_argument('--zone', type=int, help='only events of the zone with this index')
+    parser.add_argument('--since', type=float, help='only events from this unix time on')
+    parser.add_argument('--tail', type=int, help='only the last TAIL matching events')
+    parser.add_argument('--csv', action='store_true', help='write CSV instead of text')
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.path):
+        parser.error('%s does not exist' % args.path)
+    log = EventLog(args.path)
+    try:
+        kinds = None if args.kind is None else set(KIND_NAMES[name] for name in args.kind)
+        records = log.Read(kinds, args.zone, args.since)
+        if args.tail is not None:
+            records = collections.deque(records, maxlen=max(0, args.tail))
+        Dump(records, sys.stdout, args.csv)
+    finally:
+        log.Close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+'''
+Tests for the structured decision log.
+'''
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from fancontroller import Thermostat, STATE_ON, STATE_OFF
+from fancontroller import eventlog
+from fancontroller.eventlog import EventLog, DECISION, FAN_CHANGE, FLAPPING
+from fancontroller.fan_gpio import FakeFanGpio
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'events.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRingKeepsNewest(self):
+        log = EventLog(capacity=3)
+        for t in range(5):
+            log.Record(DECISION, 0, t % 2, 0, 22.5, 22.5, 20.0 + t, 15.0, 0.5, timestamp=t)
+        self.assertEqual(3, len(log))
+        self.assertEqual([2, 3, 4], [record[0] for record in log.Read()])
+        self.assertEqual([3], [record[0] for record in log.Read(since=2.5, zone=0,
+                                                                kinds=[DECISION])
+                               if record[3]])
+        self.assertEqual([], list(log.Read(zone=1)))
+
+    def testReopen(self):
+        log = EventLog(self.path, capacity=10)
+        log.Record(FAN_CHANGE, 1, STATE_ON, STATE_OFF, pid=0.5, timestamp=100)
+        log.Close()
+        log = EventLog(self.path)
+        self.assertEqual(10, log.capacity)
+        record, = log.Read()
+        self.assertEqual((100.0, FAN_CHANGE, 1, STATE_ON, STATE_OFF), record[:5])
+        self.assertEqual('fan turned on, speed 0.50', eventlog.Render(record))
+        log.Close()
+        with open(self.path, 'r+b') as f:
+            f.write(b'garbage!')
+        self.assertRaises(ValueError, EventLog, self.path)
+
+    def testThermostatRecordsDecisions(self):
+        log = EventLog(capacity=100)
+        gpio = FakeFanGpio()
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1, hysteresis=0,
+                                min_outside_diff=0, gpio=gpio)
+        now = [1000.0]
+        thermostat._fc._GetTime = lambda: now[0]
+        thermostat.SetEventLog(log, zone=2)
+        thermostat.RecordOutdoorMeasurement(15)
+        thermostat.RecordIndoorMeasurement(23.0)
+        thermostat.ControlLoop()
+        # The fan turned on 10 seconds ago.
+        now[0] += 10
+        thermostat.RecordIndoorMeasurement(22.0)
+        thermostat.ControlLoop()
+        records = list(log.Read())
+        self.assertEqual([DECISION, FAN_CHANGE, DECISION, FLAPPING],
+                         [record[1] for record in records])
+        self.assertEqual(set([2]), set(record[2] for record in records))
+        self.assertEqual('fan off suppressed, last change 10 seconds ago',
+                         eventlog.Render(records[3]))
+        self.assertEqual('ON:\tin_state: 0\tcomp_target 22.50\ttarget: 22.50\tin: 23.00\t'
+                         'out: 15.00\tdiff: 0.50\tpid:0.80', eventlog.Render(records[0]))
+
+    def testCli(self):
+        log = EventLog(self.path, capacity=10)
+        log.Record(DECISION, 0, STATE_ON, STATE_OFF, 22.5, 22.5, 23.0, 15.0, 0.8, timestamp=100)
+        log.Record(FAN_CHANGE, 0, STATE_ON, STATE_OFF, pid=0.8, timestamp=101)
+        log.Record(DECISION, 1, STATE_OFF, STATE_OFF, 22.5, 22.5, 22.0, 15.0, 0, timestamp=102)
+        log.Close()
+        out = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            eventlog.main([self.path, '--kind', 'decision', '--tail', '1'])
+            eventlog.main([self.path, '--zone', '0', '--csv'])
+        finally:
+            sys.stdout = stdout
+        lines = out.getvalue().splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[0].endswith('zone 1 OFF:\tin_state: 0\tcomp_target 22.50\t'
+                                          'target: 22.50\tin: 22.00\tout: 15.00\t'
+                                          'diff: -0.50\tpid:0.00'))
+        self.assertEqual(','.join(eventlog.FIELDS), lines[1])
+        self.assertTrue(lines[2].startswith('100.0,decision,0,1,0,22.5,'))
+        self.assertTrue(lines[3].startswith('101.0,fan_change,0,1,0,nan,'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,67 +3,73 @@ Created on May 30, 2015
 
 @author: isdal
 '''
-import ConfigParser
 import logging
 import time
 from discretepid import PID
 from fancontroller.filters import MedianFilter
-from fancontroller.fan_gpio import FanGpio
+from fancontroller.fan_gpio import FanGpio, BACKENDS
+from fancontroller.runtime import Runtime
+from fancontroller.metrics import BatchingUploader
+from fancontroller.forecast import ForecastCache, ForecastIndex
+from fancontroller import snapshot
+from fancontroller.eventlog import EventLog, EVENT_LOG_FILE, DECISION, DECISION_FORMAT, FAN_CHANGE, FLAPPING
+from fancontroller.sensors import SensorBus, W1Sensor, SENSOR_DIR
+from fancontroller.history import HistoryStore, HISTORY_FILE
+from fancontroller.instrumentation import Instruments, MetricsServer, Registry
 from math import ceil
-import urllib
-import httplib
 import os
+import signal
 import sys
-import requests
-import json
 
 STATE_OFF = 0
 STATE_ON = 1
+# Unsent metrics are spooled here while offline.
+SPOOL_FILE = '/var/tmp/fancontroller-metrics.spool'
 
 class NoaaForecast:
-    def __init__(self):
+    def __init__(self, cache=None):
+        # Raw forecast document, only set if parsed in this process.
         self._cache = None
-    
-    def _ftoc(self, degrees_f):
-        return (float(degrees_f) - 32) * 5/9
-        
-    
+        self._indexed = None
+        self._index = None
+        self._forecast = cache
+
     def Download(self):
-        url = 'http://forecast.weather.gov/MapClick.php?lat=47.6738&lon=-122.342&unit=c&lg=english&FcstType=json'
-        resp = requests.get(url=url)
-        open('noaa.json','w').write(resp.text)
-        self._cache = json.loads(resp.text)
-    
+        if self._forecast is None:
+            self._forecast = ForecastCache()
+        self._forecast.Refresh()
+
+    def GetIndex(self):
+        """The current fancontroller.forecast.ForecastIndex, None if there is none yet."""
+        return self._GetIndex()
+
+    def _GetIndex(self):
+        if self._cache is not None:
+            if self._cache is not self._indexed:
+                self._index = ForecastIndex.FromDocument(self._cache)
+                self._indexed = self._cache
+            return self._index
+        if self._forecast is None:
+            return None
+        return self._forecast.index
+
     def GetCurrentTemp(self):
-        if not self._cache:
+        index = self._GetIndex()
+        if not index:
             return None
-        return self._ftoc(self._cache['currentobservation']['Temp'])
-    
+        return index.current_temp
+
     def GetTomorrowsHigh(self):
-        if not self._cache:
+        index = self._GetIndex()
+        if not index:
             return None
-        high_pos = self._cache['time']['tempLabel'].index('High')
-        return float(self._cache['data']['temperature'][high_pos])
+        return index.GetNextHigh()
+
+class _TempSensorReader(W1Sensor):
 
-class _TempSensorReader:
-    
     def __init__(self, sensor):
-        self.sensor = sensor
-        
-    def Read(self):
-        with open('/sensors/' + self.sensor, 'r') as sensor_file:
-            temp_raw = sensor_file.readlines()
-            if temp_raw[0].strip()[-3:] != 'YES':
-                logging.warn('Got non YES from sensor: ' + temp_raw[0])
-                return None
-            temp_pos = temp_raw[1].find('t=')
-            if temp_pos == -1:
-                logging.warn('No =t sensor read: ' + temp_raw[1])
-                return None
-            temp_c = int(temp_raw[1][temp_pos + 2:]) / 1000.0
-            logging.debug('sensor %s=%f C', self.sensor, temp_c)
-            return temp_c
-            
+        W1Sensor.__init__(self, sensor, SENSOR_DIR + sensor)
+
 
 class _FanController:
     """Class for controlling a physical fan """
@@ -72,14 +78,24 @@ class _FanController:
     _MIN_SPEED = 0.2
     _GPIO_PORT = 17
 
-    def __init__(self, target):
-        self._state = STATE_OFF
+    def __init__(self, target, gpio=None, state=STATE_OFF):
+        self._state = state
         self._speed = 0
         self.last_update = 0
         self.state_changes = 0
-        self.gpio = FanGpio(_FanController._GPIO_PORT)
-        # start off.
-        self.gpio.Off()
+        self.flapping_suppressed = 0
+        # fancontroller.eventlog.EventLog recording the fan changes, and the
+        # zone index they are recorded for.
+        self.events = None
+        self.zone = 0
+        if gpio is None:
+            gpio = FanGpio(_FanController._GPIO_PORT)
+        self.gpio = gpio
+        # Start off, or in the state restored from a snapshot.
+        if state:
+            self.gpio.On()
+        else:
+            self.gpio.Off()
     
     def _TurnOnFan(self):
         logging.info('Turning on fan')
@@ -90,16 +106,35 @@ class _FanController:
         self.gpio.Off()
     
     def _SetActualFan(self, speed):
-        update_delay = self._GetTime() - self.last_update
+        """Applies self._state to the fan, returns False if that was suppressed as flapping."""
+        now = self._GetTime()
+        update_delay = now - self.last_update
         if update_delay < _FanController._MIN_UPDATE_DELAY:
             logging.warn('Fan state flapping, last update %d seconds ago', update_delay)
-            return
+            self.flapping_suppressed += 1
+            if self.events is not None:
+                self.events.Record(FLAPPING, self.zone, self._state, 1 - self._state,
+                                   value=update_delay, timestamp=now)
+            return False
+        self.last_update = now
         self._speed = speed
         self.state_changes += 1
+        if self.events is not None:
+            self.events.Record(FAN_CHANGE, self.zone, self._state, 1 - self._state,
+                               pid=speed if speed is not None else float('nan'),
+                               timestamp=self._GetTime())
         if self._state:
+            if speed is not None:
+                self._SetGpioSpeed(speed)
             self._TurnOnFan()
         else:
             self._TurnOffFan()
+        return True
+
+    def _SetGpioSpeed(self, speed):
+        # Below the minimum speed some fans stall instead of turning slowly.
+        if hasattr(self.gpio, 'SetSpeed'):
+            self.gpio.SetSpeed(max(_FanController._MIN_SPEED, speed))
         
     def _GetTime(self):
         return time.time()    
@@ -108,32 +143,70 @@ class _FanController:
         return self._state
     
     def UpdateState(self, new_state, speed=None):
-        if (self._state != new_state and
-            (speed is None or
-            self.speed != speed)):
+        """Switches the fan to new_state, and to speed (0-1) on a PWM fan.
+
+        A speed change of a running fan is applied right away, only on/off
+        changes are subject to the flapping check. A suppressed change leaves
+        the fan in its state until an update asks for it again once the
+        check passes; Thermostat.ControlLoop() does so every control step.
+        """
+        if self._state != new_state:
+            previous = self._state
             self._state = new_state
-            self._SetActualFan(speed)
+            if not self._SetActualFan(speed):
+                self._state = previous
+        elif self._state and speed is not None and speed != self._speed:
+            self._speed = speed
+            self._SetGpioSpeed(speed)
+
+
+def _Bucket(v, buckets=20):
+    return ceil(v * buckets) / float(buckets)
+
+
+def _Resize(median_filter, window):
+    """Returns a filter over window values, keeping the newest values of median_filter."""
+    if median_filter.window == window:
+        return median_filter
+    resized = MedianFilter(window)
+    resized.restore(median_filter.getValues()[-window:])
+    return resized
 
 
 class Thermostat:
     WINDOW = 60
     HYSTERESIS = 1
     MIN_OUTSIDE_DIFF = 1
+    PID_GAINS = (-1.5, -0.00, -0.0)  # I=-0.03, D=-1
     
     def __init__(self, target_temp,
                  outside_window=WINDOW,
                  inside_window=WINDOW,
                  hysteresis=HYSTERESIS,
-                 min_outside_diff=MIN_OUTSIDE_DIFF):
+                 min_outside_diff=MIN_OUTSIDE_DIFF,
+                 pid_gains=PID_GAINS,
+                 gpio=None,
+                 fan_state=STATE_OFF):
         self._hysteresis = hysteresis
         self._min_outside_diff = min_outside_diff
         self._outside_temp = MedianFilter(outside_window)
         self._inside_temp = MedianFilter(inside_window)
         self._target_temp = target_temp
-        self._fc = _FanController(target_temp)
-        self.p = PID(P=-1.5, I=-0.00, D=-0.0)  # I=-0.03, D=-1)
+        self._fc = _FanController(target_temp, gpio=gpio, state=fan_state)
+        kp, ki, kd = pid_gains
+        self.p = PID(P=kp, I=ki, D=kd)
         self.p.setPoint(target_temp)
         self.pid = 0
+        # fancontroller.planner.Plan lowering the target ahead of hot days.
+        self._plan = None
+        # Inputs of the last recompute and its result.
+        self._last_inputs = None
+        self._last_state = STATE_OFF
+        self.skipped_recomputes = 0
+        # fancontroller.eventlog.EventLog the decisions are recorded to
+        # instead of the log, see SetEventLog().
+        self._events = None
+        self._zone = 0
     
     def RecordIndoorMeasurement(self, temperature):
         self._inside_temp.add(temperature)
@@ -141,44 +214,126 @@ class Thermostat:
     def RecordOutdoorMeasurement(self, temperature):
         self._outside_temp.add(temperature)
 
-    def _RecomputeState(self, inside, outside, curr_state):
+    def _RecomputeState(self, inside, outside, curr_state, target_temp=None):
+        if target_temp is None:
+            target_temp = self._target_temp
         # Target temp depends on outside temp. If it is warm outside the target
         # is min_outside_diff higher that the outside temp.
-        target = max(self._target_temp, outside + self._min_outside_diff)
+        target = max(target_temp, outside + self._min_outside_diff)
         if curr_state == STATE_OFF:
             # To prevent flapping the target temp is higher when the fan is off...
             target += self._hysteresis / 2.0
         else:
             # ... and lower when it is on.
             target -= self._hysteresis / 2.0
-        diff = inside - target
         self.p.setPoint(target)
-        def bucket(v, buckets=20):
-            return ceil(v * buckets) / float(buckets)
-        self.pid = max(0, min(1, bucket(self.p.update(inside), buckets=10)))
-        msg = 'in_state: %d\tcomp_target %.2f\ttarget: %.2f\tin: %.2f\tout: %.2f\tdiff: %.2f\tpid:%.2f' % (
-          curr_state, target, self._target_temp, inside, outside, diff, self.pid)
-        if self.pid:
-        # if inside > target:
-            logging.info('ON:\t' + msg)
-            self._fc.UpdateState(STATE_ON)
-            return STATE_ON
+        self.pid = max(0, min(1, _Bucket(self.p.update(inside), buckets=10)))
+        new_state = STATE_ON if self.pid else STATE_OFF
+        events = self._events
+        if events is not None:
+            # Formatted only when the event log is read.
+            events.Record(DECISION, self._zone, new_state, curr_state, target, target_temp,
+                          inside, outside, self.pid, timestamp=self._fc._GetTime())
         else:
-            logging.info('OFF:\t' + msg)
-            self._fc.UpdateState(STATE_OFF)
-            return STATE_OFF
-            
+            # The message is only formatted if INFO is enabled.
+            logging.info(DECISION_FORMAT, 'ON' if new_state else 'OFF', curr_state, target,
+                         target_temp, inside, outside, inside - target, self.pid)
+        self._fc.UpdateState(new_state, self.pid)
+        return new_state
+
     def ControlLoop(self):
         outside = self._outside_temp.getMedian()
         inside = self._inside_temp.getMedian()
         if outside is None or inside is None:
             logging.warn('Not enough measurements.')
             return STATE_OFF
-        new_state = self._RecomputeState(inside, outside, self._fc.GetState())        
-        return new_state
+        curr_state = self._fc.GetState()
+        target_temp = self._target_temp
+        if self._plan is not None:
+            planned = self._plan.GetTarget(self._fc._GetTime())
+            if planned is not None and planned < target_temp:
+                target_temp = planned
+        inputs = (inside, outside, curr_state, target_temp,
+                  self._hysteresis, self._min_outside_diff)
+        # With only a P term the PID output depends on nothing but the
+        # inputs, so a recompute with unchanged inputs would change nothing.
+        if inputs == self._last_inputs and self.p.Ki == 0 and self.p.Kd == 0:
+            self.skipped_recomputes += 1
+            return self._last_state
+        self._last_state = self._RecomputeState(inside, outside, curr_state, target_temp)
+        # A change suppressed as flapping is retried with the same inputs.
+        self._last_inputs = inputs if self._fc.GetState() == self._last_state else None
+        return self._last_state
+
+    def GetState(self):
+        return self._fc.GetState()
 
     def GetStateChangeCount(self):
         return self._fc.state_changes
+
+    def GetFlappingSuppressedCount(self):
+        return self._fc.flapping_suppressed
+
+    def SetEventLog(self, events, zone=0):
+        """Records the decisions and fan changes to events as zone, None to log them again."""
+        self._events = events
+        self._zone = zone
+        self._fc.events = events
+        self._fc.zone = zone
+
+    def SetPlan(self, plan):
+        """Follows plan (a fancontroller.planner.Plan) where it is below target_temp, None to stop."""
+        self._plan = plan
+
+    def Reconfigure(self, target_temp, hysteresis, min_outside_diff,
+                    inside_window, outside_window):
+        """Changes the settings of a running thermostat.
+
+        The filters keep their newest values when their window changes and the
+        PID keeps its state, the next ControlLoop uses the new settings.
+        """
+        self._target_temp = target_temp
+        self._hysteresis = hysteresis
+        self._min_outside_diff = min_outside_diff
+        self._inside_temp = _Resize(self._inside_temp, inside_window)
+        self._outside_temp = _Resize(self._outside_temp, outside_window)
+
+    def GetSnapshot(self):
+        """Returns the controller state as a dict, see RestoreSnapshot()."""
+        return {'fan_state': self._fc.GetState(),
+                'last_update': self._fc.last_update,
+                'state_changes': self._fc.state_changes,
+                'set_point': self.p.getPoint(),
+                'integrator': self.p.getIntegrator(),
+                'derivator': self.p.getDerivator(),
+                'pid': self.pid,
+                'inside': self._inside_temp.getValues(),
+                'inside_sum': self._inside_temp.sum,
+                'outside': self._outside_temp.getValues(),
+                'outside_sum': self._outside_temp.sum}
+
+    def RestoreSnapshot(self, snapshot):
+        """Restores the state returned by GetSnapshot(), e.g. after a restart.
+
+        The fan is set to the saved state directly, without the flapping
+        check, if it is not in that state already.
+        """
+        self._inside_temp.restore(snapshot['inside'], snapshot['inside_sum'])
+        self._outside_temp.restore(snapshot['outside'], snapshot['outside_sum'])
+        # setPoint() resets the integrator and derivator, restore them after.
+        self.p.setPoint(snapshot['set_point'])
+        self.p.setIntegrator(snapshot['integrator'])
+        self.p.setDerivator(snapshot['derivator'])
+        self.pid = snapshot['pid']
+        fc = self._fc
+        fc.last_update = snapshot['last_update']
+        fc.state_changes = snapshot['state_changes']
+        if fc.GetState() != snapshot['fan_state']:
+            fc._state = snapshot['fan_state']
+            if fc._state:
+                fc._TurnOnFan()
+            else:
+                fc._TurnOffFan()
     
     def GetMeasurements(self):
         """Returns a dict with the current states to report.
@@ -191,11 +346,17 @@ class Thermostat:
                 'target_temp': self.p.getPoint()}
 
 class MetricsUploader:
-    
-    def __init__(self):
-        pass
+    _HOST = 'api.thingspeak.com:80'
+    _TIMEOUT = 10
+
+    def __init__(self, host=_HOST, timeout=_TIMEOUT):
+        self._host = host
+        self._timeout = timeout
     
     def Upload(self, measurements):
+        # Imported here, the control loop must not wait for them on startup.
+        import httplib
+        import urllib
         try:
             # https://thingspeak.com/channels/43590
             params = urllib.urlencode({'field1': measurements['indoor_temp'],
@@ -204,64 +365,143 @@ class MetricsUploader:
                                        'field4': measurements['target_temp'],
                                        'key':'102HUIUCF7VYDM1K'})
             headers = {'Content-type': 'application/x-www-form-urlencoded','Accept': 'text/plain'}
-            conn = httplib.HTTPConnection('api.thingspeak.com:80')
+            conn = httplib.HTTPConnection(self._host, timeout=self._timeout)
             conn.request('POST', '/update', params, headers)
             ts_response = conn.getresponse()
             logging.debug('Thingspeak Response: %s %s', ts_response.status, ts_response.reason)
-            conn.close
+            conn.close()
         except Exception as e:
             logging.exception(e)            
 
 
+def _GetProcessAge():
+    """Seconds since this process was launched, None if /proc is not available."""
+    try:
+        with open('/proc/self/stat') as f:
+            # The start time, in clock ticks after boot, is the 22nd field.
+            # Split after the command name, which may contain spaces.
+            started = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+    return uptime - started / float(os.sysconf('SC_CLK_TCK'))
+
+
 if __name__ == '__main__':
     logging.basicConfig(
         level=logging.INFO,
         format="[%(asctime)s] %(levelname)s [%(name)s.%(funcName)s:%(lineno)d] %(message)s",
         datefmt="%H:%M:%S", stream=sys.stdout)
 
-    indoor_sensor = _TempSensorReader('indoor_temp')
-    outdoor_sensor = _TempSensorReader('outdoor_temp')
-    config = ConfigParser.RawConfigParser({
-        'target_temp': 22.5,
-        'hysteresis': 0.5,
-        'min_outside_diff': 0.5,
-        'period': 5,
-        'report_period': 60,
-        })
-    config_file = 'config.txt'
+    from fancontroller.zones import LoadZones, GetSensorNames
+    from fancontroller.config import LoadConfig, ConfigWatcher, ControlServer, CONFIG_FILE
+    config_file = CONFIG_FILE
     if len(sys.argv) == 2:
         config_file = sys.argv[1]
-    if os.path.isfile(config_file):
-        logging.info('reading config %s', config_file)
-        config.read(config_file)
+    config = LoadConfig(config_file)
+
+    period = int(config.get('DEFAULT', 'period'))
+    report_period = int(config.get('DEFAULT', 'report_period'))
+    states = snapshot.Load(snapshot.SNAPSHOT_FILE)
+    fan_states = None
+    if states:
+        # Start the fans in their saved state instead of switching them off.
+        fan_states = dict((name, state['fan_state']) for name, state in states.items())
+    gpio_backend = BACKENDS[config.get('DEFAULT', 'gpio_backend')]()
+    zones = LoadZones(config, fan_states=fan_states, backend=gpio_backend)
+    if states:
+        logging.info('restored zones %s from snapshot',
+                     ', '.join(snapshot.Restore(zones, states)))
+    for zone in zones:
+        logging.info('Thermostat %s started, target: %f', zone.name, zone.thermostat._target_temp)
+    sensors = SensorBus.FromNames(GetSensorNames(zones))
+    trace_file = config.get('DEFAULT', 'trace_file')
+    if trace_file:
+        from fancontroller.replay import RecordingSensorBus, TraceRecorder
+        logging.info('recording sensor trace to %s', trace_file)
+        sensors = RecordingSensorBus(sensors, TraceRecorder(trace_file))
+    collector = config.get('DEFAULT', 'collector')
+    if collector:
+        from fancontroller.collector import CollectorUploader, UDP_PORT
+        host, _, port = collector.partition(':')
+        uploader = CollectorUploader(host, int(port or UDP_PORT),
+                                     config.get('DEFAULT', 'device') or None)
     else:
-        logging.info('config file not found, using defaults')
-        logging.info('current directory: %s, config file: %s', os.getcwd(), config_file)
-
-    uploader = MetricsUploader()
-    thermostat = Thermostat(target_temp=float(config.get('DEFAULT', 'target_temp')),
-                            outside_window=1,
-                            inside_window=1,
-                            hysteresis=float(config.get('DEFAULT', 'hysteresis')),
-                            min_outside_diff=float(config.get('DEFAULT', 'min_outside_diff')))
-    logging.info('Thermostat started, target: %f', thermostat._target_temp)
-    start_time = time.time()
-    last_report_time = start_time
-    iteration = 0
-    PERIOD = int(config.get('DEFAULT', 'period'))
-    REPORT_PERIOD = int(config.get('DEFAULT', 'report_period'))
-    while True:
-        thermostat.RecordIndoorMeasurement(indoor_sensor.Read())
-        thermostat.RecordOutdoorMeasurement(outdoor_sensor.Read())        
-        thermostat.ControlLoop()
-        if iteration % int(REPORT_PERIOD / PERIOD) == 0:
-            uploader.Upload(thermostat.GetMeasurements())
-        iteration += 1
-        next_iteration_start = start_time + iteration * PERIOD
-        sleep_s = next_iteration_start - time.time()
-        logging.debug('sleeping %.2fs', sleep_s)
-        if sleep_s > 0:
-            time.sleep(sleep_s)
-        else:
-            start_time = time.time()
-            iteration = 0
+        uploader = BatchingUploader(spool_path=SPOOL_FILE,
+                                    flush_period=int(config.get('DEFAULT', 'upload_period')))
+    history = HistoryStore(HISTORY_FILE)
+    event_log = config.get('DEFAULT', 'event_log')
+    events = EventLog(event_log) if event_log else None
+    planners = None
+    if int(config.get('DEFAULT', 'precool')):
+        from fancontroller.planner import Planner, ThermalModel
+        planners = {}
+        week = history.Query(start=time.time() - 7 * 86400)
+        for i, zone in enumerate(zones):
+            model = ThermalModel.Fit(week, zone=i)
+            if model is None:
+                logging.info('not enough history for zone %s, using the default model', zone.name)
+            thermostat = zone.thermostat
+            planners[zone.name] = Planner(thermostat._target_temp, thermostat._hysteresis,
+                                          thermostat._min_outside_diff, model=model)
+    registry = Registry()
+    # The forecast cache is loaded by the forecast task, off the startup path.
+    runtime = Runtime(zones, sensors,
+                      uploader=uploader,
+                      forecast=NoaaForecast(),
+                      history=history,
+                      instruments=Instruments(registry),
+                      period=period,
+                      sample_period=int(config.get('DEFAULT', 'sample_period')) or None,
+                      report_period=report_period,
+                      snapshot_path=snapshot.SNAPSHOT_FILE,
+                      snapshot_period=snapshot.PERIOD,
+                      planners=planners,
+                      gpio=gpio_backend,
+                      spike_threshold=float(config.get('DEFAULT', 'spike_threshold')) or None,
+                      events=events)
+    runtime.Start()
+    uploader.Start()
+    metrics_server = None
+    metrics_port = int(config.get('DEFAULT', 'metrics_port'))
+    if metrics_port:
+        metrics_server = MetricsServer(registry, port=metrics_port)
+        metrics_server.Start()
+    # Changes to the config file are applied without a restart.
+    watcher = ConfigWatcher(config_file, runtime, config=config)
+    watcher.Start()
+    control_server = None
+    control_socket = config.get('DEFAULT', 'control_socket')
+    if control_socket:
+        control_server = ControlServer(watcher, control_socket)
+        control_server.Start()
+    # start.sh restarts the controller with SIGTERM, shut down cleanly so the
+    # last state is saved.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # The first decision is due within one period of starting.
+        delay = runtime.WaitForFirstControl(period)
+        process_age = _GetProcessAge()
+        if delay is None:
+            logging.warn('No control step within %ds of starting', period)
+        elif process_age is not None:
+            logging.info('first control step %.2fs after start, %.2fs after launch',
+                         delay, process_age - (time.time() - runtime.first_control_time))
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        watcher.Stop()
+        if control_server is not None:
+            control_server.Stop()
+        runtime.Stop()
+        runtime.SaveSnapshot()
+        runtime.LogStats()
+        uploader.Stop()
+        runtime.Join(1)
+        sensors.Close()
+        history.Close()
+        if events is not None:
+            events.Close()
+        if metrics_server is not None:
+            metrics_server.Stop()
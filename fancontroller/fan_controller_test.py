@@ -4,12 +4,15 @@ Created on May 30, 2015
 @author: isdal
 '''
 import logging
+import random
 import unittest
 import sys
 
 from fancontroller import Thermostat, STATE_OFF, STATE_ON
-from fancontroller.filters import MedianFilter
-from fancontroller.fan_controller import NoaaForecast
+from fancontroller.filters import FilterBank, MedianFilter
+from fancontroller.fan_controller import NoaaForecast, _FanController
+from fancontroller.fan_gpio import FakeFanGpio
+import running_median
 import json
 
 
@@ -61,6 +64,156 @@ class MedianFilterTest(unittest.TestCase):
         median_filter = self.createFilter(3, values)
         self.assertEqual(median_filter.getAverage(), average)
 
+    def testBackendSelection(self):
+        self.assertIsInstance(MedianFilter(600).ordered,
+                              running_median.IndexableSortedList)
+        self.assertIsInstance(MedianFilter(MedianFilter.SKIPLIST_MIN_WINDOW).ordered,
+                              running_median.IndexableSkiplist)
+
+    def testBackendsAgree(self):
+        values = [random.randint(0, 20) / 2.0 for _ in range(500)]
+        for window in [1, 2, 7, 60]:
+            sorted_filter = MedianFilter(window)
+            skiplist_filter = MedianFilter(window)
+            skiplist_filter.ordered = running_median.IndexableSkiplist(window)
+            for v in values:
+                sorted_filter.add(v)
+                skiplist_filter.add(v)
+                self.assertEqual(skiplist_filter.getMedian(), sorted_filter.getMedian())
+            self.assertEqual(list(skiplist_filter.ordered), list(sorted_filter.ordered))
+
+    def assertSameSeries(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            if e is None:
+                self.assertNotEqual(a, a)  # NaN
+            else:
+                self.assertEqual(e, a)
+
+    def testBatchMatchesAdd(self):
+        values = [random.randint(0, 400) / 8.0 for _ in range(300)]
+        for window in [1, 2, 5, 6, 33, 60]:
+            expected = MedianFilter(window)
+            medians = []
+            averages = []
+            for v in values:
+                expected.add(v)
+                medians.append(expected.getMedian())
+                averages.append(expected.getAverage())
+
+            batch = MedianFilter(window)
+            for v in values[:3]:
+                batch.add(v)
+            self.assertSameSeries(medians[3:40], batch.rollingMedian(values[3:40]))
+            self.assertSameSeries(averages[40:150], batch.rollingAverage(values[40:150]))
+            batch.addMany(values[150:200])
+            for i, v in enumerate(values[200:], 200):
+                batch.add(v)
+                self.assertEqual(medians[i], batch.getMedian())
+                self.assertEqual(averages[i], batch.getAverage())
+            self.assertEqual(expected.sum, batch.sum)
+            self.assertEqual(list(expected.queue), list(batch.queue))
+            self.assertEqual(list(expected.ordered), list(batch.ordered))
+
+    def testRollingMedianLargeWindows(self):
+        # Many ties, and more values than a power of two.
+        values = [random.randint(0, 400) / 8.0 for _ in range(2100)]
+        for window in [33, 64, 600, 2100]:
+            expected = MedianFilter(window)
+            medians = []
+            for v in values:
+                expected.add(v)
+                medians.append(expected.getMedian())
+            self.assertSameSeries(medians, MedianFilter(window).rollingMedian(values))
+
+    def testSortedListRemoveMissing(self):
+        ordered = running_median.IndexableSortedList()
+        ordered.insert(1)
+        self.assertRaises(KeyError, ordered.remove, 2)
+
+
+class FilterBankTest(unittest.TestCase):
+
+    def testMatchesBruteForce(self):
+        rand = random.Random(3)
+        values = [round(rand.uniform(15, 30), 2) for _ in range(500)]
+        windows = [5, 20, 101]
+        bank = FilterBank(windows)
+        for i, value in enumerate(values):
+            self.assertTrue(bank.add(value, 1000 + 10 * i))
+            for window in windows:
+                if i + 1 < window:
+                    self.assertIsNone(bank.getMedian(window))
+                    continue
+                recent = values[i + 1 - window:i + 1]
+                ordered = sorted(recent)
+                median = ordered[window // 2]
+                self.assertEqual(median, bank.getMedian(window))
+                self.assertEqual(sorted(abs(v - median) for v in recent)[window // 2],
+                                 bank.getMad(window))
+                self.assertEqual(ordered[0], bank.getPercentile(0, window))
+                self.assertEqual(ordered[-1], bank.getPercentile(100, window))
+                rank = (window - 1) * 0.9
+                lower = int(rank)
+                self.assertAlmostEqual(
+                    ordered[lower] + (ordered[lower + 1] - ordered[lower]) * (rank - lower),
+                    bank.getPercentile(90, window))
+                self.assertAlmostEqual(sum(recent) / window, bank.getAverage(window))
+                trim = int(window * 0.2)
+                self.assertAlmostEqual(sum(ordered[trim:window - trim]) / (window - 2 * trim),
+                                       bank.getTrimmedMean(0.2, window))
+                # Least squares slope per minute, samples are 10 seconds apart.
+                times = [10.0 * j for j in range(window)]
+                mean_t = sum(times) / window
+                mean_v = sum(recent) / window
+                slope = (sum((t - mean_t) * (v - mean_v) for t, v in zip(times, recent)) /
+                         sum((t - mean_t) ** 2 for t in times))
+                self.assertAlmostEqual(60 * slope, bank.getRate(window))
+
+    def testRate(self):
+        bank = FilterBank([10, 30], sample_period=5)
+        for i in range(30):
+            bank.add(20 + 0.01 * i)
+        # 0.01 degrees every 5 seconds.
+        self.assertAlmostEqual(0.12, bank.getRate())
+        self.assertAlmostEqual(0.12, bank.getRate(30))
+
+    def testRejectsSpikes(self):
+        bank = FilterBank([5], spike_threshold=5)
+        for value in [21.0, 21.1, 21.0, 20.9, 21.0, 21.1]:
+            self.assertTrue(bank.add(value))
+        # A 1-Wire sensor's power-on value.
+        self.assertFalse(bank.add(85.0))
+        self.assertTrue(bank.add(21.2))
+        self.assertEqual(1, bank.rejected)
+        self.assertEqual(21.0, bank.getMedian())
+        # A real step is accepted after max_rejects readings.
+        for _ in range(FilterBank.MAX_REJECTS):
+            self.assertFalse(bank.add(25.0))
+        self.assertTrue(bank.add(25.0))
+        self.assertEqual(1 + FilterBank.MAX_REJECTS, bank.rejected)
+
+    def testAcceptsStepChange(self):
+        bank = FilterBank([9], spike_threshold=3.5)
+        noise = [0.0, 0.1, -0.1, 0.05, -0.05]
+        for i in range(20):
+            self.assertTrue(bank.add(20 + noise[i % 5]))
+        accepted = [bank.add(25 + noise[i % 5]) for i in range(20)]
+        # Held back until max_rejects + 1 agree, then everything is accepted.
+        self.assertEqual([False] * FilterBank.MAX_REJECTS +
+                         [True] * (20 - FilterBank.MAX_REJECTS), accepted)
+        self.assertEqual(FilterBank.MAX_REJECTS, bank.rejected)
+        self.assertEqual(25.0, round(bank.getMedian()))
+        # Spikes are rejected again right after the step.
+        self.assertFalse(bank.add(85.0))
+        # Different outliers in a row do not count as a step.
+        bank = FilterBank([9], spike_threshold=3.5)
+        for _ in range(9):
+            bank.add(20.0)
+        for value in [85.0, -10.0, 85.0, -10.0, 85.0]:
+            self.assertFalse(bank.add(value))
+        self.assertEqual(20.0, bank.getMedian())
+
 class FanControllerTest(unittest.TestCase):
     def testRecomputeState(self):
         target = 74
@@ -134,6 +287,77 @@ class FanControllerTest(unittest.TestCase):
                             outside=inside - 0.5,
                             curr_state=STATE_ON))
 
+    def testControlLoopSkipsUnchangedInputs(self):
+        gpio = FakeFanGpio()
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0, gpio=gpio)
+        now = [1000.0]
+        thermostat._fc._GetTime = lambda: now[0]
+        thermostat.RecordIndoorMeasurement(25)
+        thermostat.RecordOutdoorMeasurement(10)
+        self.assertEqual(STATE_ON, thermostat.ControlLoop())
+        # The fan state changed, so this is recomputed...
+        self.assertEqual(STATE_ON, thermostat.ControlLoop())
+        # ... but nothing changed since.
+        self.assertEqual(STATE_ON, thermostat.ControlLoop())
+        self.assertEqual(1, thermostat.skipped_recomputes)
+        self.assertEqual(2, gpio.writes)
+        now[0] += 60
+        thermostat.RecordIndoorMeasurement(15)
+        self.assertEqual(STATE_OFF, thermostat.ControlLoop())
+        self.assertEqual(0, gpio.level)
+
+    def testSuppressedChangeIsNotSkipped(self):
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0, gpio=FakeFanGpio())
+        thermostat._fc._GetTime = lambda: 1000.0
+        thermostat.RecordIndoorMeasurement(25)
+        thermostat.RecordOutdoorMeasurement(10)
+        self.assertEqual(STATE_ON, thermostat.ControlLoop())
+        thermostat.RecordIndoorMeasurement(15)
+        # The inputs hold steady while the change is suppressed.
+        for _ in range(5):
+            self.assertEqual(STATE_OFF, thermostat.ControlLoop())
+        self.assertEqual(5, thermostat.GetFlappingSuppressedCount())
+        self.assertEqual(0, thermostat.skipped_recomputes)
+        self.assertEqual(STATE_ON, thermostat.GetState())
+
+    def testSuppressedChangeIsRetried(self):
+        gpio = FakeFanGpio()
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0, gpio=gpio)
+        now = [1000.0]
+        thermostat._fc._GetTime = lambda: now[0]
+        thermostat.RecordIndoorMeasurement(25)
+        thermostat.RecordOutdoorMeasurement(10)
+        thermostat.ControlLoop()
+        self.assertEqual(1, gpio.level)
+        thermostat.RecordIndoorMeasurement(15)
+        # Control steps every 5 seconds with steady inputs.
+        while now[0] < 1000 + _FanController._MIN_UPDATE_DELAY:
+            thermostat.ControlLoop()
+            self.assertEqual(1, gpio.level)
+            now[0] += 5
+        thermostat.ControlLoop()
+        self.assertEqual(0, gpio.level)
+        self.assertEqual(STATE_OFF, thermostat.GetState())
+        self.assertEqual(2, thermostat.GetStateChangeCount())
+        self.assertEqual(12, thermostat.GetFlappingSuppressedCount())
+        # Settled: recomputed once for the new fan state, then skipped again.
+        thermostat.ControlLoop()
+        thermostat.ControlLoop()
+        self.assertEqual(1, thermostat.skipped_recomputes)
+
+    def testControlLoopWithIntegratorNeverSkips(self):
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0,
+                                pid_gains=(-1.5, -0.03, 0), gpio=FakeFanGpio())
+        thermostat.RecordIndoorMeasurement(25)
+        thermostat.RecordOutdoorMeasurement(10)
+        for _ in range(3):
+            thermostat.ControlLoop()
+        self.assertEqual(0, thermostat.skipped_recomputes)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,9 +5,8 @@ Created on May 30, 2015
 '''
 import numpy as np
 import pylab
-import random
 
-from fancontroller import Thermostat
+from fancontroller.simulation import Simulate, PlantModel
 import logging
 
 if __name__ == '__main__':
@@ -18,38 +17,27 @@ if __name__ == '__main__':
     temp_increase_per_minute = 0.03
     t = np.arange(0, total_hours * 3600, step)
     outdoor = 70 + 13 * np.cos(2 * np.pi * t / (24 * 3600))
-    outdoor_median = [0] * len(t)
-    outdoor_average = [0] * len(t)
-    indoor = [80] * len(t)
-    state = [0] * len(t)
-    speed = [0] * len(t)
-    pid = [0] * len(t)
-    target = [target_temp] * len(t)
-    for i in range(len(t)):
-        outdoor[i] = outdoor[i] + random.randrange(-5, 5, 1) / 10.0
+    outdoor = outdoor + np.random.randint(-5, 5, len(t)) / 10.0
 
-    thermostat = Thermostat(target_temp,
-                            outside_window=600 / step,
-                            inside_window=60 / step,
-                            hysteresis=0.5,
-                            min_outside_diff=2)
-    for i in range(len(t)):
-        thermostat.RecordIndoorMeasurement(indoor[i])
-        thermostat.RecordOutdoorMeasurement(outdoor[i])
-        outdoor_median[i] = thermostat._outside_temp.getMedian()
-        state[i] = thermostat.ControlLoop()
-        pid[i] = thermostat.pid
-        target[i] = thermostat.p.getPoint()
-        fan_speed = pid[i]
-        if i < len(t) - 1:
-            indoor[i + 1] = indoor[i] + (temp_increase_per_minute / (60.0 / step))
-            if fan_speed: 
-                indoor[i + 1] = indoor[i] - (fan_speed * fan_temp_decrease_per_minute) / (60.0 / step)
+    result = Simulate(outdoor, target_temp,
+                      step=step,
+                      initial_indoor=80,
+                      outside_window=600 / step,
+                      inside_window=60 / step,
+                      hysteresis=0.5,
+                      min_outside_diff=2,
+                      plant=PlantModel(temp_increase_per_minute,
+                                       fan_temp_decrease_per_minute))
+    outdoor_median = result.outdoor_median
+    indoor = result.indoor
+    state = result.state
+    pid = result.pid
+    target = result.target
 
     logging.warn('Done with data, plotting')
     logging.warn('Changes: %d (per hour: %.1f)',
-                 thermostat.GetStateChangeCount(),
-                 thermostat.GetStateChangeCount() / total_hours)
+                 result.state_changes,
+                 result.state_changes / total_hours)
     fig = pylab.figure()
     ax1 = fig.add_subplot(1, 1, 1)
     ax1.plot(t, outdoor, '.r', label='outdoor')
@@ -2,20 +2,322 @@
 Created on Jun 28, 2015
 
 @author: isdal
+
+GPIO backends for the fans.
+
+A backend drives the pins: PigpioBackend through the pigpio daemon,
+SysfsBackend through /sys/class/gpio and /sys/class/pwm without any daemon,
+FakeBackend in memory. All of them remember the level and duty cycle last
+written to every pin and skip writes that would not change anything, so the
+control loop can call On() every cycle without a daemon round trip or sysfs
+write each time. Writes made inside Batch() are sent as one bank write,
+which sets the pins of all fans at once, and only the last duty cycle set
+for a pin inside it is written.
 '''
-import pigpio
+import contextlib
+import os
+import threading
+import time
+
+# Fan PWM frequency, 4 pin PC fans expect 25kHz.
+PWM_FREQUENCY = 25000
+# Pins with a hardware PWM channel on the Raspberry Pi, and their channel.
+HARDWARE_PWM_PINS = {12: 0, 13: 1, 18: 0, 19: 1}
+SYSFS_ROOT = '/sys/class/gpio'
+PWM_CHIP_ROOT = '/sys/class/pwm/pwmchip0'
+
+
+class GpioBackend(object):
+    """Base of the backends, caches pin levels so only changes are written.
+
+    Subclasses implement _Write(pin, level) and _SetPwm(pin, duty), and
+    _WriteBank(levels) if they can set several pins in one operation.
+    """
+
+    def __init__(self):
+        self._levels = {}
+        self._duties = {}
+        self._batch = None
+        self._pwm_batch = None
+        self._lock = threading.Lock()
+        # fancontroller.instrumentation.Instruments, times the operations
+        # sent to the hardware.
+        self.instruments = None
+        # Operations sent to the hardware, and writes skipped because the pin
+        # already had that level.
+        self.writes = 0
+        self.coalesced = 0
+
+    def Write(self, pin, level):
+        with self._lock:
+            if self._batch is not None:
+                self._batch[pin] = level
+            else:
+                self._WriteLevels({pin: level})
+
+    def WriteBank(self, levels):
+        """Sets the pins in levels (pin -> level), in one operation where the backend can."""
+        with self._lock:
+            self._WriteLevels(levels)
+
+    def _WriteLevels(self, levels):
+        changed = dict((pin, level) for pin, level in levels.items()
+                       if self._levels.get(pin) != level)
+        self.coalesced += len(levels) - len(changed)
+        if not changed:
+            return
+        start = time.time()
+        if len(changed) == 1:
+            self._Write(*changed.items()[0])
+        else:
+            self._WriteBank(changed)
+        self._Observe(start)
+        self._levels.update(changed)
+        self.writes += 1
+
+    def _WriteDuties(self, duties):
+        for pin, duty in sorted(duties.items()):
+            if self._duties.get(pin) == duty:
+                self.coalesced += 1
+                continue
+            start = time.time()
+            self._SetPwm(pin, duty)
+            self._Observe(start)
+            self._duties[pin] = duty
+            self.writes += 1
+
+    def _Observe(self, start):
+        if self.instruments is not None:
+            self.instruments.gpio_write.Observe(time.time() - start)
+
+    def _WriteBank(self, levels):
+        for pin, level in sorted(levels.items()):
+            self._Write(pin, level)
+
+    @contextlib.contextmanager
+    def Batch(self):
+        """Collects the Write() and SetPwm() calls in the with block and writes them at its end.
+
+        The levels are written as one bank, of the duty cycles set for a pin
+        only the last one is written.
+        """
+        with self._lock:
+            owner = self._batch is None
+            if owner:
+                self._batch = {}
+                self._pwm_batch = {}
+        try:
+            yield
+        finally:
+            if owner:
+                with self._lock:
+                    batch, self._batch = self._batch, None
+                    duties, self._pwm_batch = self._pwm_batch, None
+                    self._WriteLevels(batch)
+                    self._WriteDuties(duties)
+
+    def SetPwm(self, pin, duty):
+        """Sets the PWM duty cycle of pin, 0 to 1."""
+        duty = max(0.0, min(1.0, float(duty)))
+        with self._lock:
+            if self._pwm_batch is not None:
+                self._pwm_batch[pin] = duty
+            else:
+                self._WriteDuties({pin: duty})
+
+    def GetLevel(self, pin):
+        """The level last written to pin, None if it was never written."""
+        return self._levels.get(pin)
+
+    def Close(self):
+        pass
+
+
+class PigpioBackend(GpioBackend):
+    """Pins driven through the pigpio daemon, one connection for all fans."""
+
+    def __init__(self, host=None, port=None):
+        GpioBackend.__init__(self)
+        # Only needed with this backend.
+        import pigpio
+        kwargs = {}
+        if host is not None:
+            kwargs['host'] = host
+        if port is not None:
+            kwargs['port'] = port
+        self._pi = pigpio.pi(**kwargs)
+        if not self._pi.connected:
+            raise IOError('can not connect to the pigpio daemon')
+
+    def _Write(self, pin, level):
+        self._pi.write(pin, level)
+
+    def _WriteBank(self, levels):
+        on = sum(1 << pin for pin, level in levels.items() if level)
+        off = sum(1 << pin for pin, level in levels.items() if not level)
+        if on:
+            self._pi.set_bank_1(on)
+        if off:
+            self._pi.clear_bank_1(off)
+
+    def _SetPwm(self, pin, duty):
+        if pin in HARDWARE_PWM_PINS:
+            self._pi.hardware_PWM(pin, PWM_FREQUENCY, int(round(duty * 1000000)))
+        else:
+            # DMA timed PWM, at most 8kHz.
+            self._pi.set_PWM_dutycycle(pin, int(round(duty * 255)))
+
+    def Close(self):
+        self._pi.stop()
+
+
+class SysfsBackend(GpioBackend):
+    """Pins driven through the kernel's sysfs GPIO and PWM interfaces.
+
+    Exported pins keep their value file open, a write is one lseek and one
+    write system call.
+    """
+
+    def __init__(self, root=SYSFS_ROOT, pwm_root=PWM_CHIP_ROOT):
+        GpioBackend.__init__(self)
+        self._root = root
+        self._pwm_root = pwm_root
+        self._values = {}
+        self._duty_files = {}
+
+    @staticmethod
+    def _WriteFile(path, value):
+        with open(path, 'w') as f:
+            f.write(value)
+
+    @staticmethod
+    def _Store(fd, value):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, value)
+
+    def _Value(self, pin):
+        fd = self._values.get(pin)
+        if fd is None:
+            path = os.path.join(self._root, 'gpio%d' % pin)
+            if not os.path.isdir(path):
+                self._WriteFile(os.path.join(self._root, 'export'), str(pin))
+            self._WriteFile(os.path.join(path, 'direction'), 'out')
+            fd = self._values[pin] = os.open(os.path.join(path, 'value'), os.O_WRONLY)
+        return fd
+
+    def _Write(self, pin, level):
+        self._Store(self._Value(pin), b'1' if level else b'0')
+
+    def _SetPwm(self, pin, duty):
+        fd = self._duty_files.get(pin)
+        period = 1000000000 // PWM_FREQUENCY
+        if fd is None:
+            if pin not in HARDWARE_PWM_PINS:
+                raise ValueError('gpio %d has no hardware PWM' % pin)
+            path = os.path.join(self._pwm_root, 'pwm%d' % HARDWARE_PWM_PINS[pin])
+            if not os.path.isdir(path):
+                self._WriteFile(os.path.join(self._pwm_root, 'export'),
+                                str(HARDWARE_PWM_PINS[pin]))
+            self._WriteFile(os.path.join(path, 'period'), str(period))
+            fd = os.open(os.path.join(path, 'duty_cycle'), os.O_WRONLY)
+            self._Store(fd, str(int(round(duty * period))))
+            self._WriteFile(os.path.join(path, 'enable'), '1')
+            self._duty_files[pin] = fd
+            return
+        self._Store(fd, str(int(round(duty * period))))
+
+    def Close(self):
+        for fd in self._values.values() + self._duty_files.values():
+            os.close(fd)
+        self._values = {}
+        self._duty_files = {}
+
+
+class FakeBackend(GpioBackend):
+    """In-memory pins, records what reached the hardware."""
+
+    def __init__(self):
+        GpioBackend.__init__(self)
+        self.pins = {}
+        self.duty = {}
+        self.bank_writes = 0
+
+    def _Write(self, pin, level):
+        self.pins[pin] = level
+
+    def _WriteBank(self, levels):
+        self.pins.update(levels)
+        self.bank_writes += 1
+
+    def _SetPwm(self, pin, duty):
+        self.duty[pin] = duty
+
+
+BACKENDS = {'pigpio': PigpioBackend, 'sysfs': SysfsBackend, 'fake': FakeBackend}
+_default_backend = None
+
+
+def DefaultBackend():
+    """The PigpioBackend shared by the FanGpios created without a backend."""
+    global _default_backend
+    if _default_backend is None:
+        _default_backend = PigpioBackend()
+    return _default_backend
+
 
 class FanGpio(object):
     '''
-    classdocs
+    A fan switched by one GPIO pin, or with pwm speed controlled by its duty cycle.
     '''
-    
-    def __init__(self, gpio_port):
-        self.pi = pigpio.pi()
+
+    def __init__(self, gpio_port, backend=None, pwm=False):
+        self.backend = backend or DefaultBackend()
         self.port = gpio_port
-    
+        self.pwm = pwm
+        self.speed = 1.0
+        self._on = False
+
     def On(self):
-        self.pi.write(self.port, 1)
-            
+        self._on = True
+        if self.pwm:
+            self.backend.SetPwm(self.port, self.speed)
+        else:
+            self.backend.Write(self.port, 1)
+
     def Off(self):
-        self.pi.write(self.port, 0)
+        self._on = False
+        if self.pwm:
+            self.backend.SetPwm(self.port, 0)
+        else:
+            self.backend.Write(self.port, 0)
+
+    def SetSpeed(self, speed):
+        """Sets the duty cycle while on, 0 to 1; ignored without pwm."""
+        if not self.pwm:
+            return
+        self.speed = speed
+        if self._on:
+            self.backend.SetPwm(self.port, speed)
+
+
+class FakeFanGpio(object):
+    '''
+    In-memory stand-in for FanGpio, used by simulations and tests.
+    '''
+
+    def __init__(self, gpio_port=None):
+        self.port = gpio_port
+        self.level = 0
+        self.writes = 0
+        self.speed = None
+
+    def On(self):
+        self.level = 1
+        self.writes += 1
+
+    def Off(self):
+        self.level = 0
+        self.writes += 1
+
+    def SetSpeed(self, speed):
+        self.speed = speed
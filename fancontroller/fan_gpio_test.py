@@ -0,0 +1,118 @@
+'''
+Tests for the GPIO backends.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fancontroller import Thermostat
+from fancontroller.fan_gpio import FakeBackend, FanGpio, SysfsBackend, PWM_FREQUENCY
+from fancontroller.instrumentation import Instruments, Registry
+
+
+class GpioBackendTest(unittest.TestCase):
+
+    def testRedundantWritesAreCoalesced(self):
+        backend = FakeBackend()
+        fan = FanGpio(17, backend=backend)
+        for _ in range(10):
+            fan.On()
+        fan.Off()
+        fan.Off()
+        self.assertEqual(0, backend.pins[17])
+        self.assertEqual(2, backend.writes)
+        self.assertEqual(10, backend.coalesced)
+
+    def testBatchIsOneBankWrite(self):
+        backend = FakeBackend()
+        fans = [FanGpio(port, backend=backend) for port in (17, 18, 22)]
+        with backend.Batch():
+            for fan in fans:
+                fan.On()
+            # Not written before the end of the batch.
+            self.assertEqual({}, backend.pins)
+        self.assertEqual({17: 1, 18: 1, 22: 1}, backend.pins)
+        self.assertEqual(1, backend.bank_writes)
+        with backend.Batch():
+            fans[0].Off()
+            fans[1].On()
+        # Only one pin changed, no bank needed.
+        self.assertEqual(1, backend.bank_writes)
+        self.assertEqual(0, backend.GetLevel(17))
+
+    def testBatchWritesTheLastDutyCycle(self):
+        backend = FakeBackend()
+        backend.instruments = Instruments(Registry())
+        fan = FanGpio(18, backend=backend, pwm=True)
+        with backend.Batch():
+            fan.On()
+            fan.SetSpeed(0.5)
+            fan.SetSpeed(0.7)
+            # Not written before the end of the batch.
+            self.assertEqual({}, backend.duty)
+        self.assertEqual({18: 0.7}, backend.duty)
+        self.assertEqual(1, backend.writes)
+        # Only the write that reached the pin is timed.
+        self.assertEqual(1, backend.instruments.gpio_write.count)
+        with backend.Batch():
+            fan.SetSpeed(0.5)
+            fan.SetSpeed(0.7)
+        self.assertEqual(1, backend.writes)
+        self.assertEqual(1, backend.coalesced)
+
+    def testPwmFanFollowsPid(self):
+        backend = FakeBackend()
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1, hysteresis=0,
+                                min_outside_diff=0, gpio=FanGpio(18, backend=backend, pwm=True))
+        thermostat.RecordOutdoorMeasurement(15)
+        thermostat.RecordIndoorMeasurement(22.8)
+        thermostat.ControlLoop()
+        self.assertEqual(0.5, thermostat.pid)
+        self.assertEqual(0.5, backend.duty[18])
+        # Faster while on, without the flapping delay of on/off changes.
+        thermostat.RecordIndoorMeasurement(23.5)
+        thermostat.ControlLoop()
+        self.assertEqual(1, backend.duty[18])
+        thermostat.RecordIndoorMeasurement(22.55)
+        thermostat.ControlLoop()
+        # Not below the minimum speed.
+        self.assertEqual(0.1, thermostat.pid)
+        self.assertEqual(0.2, backend.duty[18])
+        self.assertNotIn(18, backend.pins)
+
+
+class SysfsBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for path in ['gpio/gpio17', 'pwm/pwm0']:
+            os.makedirs(os.path.join(self.dir, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _Read(self, path):
+        with open(os.path.join(self.dir, path)) as f:
+            return f.read()
+
+    def testWritesValueFiles(self):
+        backend = SysfsBackend(os.path.join(self.dir, 'gpio'), os.path.join(self.dir, 'pwm'))
+        open(os.path.join(self.dir, 'gpio/gpio17/value'), 'w').close()
+        backend.Write(17, 1)
+        self.assertEqual('out', self._Read('gpio/gpio17/direction'))
+        self.assertEqual('1', self._Read('gpio/gpio17/value'))
+        backend.Write(17, 0)
+        self.assertEqual('0', self._Read('gpio/gpio17/value'))
+        open(os.path.join(self.dir, 'pwm/pwm0/duty_cycle'), 'w').close()
+        backend.SetPwm(18, 0.5)
+        period = 1000000000 // PWM_FREQUENCY
+        self.assertEqual(str(period), self._Read('pwm/pwm0/period'))
+        self.assertEqual(str(period // 2), self._Read('pwm/pwm0/duty_cycle'))
+        self.assertEqual('1', self._Read('pwm/pwm0/enable'))
+        self.assertRaises(ValueError, backend.SetPwm, 17, 0.5)
+        backend.Close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,27 +8,441 @@ from collections import deque
 
 class MedianFilter:
     """Simple class for calculating the median over a window of temperature measurements."""
+    # Windows below this use the bisect based list, the skiplist only pays off
+    # once shifting the list on every add costs more than its node overhead.
+    SKIPLIST_MIN_WINDOW = 100000
+
     def __init__(self, window):
         self.window = window
-        self.skiplist = running_median.IndexableSkiplist(expected_size=window)
+        self.ordered = self._CreateOrdered()
         self.queue = deque()
         self.sum = 0.0
-        
+
+    def _CreateOrdered(self):
+        return _CreateOrdered(self.window)
+
     def add(self, temperature):
         if len(self.queue) == self.window:
             to_remove = self.queue.popleft()
-            self.skiplist.remove(to_remove)
+            self.ordered.remove(to_remove)
             self.sum -= to_remove
         self.queue.append(temperature)
-        self.skiplist.insert(temperature)
+        self.ordered.insert(temperature)
         self.sum += temperature
-        
+
+    def addMany(self, temperatures):
+        """Adds all temperatures, same as calling add() for each of them."""
+        self._addMany(temperatures)
+
+    def rollingMedian(self, temperatures):
+        """Adds all temperatures and returns the median after each add.
+
+        Returns a NumPy array, NaN where getMedian() would have returned None.
+        """
+        return self._addMany(temperatures, medians=True)[0]
+
+    def rollingAverage(self, temperatures):
+        """Adds all temperatures and returns the average after each add.
+
+        Returns a NumPy array, NaN where getAverage() would have returned None.
+        """
+        return self._addMany(temperatures, averages=True)[1]
+
+    def _addMany(self, temperatures, medians=False, averages=False):
+        # numpy is only needed for offline processing, keep it off the Pi's
+        # control path.
+        import numpy as np
+        values = np.asarray(temperatures, dtype=float).ravel()
+        window = int(self.window)
+        queued = len(self.queue)
+        history = np.concatenate([np.array(self.queue, dtype=float), values])
+        n = len(values)
+        # Index of the first new value that completes a full window.
+        first = min(n, max(0, window - queued - 1))
+
+        median_series = None
+        if medians:
+            median_series = np.full(n, np.nan)
+            if first < n:
+                median_series[first:] = _RollingSelect(
+                    history[queued + first - window + 1:], window, window // 2)
+
+        # Replay the exact add()/subtract sequence of add() so the running sum
+        # is bit-identical: one subtraction (or -0.0 while the window fills)
+        # followed by one addition per value, accumulated left to right.
+        removed = np.full(n, 0.0)
+        start = max(0, window - queued)
+        if start < n:
+            removed[start:] = history[queued + start - window:queued + n - window]
+        ops = np.empty(2 * n + 1)
+        ops[0] = self.sum
+        ops[1::2] = np.where(np.arange(n) >= start, -removed, -0.0)
+        ops[2::2] = values
+        sums = np.add.accumulate(ops)[2::2]
+
+        average_series = None
+        if averages:
+            average_series = np.full(n, np.nan)
+            average_series[first:] = sums[first:] / self.window
+
+        if n:
+            self.sum = float(sums[-1])
+            self.queue = deque(history[-window:].tolist())
+            self.ordered = self._CreateOrdered()
+            for v in self.queue:
+                self.ordered.insert(v)
+        return median_series, average_series
+
+    def getValues(self):
+        """Returns the values in the window, oldest first."""
+        return list(self.queue)
+
+    def restore(self, values, total=None):
+        """Replaces the window with values (oldest first), as returned by getValues().
+
+        total is the saved sum, restoring it keeps getAverage() identical to
+        the filter the values were saved from. It is ignored if values do not
+        fit the window.
+        """
+        self.queue = deque()
+        self.ordered = self._CreateOrdered()
+        self.sum = 0.0
+        for v in values:
+            self.add(v)
+        if total is not None and len(values) <= self.window:
+            self.sum = total
+
     def getMedian(self):
         if len(self.queue) < self.window:
             return None
-        return self.skiplist[len(self.queue) // 2]
+        return self.ordered[len(self.queue) // 2]
 
     def getAverage(self):
         if len(self.queue) < self.window:
             return None
         return self.sum / self.window
+
+
+def _CreateOrdered(window):
+    if window >= MedianFilter.SKIPLIST_MIN_WINDOW:
+        return running_median.IndexableSkiplist(expected_size=window)
+    return running_median.IndexableSortedList(expected_size=window)
+
+
+# Scales the MAD to the standard deviation of normally distributed values.
+_MAD_SCALE = 1.4826
+
+
+def _Median(values):
+    # The upper median, like the windows'.
+    return sorted(values)[len(values) // 2]
+
+
+def _KthOfTwo(a, na, b, nb, k):
+    """Returns the k-th smallest (from 0) value of two sorted sequences given as getters."""
+    lo, hi = max(0, k + 1 - nb), min(k + 1, na)
+    # Find how many of the k + 1 smallest come from a.
+    while lo < hi:
+        i = (lo + hi) // 2
+        if a(i) < b(k - i):
+            lo = i + 1
+        else:
+            hi = i
+    i, j = lo, k + 1 - lo
+    if i == 0:
+        return b(j - 1)
+    if j == 0:
+        return a(i - 1)
+    return max(a(i - 1), b(j - 1))
+
+
+class _Window(object):
+    """The sorted values and running sums of one window of a FilterBank."""
+
+    def __init__(self, size):
+        self.size = size
+        self.ordered = _CreateOrdered(size)
+        self.ResetSums()
+
+    def ResetSums(self):
+        # Of values, times (relative to the bank's base time), times squared
+        # and times * values, for the average and the rate.
+        self.sum = 0.0
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_tv = 0.0
+
+    def Add(self, value, t):
+        self.ordered.insert(value)
+        self.sum += value
+        self.sum_t += t
+        self.sum_tt += t * t
+        self.sum_tv += t * value
+
+    def Remove(self, value, t):
+        self.ordered.remove(value)
+        self.sum -= value
+        self.sum_t -= t
+        self.sum_tt -= t * t
+        self.sum_tv -= t * value
+
+
+class FilterBank:
+    """Rolling statistics of one signal over several windows at once.
+
+    The last max(windows) samples live in one ring buffer. Each window has
+    one sorted structure and a few running sums that all of its statistics
+    share, so add() costs O(log n) per window however many statistics are
+    read: median, percentiles, average, trimmed mean, MAD and rate of
+    change. Like MedianFilter, statistics are None until their window is
+    full.
+
+    With spike_threshold a sample further than spike_threshold standard
+    deviations (estimated from the MAD of the shortest window, at least
+    min_mad) from that window's median is rejected, e.g. a 1-Wire sensor's
+    85C power-on value. When max_rejects rejected samples in a row are
+    followed by one more that agrees with them, the signal is taken to have
+    really moved: the rejected samples are added after all, and until they
+    make up most of the shortest window new samples are judged against them
+    instead of the lagging window median.
+    """
+    MIN_MAD = 0.05
+    MAX_REJECTS = 3
+
+    def __init__(self, windows, sample_period=1.0, spike_threshold=None,
+                 min_mad=MIN_MAD, max_rejects=MAX_REJECTS):
+        self.windows = sorted(set(int(w) for w in windows))
+        self._capacity = self.windows[-1]
+        self._values = [0.0] * self._capacity
+        self._times = [0.0] * self._capacity
+        self._count = 0
+        self._base = None
+        self._sample_period = sample_period
+        self._stats = dict((w, _Window(w)) for w in self.windows)
+        self.spike_threshold = spike_threshold
+        self.min_mad = min_mad
+        self.max_rejects = max_rejects
+        self.rejected = 0
+        # (value, timestamp) of the samples rejected in a row.
+        self._pending = []
+        # The samples since the signal moved, None once the window caught up.
+        self._recent = None
+
+    def add(self, value, timestamp=None):
+        """Adds a sample taken at timestamp (seconds), returns False if it was rejected as a spike.
+
+        Without timestamps samples are sample_period seconds apart.
+        """
+        pending = self._pending
+        if self.spike_threshold is not None and self._IsSpike(value):
+            if pending and not self._Agrees(value, [v for v, _ in pending]):
+                # Another outlier, not the signal moving.
+                del pending[:]
+            if len(pending) < self.max_rejects:
+                pending.append((value, timestamp))
+                self.rejected += 1
+                return False
+            self._recent = []
+            for v, t in pending:
+                self._Add(v, t)
+        del pending[:]
+        self._Add(value, timestamp)
+        return True
+
+    def _Add(self, value, timestamp):
+        if timestamp is None:
+            timestamp = self._count * self._sample_period
+        if self._recent is not None:
+            self._recent.append(value)
+            if len(self._recent) > self.windows[0] // 2:
+                self._recent = None
+        if self._base is None:
+            self._base = timestamp
+        t = timestamp - self._base
+        count = self._count
+        for size, window in self._stats.items():
+            if count >= size:
+                old = (count - size) % self._capacity
+                window.Remove(self._values[old], self._times[old])
+            window.Add(value, t)
+        position = count % self._capacity
+        self._values[position] = value
+        self._times[position] = t
+        self._count = count + 1
+        if self._count % self._capacity == 0:
+            self._Rebase()
+
+    def _Rebase(self):
+        # The running sums cancel less the closer the times are to 0 and
+        # rounding errors do not accumulate past one pass over the buffer:
+        # recompute them from the oldest sample. Amortized O(1) per add().
+        oldest = self._times[self._count % self._capacity]
+        self._base += oldest
+        self._times = [t - oldest for t in self._times]
+        for size, window in self._stats.items():
+            window.ResetSums()
+            for i in range(self._count - min(size, self._count), self._count):
+                position = i % self._capacity
+                value, t = self._values[position], self._times[position]
+                window.sum += value
+                window.sum_t += t
+                window.sum_tt += t * t
+                window.sum_tv += t * value
+
+    def _GetReference(self):
+        """Returns the median and the scale spikes are measured in, None before the window filled."""
+        if self._recent is None:
+            median = self.getMedian()
+            if median is None:
+                return None, None
+            mad = self.getMad()
+        else:
+            median = _Median(self._recent)
+            mad = _Median([abs(v - median) for v in self._recent])
+        return median, _MAD_SCALE * max(mad, self.min_mad)
+
+    def _IsSpike(self, value):
+        median, scale = self._GetReference()
+        if median is None:
+            return False
+        return abs(value - median) > self.spike_threshold * scale
+
+    def _Agrees(self, value, values):
+        _, scale = self._GetReference()
+        return abs(value - _Median(values)) <= self.spike_threshold * scale
+
+    def _Full(self, window):
+        if window is None:
+            window = self.windows[0]
+        stats = self._stats[window]
+        if self._count < window:
+            return None
+        return stats
+
+    def getMedian(self, window=None):
+        stats = self._Full(window)
+        if stats is None:
+            return None
+        return stats.ordered[stats.size // 2]
+
+    def getPercentile(self, q, window=None):
+        """The q-th percentile (0-100), interpolated between samples like numpy.percentile."""
+        stats = self._Full(window)
+        if stats is None:
+            return None
+        rank = (stats.size - 1) * q / 100.0
+        lower = int(rank)
+        if lower + 1 >= stats.size:
+            return stats.ordered[stats.size - 1]
+        low = stats.ordered[lower]
+        return low + (stats.ordered[lower + 1] - low) * (rank - lower)
+
+    def getAverage(self, window=None):
+        stats = self._Full(window)
+        if stats is None:
+            return None
+        return stats.sum / stats.size
+
+    def getTrimmedMean(self, fraction, window=None):
+        """The average without the lowest and highest fraction of the samples."""
+        stats = self._Full(window)
+        if stats is None:
+            return None
+        trim = int(stats.size * fraction)
+        if 2 * trim >= stats.size:
+            return self.getMedian(window)
+        ordered = stats.ordered
+        total = stats.sum
+        for i in range(trim):
+            total -= ordered[i] + ordered[stats.size - 1 - i]
+        return total / (stats.size - 2 * trim)
+
+    def getMad(self, window=None):
+        """The median absolute deviation from the median, O(log n)."""
+        stats = self._Full(window)
+        if stats is None:
+            return None
+        ordered = stats.ordered
+        n = stats.size
+        half = n // 2
+        median = ordered[half]
+        # The deviations below and above the median, both ascending.
+        return _KthOfTwo(lambda i: median - ordered[half - 1 - i], half,
+                         lambda i: ordered[half + i] - median, n - half, half)
+
+    def getRate(self, window=None):
+        """The least squares slope of the samples in degrees per minute."""
+        stats = self._Full(window)
+        if stats is None or stats.size < 2:
+            return None
+        n = stats.size
+        denominator = n * stats.sum_tt - stats.sum_t * stats.sum_t
+        if denominator <= 0:
+            return None
+        return 60 * (n * stats.sum_tv - stats.sum_t * stats.sum) / denominator
+
+
+# Windows up to this size are selected with np.partition over a strided view,
+# which costs O(window) per value. Larger windows use a wavelet matrix over
+# the values' ranks, O(log n) vectorized steps whatever the window.
+_PARTITION_MAX_WINDOW = 32
+
+
+def _RollingSelect(values, window, k):
+    """Returns the k-th smallest value of every full window of values."""
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+    values = np.ascontiguousarray(values, dtype=float)
+    count = len(values) - window + 1
+    if count <= 0:
+        return np.empty(0)
+    if window <= _PARTITION_MAX_WINDOW:
+        selected = np.empty(count)
+        chunk_size = max(1, (1 << 20) // window)
+        for start in range(0, count, chunk_size):
+            stop = min(count, start + chunk_size)
+            chunk = values[start:stop + window - 1]
+            view = as_strided(chunk, shape=(stop - start, window),
+                              strides=(chunk.strides[0], chunk.strides[0]))
+            selected[start:stop] = np.partition(view, k, axis=1)[:, k]
+        return selected
+    return _WaveletSelect(values, window, k)
+
+
+def _WaveletSelect(values, window, k):
+    """_RollingSelect() for large windows.
+
+    Every value is replaced by its distinct rank. A wavelet matrix level
+    stably moves the ranks with a 0 bit before those with a 1 bit, highest
+    bit first; counting the 0 bits in a window tells whether its k-th rank
+    has that bit set, and where the window's values went on the next level.
+    All windows descend the levels together.
+    """
+    import numpy as np
+    n = len(values)
+    count = n - window + 1
+    order = np.argsort(values, kind='mergesort').astype(np.int32)
+    ranks = np.empty(n, dtype=np.int32)
+    ranks[order] = np.arange(n, dtype=np.int32)
+    lo = np.arange(count, dtype=np.int32)
+    hi = lo + window
+    k = np.full(count, k, dtype=np.int32)
+    selected = np.zeros(count, dtype=np.int32)
+    # zeros[i]: the 0 bits among the first i ranks of the level.
+    zeros = np.zeros(n + 1, dtype=np.int32)
+    for bit in range(max(1, int(n - 1).bit_length()) - 1, -1, -1):
+        zero = (ranks >> bit) & 1 == 0
+        np.cumsum(zero, out=zeros[1:])
+        total = zeros[-1]
+        zeros_lo = zeros[lo]
+        zeros_hi = zeros[hi]
+        in_window = zeros_hi - zeros_lo
+        one = (k >= in_window).astype(np.int32)
+        k -= in_window * one
+        # The 0 bits keep their order at the start of the next level, the 1
+        # bits follow them.
+        lo = zeros_lo + one * (total + lo - 2 * zeros_lo)
+        hi = zeros_hi + one * (total + hi - 2 * zeros_hi)
+        selected |= one << bit
+        ranks = np.concatenate([ranks[zero], ranks[~zero]])
+    return values[order[selected]]
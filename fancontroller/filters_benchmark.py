@@ -0,0 +1,57 @@
+'''
+Benchmark of the MedianFilter order statistic backends.
+
+Prints the per add() latency and the memory held by the sorted structure of
+IndexableSkiplist and IndexableSortedList for a range of window sizes.
+
+  PYTHONPATH=. python fancontroller/filters_benchmark.py
+'''
+import random
+import sys
+import timeit
+
+import running_median
+from fancontroller.filters import MedianFilter
+
+WINDOWS = [1, 6, 60, 600, 6000]
+BACKENDS = [running_median.IndexableSkiplist, running_median.IndexableSortedList]
+
+
+def _StructureSize(ordered):
+    """Bytes used by the structure itself, the values are shared with the queue."""
+    if isinstance(ordered, running_median.IndexableSortedList):
+        return sys.getsizeof(ordered.values)
+    size = 0
+    node = ordered.head
+    while node is not running_median.NIL:
+        size += (sys.getsizeof(node) + sys.getsizeof(node.next) +
+                 sys.getsizeof(node.width))
+        node = node.next[0]
+    return size
+
+
+def _CreateFilter(backend, window):
+    median_filter = MedianFilter(window)
+    median_filter.ordered = backend(expected_size=window)
+    return median_filter
+
+
+def Benchmark(backend, window, adds=20000):
+    """Returns (seconds per add, structure bytes) for a full window."""
+    median_filter = _CreateFilter(backend, window)
+    values = [20 + random.random() * 5 for _ in range(window + adds)]
+    for v in values[:window]:
+        median_filter.add(v)
+    it = iter(values[window:])
+    add = median_filter.add
+    elapsed = min(timeit.repeat(lambda: add(next(it)), number=adds // 4, repeat=4))
+    return elapsed / (adds // 4), _StructureSize(median_filter.ordered)
+
+
+if __name__ == '__main__':
+    print('%-20s %8s %12s %12s' % ('backend', 'window', 'us/add', 'bytes'))
+    for window in WINDOWS:
+        for backend in BACKENDS:
+            latency, size = Benchmark(backend, window)
+            print('%-20s %8d %12.2f %12d' % (backend.__name__, window,
+                                             latency * 1e6, size))
@@ -0,0 +1,225 @@
+'''
+Cached NOAA MapClick forecast.
+
+ForecastCache downloads the forecast at most once per ttl with conditional
+requests (ETag / If-Modified-Since), extracts the handful of fields the
+controller needs into a ForecastIndex and atomically stores only that index
+on disk, so a restart loads a few hundred bytes instead of re-downloading
+and re-parsing the whole document.
+'''
+import calendar
+import logging
+import os
+import threading
+import time
+
+URL = 'http://forecast.weather.gov/MapClick.php?lat=47.6738&lon=-122.342&unit=c&lg=english&FcstType=json'
+# Forecast temperatures are in C (unit=c above), the current observation is F.
+CACHE_FILE = '/var/tmp/fancontroller-forecast.json'
+TTL = 3600
+TIMEOUT = 10
+RETRY_DELAY = 60
+
+# Local hour of the day the forecast high / low is assumed to occur.
+_HIGH_HOUR = 15
+_LOW_HOUR = 5
+
+
+def _ftoc(degrees_f):
+    return (float(degrees_f) - 32) * 5 / 9
+
+
+def _ParseTime(text):
+    """Parses '2015-06-24T06:00:00-07:00', returns (epoch seconds, utc offset seconds)."""
+    offset_sign = -1 if text[19] == '-' else 1
+    offset = offset_sign * (int(text[20:22]) * 3600 + int(text[23:25]) * 60)
+    local = calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S'))
+    return local - offset, offset
+
+
+def _NextLocalHour(epoch, offset, hour):
+    """Returns the first time at or after epoch where the local hour is hour."""
+    local = epoch + offset
+    day_start = local - local % 86400
+    candidate = day_start + hour * 3600
+    if candidate < local:
+        candidate += 86400
+    return candidate - offset
+
+
+class ForecastIndex(object):
+    """The fields of a MapClick forecast the controller queries.
+
+    current_temp: observed temperature in C.
+    periods: list of (start epoch, name, 'High' or 'Low', temperature C).
+    extremes: list of (epoch, temperature C), the times the highs and lows
+      are assumed to occur, used to interpolate an hourly series.
+    """
+
+    def __init__(self, current_temp, periods, extremes):
+        self.current_temp = current_temp
+        self.periods = periods
+        self.extremes = extremes
+
+    @staticmethod
+    def FromDocument(doc):
+        current_temp = None
+        observation = doc.get('currentobservation') or {}
+        try:
+            current_temp = _ftoc(observation['Temp'])
+        except (KeyError, ValueError):
+            pass
+        periods = []
+        extremes = []
+        times = doc['time']
+        for start, name, label, temp in zip(times['startValidTime'],
+                                            times['startPeriodName'],
+                                            times['tempLabel'],
+                                            doc['data']['temperature']):
+            if temp is None:
+                continue
+            epoch, offset = _ParseTime(start)
+            periods.append((epoch, name, label, float(temp)))
+            hour = _HIGH_HOUR if label == 'High' else _LOW_HOUR
+            extremes.append((_NextLocalHour(epoch, offset, hour), float(temp)))
+        return ForecastIndex(current_temp, periods, extremes)
+
+    def ToDict(self):
+        return {'current_temp': self.current_temp,
+                'periods': self.periods,
+                'extremes': self.extremes}
+
+    @staticmethod
+    def FromDict(d):
+        return ForecastIndex(d['current_temp'],
+                             [tuple(p) for p in d['periods']],
+                             [tuple(e) for e in d['extremes']])
+
+    def _Next(self, label):
+        for _, _, period_label, temp in self.periods:
+            if period_label == label:
+                return temp
+        return None
+
+    def GetNextHigh(self):
+        return self._Next('High')
+
+    def GetNextLow(self):
+        return self._Next('Low')
+
+    def GetHourlySeries(self, start, hours):
+        """Returns hours temperatures, one per hour from start (epoch seconds).
+
+        Linearly interpolated between the forecast highs and lows, held
+        constant outside of the forecast range. Empty if there is no forecast.
+        """
+        if not self.extremes:
+            return []
+        import numpy as np
+        t = start + 3600.0 * np.arange(hours)
+        times, temps = zip(*self.extremes)
+        return np.interp(t, times, temps).tolist()
+
+
+class ForecastCache(object):
+    """Downloads the forecast at most every ttl seconds and keeps its index.
+
+    Refresh() blocks on the network, run it from its own task (Runtime's
+    forecast task) or with Start() on a background thread.
+    """
+
+    def __init__(self, url=URL, cache_path=CACHE_FILE, ttl=TTL, timeout=TIMEOUT):
+        self._url = url
+        self._cache_path = cache_path
+        self._ttl = ttl
+        self._timeout = timeout
+        self._etag = None
+        self._last_modified = None
+        self.fetched_at = 0
+        self.index = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.Load()
+
+    def Load(self):
+        """Loads the index from the on-disk cache, returns False if there is none."""
+        if not self._cache_path or not os.path.exists(self._cache_path):
+            return False
+        import json
+        try:
+            with open(self._cache_path) as f:
+                cached = json.load(f)
+            self.index = ForecastIndex.FromDict(cached['index'])
+        except (IOError, ValueError, KeyError) as e:
+            logging.warn('Ignoring bad forecast cache %s: %s', self._cache_path, e)
+            return False
+        self._etag = cached.get('etag')
+        self._last_modified = cached.get('last_modified')
+        self.fetched_at = cached.get('fetched_at', 0)
+        return True
+
+    def _Save(self):
+        if not self._cache_path:
+            return
+        import json
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'etag': self._etag,
+                       'last_modified': self._last_modified,
+                       'fetched_at': self.fetched_at,
+                       'index': self.index.ToDict()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._cache_path)
+
+    def IsFresh(self):
+        return self.index is not None and time.time() - self.fetched_at < self._ttl
+
+    def Refresh(self, force=False):
+        """Downloads the forecast if the cached one expired.
+
+        Returns True if the index changed.
+        """
+        if not force and self.IsFresh():
+            return False
+        import json
+        import requests
+        headers = {}
+        if self.index is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        resp = requests.get(url=self._url, headers=headers, timeout=self._timeout)
+        if resp.status_code == 304:
+            logging.debug('Forecast not modified')
+            self.fetched_at = time.time()
+            self._Save()
+            return False
+        resp.raise_for_status()
+        self.index = ForecastIndex.FromDocument(json.loads(resp.text))
+        self._etag = resp.headers.get('ETag')
+        self._last_modified = resp.headers.get('Last-Modified')
+        self.fetched_at = time.time()
+        self._Save()
+        return True
+
+    def _Run(self):
+        while not self._stop.is_set():
+            try:
+                self.Refresh()
+                delay = self.fetched_at + self._ttl - time.time()
+            except Exception as e:
+                logging.warn('Forecast refresh failed: %s', e)
+                delay = RETRY_DELAY
+            self._stop.wait(max(1, delay))
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._Run, name='forecast')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,109 @@
+'''
+Tests for the cached NOAA forecast.
+'''
+import BaseHTTPServer
+import calendar
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from fancontroller.fan_controller import NoaaForecast
+from fancontroller.forecast import ForecastCache
+
+_ETAG = '"noaa-1"'
+
+
+class FakeNoaaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for forecast.weather.gov serving the checked-in noaa.json."""
+    requests = []
+
+    def do_GET(self):
+        FakeNoaaHandler.requests.append(self.headers.getheader('If-None-Match'))
+        if self.headers.getheader('If-None-Match') == _ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = open('noaa.json').read()
+        self.send_response(200)
+        self.send_header('ETag', _ETAG)
+        self.send_header('Last-Modified', 'Tue, 23 Jun 2015 22:00:00 GMT')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ForecastCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeNoaaHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), FakeNoaaHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://localhost:%d/MapClick.php' % self.server.server_port
+        self.dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.dir, 'forecast.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def createCache(self, **kwargs):
+        return ForecastCache(url=self.url, cache_path=self.cache_path, **kwargs)
+
+    def testRefresh(self):
+        cache = self.createCache()
+        self.assertTrue(cache.Refresh())
+        self.assertAlmostEqual(cache.index.current_temp, 20.56, places=2)
+        self.assertEqual(27, cache.index.GetNextHigh())
+        self.assertEqual(13, cache.index.GetNextLow())
+        self.assertTrue(os.path.exists(self.cache_path))
+        # Within the ttl nothing is downloaded.
+        self.assertFalse(cache.Refresh())
+        self.assertEqual([None], FakeNoaaHandler.requests)
+
+    def testConditionalRequest(self):
+        cache = self.createCache(ttl=0)
+        self.assertTrue(cache.Refresh())
+        self.assertFalse(cache.Refresh())
+        self.assertEqual([None, _ETAG], FakeNoaaHandler.requests)
+        self.assertEqual(27, cache.index.GetNextHigh())
+
+    def testLoadFromDisk(self):
+        self.createCache().Refresh()
+        restarted = self.createCache()
+        self.assertTrue(restarted.IsFresh())
+        self.assertFalse(restarted.Refresh())
+        self.assertEqual(1, len(FakeNoaaHandler.requests))
+        self.assertEqual(27, restarted.index.GetNextHigh())
+        forecast = NoaaForecast(cache=restarted)
+        self.assertEqual(27, forecast.GetTomorrowsHigh())
+        self.assertAlmostEqual(forecast.GetCurrentTemp(), 20.56, places=2)
+
+    def testCorruptCacheIsIgnored(self):
+        open(self.cache_path, 'w').write('{"index": ')
+        cache = self.createCache()
+        self.assertIsNone(cache.index)
+        self.assertTrue(cache.Refresh())
+
+    def testHourlySeries(self):
+        cache = self.createCache()
+        cache.Refresh()
+        # The first low (13C) is assumed at 5am, the first high (27C) at 3pm PDT.
+        low = calendar.timegm(time.strptime('2015-06-24 12:00', '%Y-%m-%d %H:%M'))
+        series = cache.index.GetHourlySeries(low - 3600, 12)
+        self.assertEqual(13, series[0])
+        self.assertEqual(13, series[1])
+        self.assertEqual(20, series[6])
+        self.assertEqual(27, series[11])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+'''
+Fixed size, memory-mapped ring buffer of controller measurements.
+
+The file is a small header followed by capacity fixed size records. Append
+writes one record in place and then bumps the head counter, so an append
+dirties at most two pages and the kernel writes them back in batches. Every
+record carries a CRC, on reopen trailing records that did not make it to
+disk intact are dropped; once the ring has wrapped, a dropped record's slot
+no longer holds the oldest record either, so the header also keeps the
+index of the oldest valid record. Reads are zero-copy NumPy views on the mapping.
+
+Timestamps never decrease from one record to the next, so time ranges are
+found by binary search. A record appended while the clock is behind the
+previous record, e.g. after an NTP step, gets the previous timestamp.
+'''
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'FCHIST01'
+VERSION = 1
+# magic, version, record size, capacity, head (records ever appended), tail
+# (index of the oldest valid record, 0 in files written before it existed).
+_HEADER = struct.Struct('<8sIIQQQ')
+HEADER_SIZE = 64
+# timestamp, indoor, outdoor, indoor median, outdoor median, pid, target,
+# state, zone, crc32 of the preceding bytes.
+_RECORD = struct.Struct('<d6fBB2xI')
+_CRC_OFFSET = _RECORD.size - 4
+RECORD_FIELDS = ['timestamp', 'indoor', 'outdoor', 'indoor_median',
+                 'outdoor_median', 'pid', 'target', 'state', 'zone']
+HISTORY_FILE = '/var/tmp/fancontroller-history.bin'
+# A month of samples every 5 seconds.
+DEFAULT_CAPACITY = 31 * 24 * 3600 // 5
+
+
+def RecordDtype():
+    """NumPy dtype matching the on-disk record layout."""
+    import numpy as np
+    return np.dtype({'names': RECORD_FIELDS + ['crc'],
+                     'formats': ['<f8'] + ['<f4'] * 6 + ['u1', 'u1', '<u4'],
+                     'offsets': [0, 8, 12, 16, 20, 24, 28, 32, 33, 36],
+                     'itemsize': _RECORD.size})
+
+
+def _Nan(value):
+    return float('nan') if value is None else value
+
+
+class HistoryStore(object):
+    """Ring buffer of the last capacity measurement records in a file.
+
+    A readonly store never creates or writes the file, torn records are only
+    left out of its reads, so tools can read the history of a running
+    controller.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            self._file = open(path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                self._Create(path, capacity)
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        (magic, version, record_size, self.capacity, self._head,
+         self._tail) = _HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION or record_size != _RECORD.size:
+            self.Close()
+            raise ValueError('%s is not a version %d history file' % (path, VERSION))
+        if len(self._map) < HEADER_SIZE + self.capacity * _RECORD.size:
+            self.Close()
+            raise ValueError('%s is truncated' % path)
+        self._record = bytearray(_RECORD.size)
+        self._DropTornRecords()
+        self._last_timestamp = float('-inf')
+        if len(self):
+            self._last_timestamp = struct.unpack_from(
+                '<d', self._map, self._Offset(self._head - 1))[0]
+        self._clock_behind = False
+
+    @staticmethod
+    def _Create(path, capacity):
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, _RECORD.size, capacity, 0, 0))
+            f.truncate(HEADER_SIZE + capacity * _RECORD.size)
+
+    def _Offset(self, index):
+        return HEADER_SIZE + (index % self.capacity) * _RECORD.size
+
+    def _IsValid(self, index):
+        offset = self._Offset(index)
+        crc = struct.unpack_from('<I', self._map, offset + _CRC_OFFSET)[0]
+        return crc == zlib.crc32(self._map[offset:offset + _CRC_OFFSET]) & 0xffffffff
+
+    def _DropTornRecords(self):
+        # A torn record overwrote the slot of the record capacity before it,
+        # so the oldest valid record stays where it was.
+        self._tail = max(self._tail, self._head - self.capacity)
+        while len(self) and not self._IsValid(self._head - 1):
+            logging.warn('Dropping torn history record %d', self._head - 1)
+            self._head -= 1
+        if self.readonly:
+            return
+        struct.pack_into('<Q', self._map, 32, self._tail)
+        self._WriteHead()
+
+    def _WriteHead(self):
+        struct.pack_into('<Q', self._map, 24, self._head)
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def Append(self, timestamp, indoor, outdoor, indoor_median, outdoor_median,
+               pid, target, state, zone=0):
+        """Appends one record, None temperatures are stored as NaN."""
+        if timestamp < self._last_timestamp:
+            if not self._clock_behind:
+                logging.warn('Clock is %.1f seconds behind the last history record',
+                             self._last_timestamp - timestamp)
+                self._clock_behind = True
+            timestamp = self._last_timestamp
+        else:
+            self._clock_behind = False
+        self._last_timestamp = timestamp
+        record = self._record
+        _RECORD.pack_into(record, 0, timestamp, _Nan(indoor), _Nan(outdoor),
+                          _Nan(indoor_median), _Nan(outdoor_median), pid,
+                          _Nan(target), state, zone, 0)
+        struct.pack_into('<I', record, _CRC_OFFSET,
+                         zlib.crc32(bytes(record[:_CRC_OFFSET])) & 0xffffffff)
+        offset = self._Offset(self._head)
+        self._map[offset:offset + _RECORD.size] = bytes(record)
+        # The head only moves once the record is in place.
+        self._head += 1
+        # Derived from the head on reopen, only written when records are dropped.
+        self._tail = max(self._tail, self._head - self.capacity)
+        self._WriteHead()
+
+    def GetSegments(self):
+        """Returns the records oldest first as at most two zero-copy NumPy views."""
+        import numpy as np
+        records = np.frombuffer(self._map, dtype=RecordDtype(),
+                                count=self.capacity, offset=HEADER_SIZE)
+        first = self._tail % self.capacity
+        end = first + len(self)
+        if end <= self.capacity:
+            return [records[first:end]]
+        return [records[first:], records[:end - self.capacity]]
+
+    def Query(self, start=None, end=None):
+        """Returns the records with start <= timestamp < end, oldest first.
+
+        Relies on the timestamps being sorted, which Append() ensures.
+
+        A view on the mapping unless the range wraps around the end of the
+        ring, in which case the two parts are copied into one array.
+        """
+        import numpy as np
+        parts = []
+        for segment in self.GetSegments():
+            timestamps = segment['timestamp']
+            lo = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+            hi = len(segment) if end is None else np.searchsorted(timestamps, end, 'left')
+            if hi > lo:
+                parts.append(segment[lo:hi])
+        if not parts:
+            return np.empty(0, dtype=RecordDtype())
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def Flush(self):
+        """Forces the mapping to disk, normally left to the kernel's writeback."""
+        self._map.flush()
+
+    def Close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
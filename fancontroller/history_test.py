@@ -0,0 +1,162 @@
+'''
+Tests for the memory-mapped measurement history.
+'''
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.history import HistoryStore, HEADER_SIZE
+from fancontroller.runtime import Runtime
+from fancontroller.sensors import SensorBatch
+from fancontroller.zones import Zone
+from fancontroller import Thermostat
+
+
+def _Append(store, t):
+    store.Append(t, 20.0 + t, 10.0, 20.5, 10.5, 0.5, 22.5, t % 2, zone=1)
+
+
+class FakeSensorBus(object):
+    def ReadAll(self):
+        return SensorBatch(time.time(), {'indoor_temp': 25, 'outdoor_temp': 10})
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'history.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testAppendAndQuery(self):
+        store = HistoryStore(self.path, capacity=10)
+        for t in range(5):
+            _Append(store, t)
+        self.assertEqual(5, len(store))
+        records = store.Query(1, 3)
+        self.assertEqual([1, 2], records['timestamp'].tolist())
+        self.assertEqual([21, 22], records['indoor'].tolist())
+        self.assertEqual([1, 0], records['state'].tolist())
+        self.assertEqual([1, 1], records['zone'].tolist())
+        # Unwrapped ranges are views on the mapping.
+        self.assertFalse(records.flags.owndata)
+        store.Close()
+
+    def testWrapAround(self):
+        store = HistoryStore(self.path, capacity=4)
+        for t in range(10):
+            _Append(store, t)
+        self.assertEqual(4, len(store))
+        self.assertEqual([6, 7, 8, 9], store.Query()['timestamp'].tolist())
+        self.assertEqual([7, 8], store.Query(7, 9)['timestamp'].tolist())
+        self.assertEqual(0, len(store.Query(100)))
+        store.Close()
+
+    def testTimestampsNeverDecrease(self):
+        store = HistoryStore(self.path, capacity=10)
+        for t in [0, 1, 5, 3, 4, 6]:
+            _Append(store, t)
+        store.Close()
+        store = HistoryStore(self.path)
+        _Append(store, 2)
+        # The clock stepped back after 5, those records keep its timestamp.
+        self.assertEqual([0, 1, 5, 5, 5, 6, 6], store.Query()['timestamp'].tolist())
+        self.assertEqual([1, 5, 5, 5], store.Query(1, 6)['timestamp'].tolist())
+        self.assertEqual([25, 23, 24], store.Query(5, 6)['indoor'].tolist())
+        store.Close()
+
+    def testReopen(self):
+        store = HistoryStore(self.path, capacity=4)
+        for t in range(6):
+            _Append(store, t)
+        store.Close()
+        # The capacity is taken from the file.
+        store = HistoryStore(self.path, capacity=100)
+        self.assertEqual(4, store.capacity)
+        self.assertEqual([2, 3, 4, 5], store.Query()['timestamp'].tolist())
+        store.Close()
+
+    def testTornRecordIsDropped(self):
+        store = HistoryStore(self.path, capacity=10)
+        for t in range(3):
+            _Append(store, t)
+        store.Close()
+        # Corrupt the last record as if it never made it to disk.
+        with open(self.path, 'r+b') as f:
+            f.seek(HEADER_SIZE + 2 * 40 + 8)
+            f.write(struct.pack('<f', 99.0))
+        store = HistoryStore(self.path)
+        self.assertEqual([0, 1], store.Query()['timestamp'].tolist())
+        store.Close()
+
+    def testTornRecordAfterWrapIsDropped(self):
+        store = HistoryStore(self.path, capacity=10)
+        for t in range(1000, 1015):
+            _Append(store, t)
+        store.Close()
+        # The newest record, 1014, sits in slot 4.
+        with open(self.path, 'r+b') as f:
+            f.seek(HEADER_SIZE + 4 * 40 + 8)
+            f.write(struct.pack('<f', 99.0))
+        store = HistoryStore(self.path)
+        self.assertEqual(9, len(store))
+        self.assertEqual(range(1005, 1014), store.Query()['timestamp'].tolist())
+        self.assertEqual(range(1010, 1014), store.Query(start=1010)['timestamp'].tolist())
+        _Append(store, 1014)
+        _Append(store, 1015)
+        store.Close()
+        store = HistoryStore(self.path)
+        self.assertEqual(range(1006, 1016), store.Query()['timestamp'].tolist())
+        store.Close()
+
+    def testReadonly(self):
+        self.assertRaises(IOError, HistoryStore, self.path, readonly=True)
+        self.assertFalse(os.path.exists(self.path))
+        store = HistoryStore(self.path, capacity=10)
+        for t in range(3):
+            _Append(store, t)
+        store.Close()
+        with open(self.path, 'r+b') as f:
+            f.seek(HEADER_SIZE + 2 * 40 + 8)
+            f.write(struct.pack('<f', 99.0))
+        with open(self.path, 'rb') as f:
+            contents = f.read()
+        store = HistoryStore(self.path, readonly=True)
+        self.assertEqual([0, 1], store.Query()['timestamp'].tolist())
+        self.assertRaises(TypeError, _Append, store, 3)
+        store.Close()
+        # The torn record is only dropped by a writer.
+        with open(self.path, 'rb') as f:
+            self.assertEqual(contents, f.read())
+
+    def testNotAHistoryFile(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a history file' * 10)
+        self.assertRaises(ValueError, HistoryStore, self.path)
+
+    def testRuntimeRecordsControlSteps(self):
+        store = HistoryStore(self.path, capacity=10)
+        zone = Zone('default', Thermostat(22.5, 1, 1, 0, 0, gpio=FakeFanGpio()),
+                    'indoor_temp', 'outdoor_temp')
+        runtime = Runtime([zone], FakeSensorBus(), history=store)
+        runtime._ReadSensors()
+        runtime._Control()
+        records = store.Query()
+        self.assertEqual(1, len(records))
+        self.assertEqual(25, records['indoor'][0])
+        self.assertEqual(10, records['outdoor_median'][0])
+        self.assertEqual(1, records['state'][0])
+        self.assertTrue(np.isfinite(records['pid'][0]))
+        store.Close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+'''
+Hot path timing and counters, served in the Prometheus text format.
+
+Histograms have fixed bucket bounds so an observation is one bisect and two
+additions. Counters that already exist elsewhere (task overruns, sensor
+failures, flapping suppressions) are read through callbacks when the
+metrics are scraped and cost nothing on the hot path.
+
+  curl http://localhost:9105/metrics
+'''
+import bisect
+import logging
+import threading
+
+PORT = 9105
+# Latency bucket bounds in seconds, 10us to 10s.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+STAGE_METRIC = 'fancontroller_stage_seconds'
+STAGES = ['sensor_read', 'filter_update', 'control', 'gpio_write', 'upload']
+
+
+def _FormatLabels(labels, extra=None):
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in items)
+
+
+class Histogram(object):
+    """Counts of observations per fixed bucket."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One count per bound plus +Inf.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    """Named histograms and callback counters / gauges, rendered for Prometheus."""
+
+    def __init__(self):
+        # name -> (type, help, [(labels, histogram or callback)])
+        self._metrics = {}
+        self._order = []
+
+    def _Add(self, name, metric_type, help_text, labels, value):
+        if name not in self._metrics:
+            self._metrics[name] = (metric_type, help_text, [])
+            self._order.append(name)
+        elif self._metrics[name][0] != metric_type:
+            raise ValueError('%s is a %s' % (name, self._metrics[name][0]))
+        self._metrics[name][2].append((labels or {}, value))
+        return value
+
+    def AddHistogram(self, name, help_text, labels=None, bounds=LATENCY_BUCKETS):
+        return self._Add(name, 'histogram', help_text, labels, Histogram(bounds))
+
+    def AddCounter(self, name, help_text, fn, labels=None):
+        """fn is called on every scrape and returns the counter's total."""
+        self._Add(name, 'counter', help_text, labels, fn)
+
+    def AddGauge(self, name, help_text, fn, labels=None):
+        self._Add(name, 'gauge', help_text, labels, fn)
+
+    def Render(self):
+        lines = []
+        for name in self._order:
+            metric_type, help_text, series = self._metrics[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in series:
+                if metric_type != 'histogram':
+                    try:
+                        lines.append('%s%s %r' % (name, _FormatLabels(labels), float(value())))
+                    except Exception as e:
+                        logging.warn('Failed to read metric %s: %s', name, e)
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.bounds + ('+Inf',), value.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, _FormatLabels(labels, ('le', bound)), cumulative))
+                lines.append('%s_sum%s %r' % (name, _FormatLabels(labels), value.sum))
+                lines.append('%s_count%s %d' % (name, _FormatLabels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+class Instruments(object):
+    """The per stage latency histograms of a control cycle.
+
+    Attributes are Histograms named after STAGES, observe seconds into them.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        for stage in STAGES:
+            setattr(self, stage, registry.AddHistogram(
+                STAGE_METRIC, 'Latency of control cycle stages.',
+                labels={'stage': stage}))
+
+
+def _ServerClasses():
+    # BaseHTTPServer is only imported once the server is started.
+    import BaseHTTPServer
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.registry.Render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return BaseHTTPServer.HTTPServer, MetricsHandler
+
+
+class MetricsServer(object):
+    """Serves registry on http://host:port/metrics from a background thread."""
+
+    def __init__(self, registry, host='localhost', port=PORT):
+        server_class, handler_class = _ServerClasses()
+        self._server = server_class((host, port), handler_class)
+        self._server.registry = registry
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics')
+        self._thread.daemon = True
+
+    def Start(self):
+        self._thread.start()
+
+    def Stop(self):
+        self._server.shutdown()
+        self._server.server_close()
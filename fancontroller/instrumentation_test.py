@@ -0,0 +1,96 @@
+'''
+Tests for the hot path instrumentation and the metrics endpoint.
+'''
+import time
+import unittest
+import urllib2
+
+from fancontroller import Thermostat
+from fancontroller.fan_gpio import FakeBackend, FanGpio
+from fancontroller.instrumentation import Histogram, Instruments, MetricsServer, Registry
+from fancontroller.runtime import Runtime
+from fancontroller.sensors import SensorBatch
+from fancontroller.zones import Zone
+
+
+class FakeSensorBus(object):
+    def __init__(self):
+        self.failures = 0
+
+    def ReadAll(self):
+        return SensorBatch(time.time(), {'indoor_temp': 25, 'outdoor_temp': 10})
+
+    def GetFailureCount(self):
+        return self.failures
+
+
+class HistogramTest(unittest.TestCase):
+
+    def testBuckets(self):
+        histogram = Histogram(bounds=(1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.Observe(value)
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(6, histogram.sum)
+
+    def testRender(self):
+        registry = Registry()
+        histogram = registry.AddHistogram('latency_seconds', 'Latency.',
+                                          labels={'stage': 'read'}, bounds=(1, 2))
+        histogram.Observe(1.5)
+        registry.AddCounter('errors_total', 'Errors.', lambda: 3)
+        self.assertEqual('\n'.join([
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{stage="read",le="1"} 0',
+            'latency_seconds_bucket{stage="read",le="2"} 1',
+            'latency_seconds_bucket{stage="read",le="+Inf"} 1',
+            'latency_seconds_sum{stage="read"} 1.5',
+            'latency_seconds_count{stage="read"} 1',
+            '# HELP errors_total Errors.',
+            '# TYPE errors_total counter',
+            'errors_total 3.0',
+            '']), registry.Render())
+
+
+class InstrumentedRuntimeTest(unittest.TestCase):
+
+    def testStagesAndCounters(self):
+        registry = Registry()
+        sensors = FakeSensorBus()
+        sensors.failures = 2
+        backend = FakeBackend()
+        thermostat = Thermostat(22.5, 1, 1, 0, 0, gpio=FanGpio(17, backend=backend))
+        runtime = Runtime([Zone('default', thermostat, 'indoor_temp', 'outdoor_temp')],
+                          sensors, instruments=Instruments(registry), gpio=backend)
+        runtime._ReadSensors()
+        runtime._Control()
+        # The fan was just turned on, turning it off again is suppressed.
+        sensors.ReadAll = lambda: SensorBatch(time.time(), {'indoor_temp': 15,
+                                                            'outdoor_temp': 10})
+        runtime._ReadSensors()
+        runtime._Control()
+        text = registry.Render()
+        self.assertIn('fancontroller_stage_seconds_count{stage="sensor_read"} 2', text)
+        self.assertIn('fancontroller_stage_seconds_count{stage="control"} 2', text)
+        self.assertIn('fancontroller_stage_seconds_count{stage="gpio_write"} 1', text)
+        self.assertIn('fancontroller_flapping_suppressed_total{zone="default"} 1.0', text)
+        self.assertIn('fancontroller_sensor_failures_total 2.0', text)
+        self.assertIn('fancontroller_task_overruns_total{task="control"} 0.0', text)
+
+    def testServer(self):
+        registry = Registry()
+        registry.AddCounter('errors_total', 'Errors.', lambda: 1)
+        server = MetricsServer(registry, port=0)
+        server.Start()
+        try:
+            base = 'http://localhost:%d' % server.port
+            self.assertIn('errors_total 1.0', urllib2.urlopen(base + '/metrics').read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, base + '/other')
+        finally:
+            server.Stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+'''
+Buffered, batched metrics uploader.
+
+Upload() only queues the sample. A background thread sends the queued
+samples to the thingspeak bulk update API in batches over one reused
+keep-alive connection, retrying with exponential backoff. While the network
+is down samples accumulate in a bounded in-memory buffer; when it fills up
+the buffer is appended to a disk spool which is drained first once the
+network is back. The spool is only written to when offline, so the SD card
+sees no writes in normal operation. The offset of the first unsent spool
+record is kept in a small file next to the spool, so a restart resumes
+draining the spool where it stopped instead of sending it all again.
+
+Connection errors, 5xx and 429 responses are retried; any other rejected
+batch would be rejected again, so it is dropped and counted.
+'''
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Sample fields in the order they are spooled, with their thingspeak field.
+FIELDS = [('indoor_temp', 'field1'),
+          ('outdoor_temp', 'field2'),
+          ('pid', 'field3'),
+          ('target_temp', 'field4')]
+
+
+def _FormatRecord(timestamp, measurements):
+    values = [repr(float(timestamp))]
+    for name, _ in FIELDS:
+        value = measurements.get(name)
+        values.append('' if value is None else repr(float(value)))
+    values.append(measurements.get('zone', ''))
+    return ','.join(values) + '\n'
+
+
+def _ParseRecord(line):
+    values = line.rstrip('\n').split(',')
+    if len(values) != len(FIELDS) + 2:
+        raise ValueError('expected %d values' % (len(FIELDS) + 2))
+    measurements = {}
+    for (name, _), value in zip(FIELDS, values[1:]):
+        measurements[name] = float(value) if value else None
+    if values[-1]:
+        measurements['zone'] = values[-1]
+    return float(values[0]), measurements
+
+
+class UploaderStats(object):
+    def __init__(self):
+        self.queued = 0
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def __str__(self):
+        return ('queued: %d sent: %d batches: %d failures: %d spilled: %d '
+                'dropped: %d rejected: %d' % (self.queued, self.sent, self.batches,
+                                              self.failures, self.spilled, self.dropped,
+                                              self.rejected))
+
+
+class BatchingUploader(object):
+    """Drop-in replacement for MetricsUploader that never blocks the caller.
+
+    Queued samples are sent every flush_period seconds, or as soon as a full
+    batch of batch_size is queued.
+    """
+    # https://thingspeak.com/channels/43590
+    _HOST = 'api.thingspeak.com:80'
+    _CHANNEL = 43590
+    _KEY = '102HUIUCF7VYDM1K'
+
+    def __init__(self, host=_HOST, channel=_CHANNEL, key=_KEY,
+                 spool_path=None, buffer_size=1000, batch_size=100,
+                 flush_period=60, timeout=10, min_backoff=1, max_backoff=600):
+        self._host = host
+        self._path = '/channels/%s/bulk_update.json' % channel
+        self._key = key
+        self._spool_path = spool_path
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._flush_period = flush_period
+        self._timeout = timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._backoff = 0
+        self._retry_time = 0
+        self._buffer = deque()
+        # Bumped on every spill, tells _FlushBuffer its batch moved to the spool.
+        self._spills = 0
+        # Byte offset of the first unsent record in the spool.
+        self._spool_offset = self._LoadSpoolOffset()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.stats = UploaderStats()
+
+    def _GetOffsetPath(self):
+        return self._spool_path + '.offset'
+
+    def _LoadSpoolOffset(self):
+        if not self._spool_path or not os.path.exists(self._spool_path):
+            return 0
+        try:
+            with open(self._GetOffsetPath()) as f:
+                offset = int(f.read())
+        except (IOError, ValueError):
+            return 0
+        return offset if offset <= os.path.getsize(self._spool_path) else 0
+
+    def _SaveSpoolOffset(self, offset):
+        path = self._GetOffsetPath()
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d\n' % offset)
+        os.rename(path + '.tmp', path)
+        self._spool_offset = offset
+
+    def SetFlushPeriod(self, flush_period):
+        """Changes the flush period, from the next wait on."""
+        self._flush_period = flush_period
+
+    def Upload(self, measurements, timestamp=None):
+        """Queues one GetMeasurements() sample, taken at timestamp or now."""
+        with self._lock:
+            if len(self._buffer) >= self._buffer_size:
+                if self._spool_path:
+                    self._Spill()
+                else:
+                    self._buffer.popleft()
+                    self.stats.dropped += 1
+            self._buffer.append((time.time() if timestamp is None else timestamp,
+                                 measurements))
+            self.stats.queued += 1
+            if len(self._buffer) >= self._batch_size:
+                self._wakeup.set()
+
+    def _Spill(self):
+        """Appends the whole buffer to the spool. Called with the lock held."""
+        with open(self._spool_path, 'a') as spool:
+            spool.write(''.join(_FormatRecord(ts, m) for ts, m in self._buffer))
+        self.stats.spilled += len(self._buffer)
+        self._buffer.clear()
+        self._spills += 1
+
+    def Flush(self):
+        """Sends everything that is spooled or buffered.
+
+        Returns False if a batch failed, the rest is kept for the next try.
+        """
+        if time.time() < self._retry_time:
+            return False
+        ok = self._FlushSpool() and self._FlushBuffer()
+        if ok:
+            self._backoff = 0
+        else:
+            self._backoff = min(self._max_backoff,
+                                max(self._min_backoff, self._backoff * 2))
+            self._retry_time = time.time() + self._backoff
+            logging.warn('Metrics upload failed, retrying in %ds', self._backoff)
+        return ok
+
+    def _FlushSpool(self):
+        if not self._spool_path or not os.path.exists(self._spool_path):
+            return True
+        while True:
+            with self._lock:
+                # Only whole spills are read, Upload() appends under the lock.
+                size = os.path.getsize(self._spool_path)
+                if size <= self._spool_offset:
+                    # Without the offset a crash in between resends the
+                    # spool, with it a new spool could be skipped.
+                    if os.path.exists(self._GetOffsetPath()):
+                        os.remove(self._GetOffsetPath())
+                    os.remove(self._spool_path)
+                    self._spool_offset = 0
+                    return True
+            with open(self._spool_path, 'r') as spool:
+                spool.seek(self._spool_offset)
+                lines = []
+                while len(lines) < self._batch_size and spool.tell() < size:
+                    line = spool.readline()
+                    if not line:
+                        break
+                    lines.append(line)
+                offset = spool.tell()
+            batch = []
+            for line in lines:
+                try:
+                    batch.append(_ParseRecord(line))
+                except ValueError:
+                    # A record cut short by a crash or power loss.
+                    logging.warn('Skipping corrupt spool record: %r', line)
+            if batch and not self._Send(batch):
+                return False
+            self._SaveSpoolOffset(offset)
+
+    def _FlushBuffer(self):
+        while True:
+            with self._lock:
+                batch = [self._buffer[i] for i in
+                         range(min(self._batch_size, len(self._buffer)))]
+                spills = self._spills
+            if not batch:
+                return True
+            if not self._Send(batch):
+                return False
+            with self._lock:
+                # If Upload() spilled the buffer meanwhile the batch is in the
+                # spool now and is sent again from there.
+                if spills == self._spills:
+                    for _ in batch:
+                        self._buffer.popleft()
+
+    def _Send(self, batch):
+        updates = []
+        for timestamp, measurements in batch:
+            update = {'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                  time.gmtime(timestamp))}
+            for name, field in FIELDS:
+                if measurements.get(name) is not None:
+                    update[field] = measurements[name]
+            if 'zone' in measurements:
+                # Multi zone controllers tag every update with its zone.
+                update['status'] = measurements['zone']
+            updates.append(update)
+        # Imported on first use to keep them out of the controller's startup.
+        import httplib
+        import json
+        body = json.dumps({'write_api_key': self._key, 'updates': updates})
+        headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+        try:
+            if self._conn is None:
+                self._conn = httplib.HTTPConnection(self._host, timeout=self._timeout)
+            self._conn.request('POST', self._path, body, headers)
+            response = self._conn.getresponse()
+            # Read the body so the connection can be reused.
+            response.read()
+            logging.debug('Thingspeak Response: %s %s', response.status, response.reason)
+            if response.will_close:
+                self._Disconnect()
+            if response.status >= 500 or response.status == 429:
+                self.stats.failures += 1
+                return False
+            if not 200 <= response.status < 300:
+                # Sending it again would get the same answer.
+                logging.warn('Metrics upload of %d samples rejected: %s %s',
+                             len(batch), response.status, response.reason)
+                self.stats.rejected += len(batch)
+                return True
+        except (httplib.HTTPException, IOError) as e:
+            logging.warn('Metrics upload error: %s', e)
+            self.stats.failures += 1
+            self._Disconnect()
+            return False
+        self.stats.sent += len(batch)
+        self.stats.batches += 1
+        return True
+
+    def _Disconnect(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _Run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(max(self._flush_period, self._retry_time - time.time()))
+            self._wakeup.clear()
+            try:
+                self.Flush()
+            except Exception:
+                logging.exception('Metrics upload failed')
+
+    def Start(self):
+        self._thread = threading.Thread(target=self._Run, name='uploader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def Stop(self):
+        """Stops the background thread and spools whatever was not sent."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            # A send in progress gives up after the HTTP timeout.
+            self._thread.join(self._timeout)
+            if self._thread.is_alive():
+                logging.warn('Metrics uploader still busy after %ds, not waiting for it',
+                             self._timeout)
+        with self._lock:
+            if self._spool_path and self._buffer:
+                self._Spill()
+        self._Disconnect()
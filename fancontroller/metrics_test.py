@@ -0,0 +1,250 @@
+'''
+Tests for the batching metrics uploader.
+'''
+import BaseHTTPServer
+import json
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+import unittest
+
+from fancontroller.metrics import BatchingUploader
+
+
+class FakeThingspeakHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for the thingspeak bulk update API."""
+    protocol_version = 'HTTP/1.1'
+    status = 202
+    connections = 0
+    updates = []
+    batches = []
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        FakeThingspeakHandler.connections += 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.getheader('content-length'))))
+        if FakeThingspeakHandler.status == 202:
+            FakeThingspeakHandler.batches.append(len(body['updates']))
+            FakeThingspeakHandler.updates.extend(body['updates'])
+        response = '{"success":true}'
+        self.send_response(FakeThingspeakHandler.status)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def _UnusedPort():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class BatchingUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeThingspeakHandler.status = 202
+        FakeThingspeakHandler.connections = 0
+        FakeThingspeakHandler.updates = []
+        FakeThingspeakHandler.batches = []
+        self.server = _Server(('localhost', 0), FakeThingspeakHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.host = 'localhost:%d' % self.server.server_port
+        self.spool = os.path.join(tempfile.mkdtemp(), 'metrics.spool')
+        # After the uploaders' cleanups, which may spool.
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.spool))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def createUploader(self, host=None, **kwargs):
+        uploader = BatchingUploader(host=host or self.host, spool_path=self.spool,
+                                    **kwargs)
+        self.addCleanup(uploader.Stop)
+        return uploader
+
+    def upload(self, uploader, start, count):
+        for i in range(start, start + count):
+            uploader.Upload({'indoor_temp': i, 'outdoor_temp': 10.0,
+                             'pid': 0, 'target_temp': None})
+
+    def assertReceived(self, count):
+        self.assertEqual(range(count),
+                         [int(u['field1']) for u in FakeThingspeakHandler.updates])
+
+    def testBatchesOverOneConnection(self):
+        uploader = self.createUploader(batch_size=100)
+        self.upload(uploader, 0, 250)
+        self.assertTrue(uploader.Flush())
+        self.assertEqual([100, 100, 50], FakeThingspeakHandler.batches)
+        self.assertEqual(1, FakeThingspeakHandler.connections)
+        self.assertReceived(250)
+        self.assertNotIn('field4', FakeThingspeakHandler.updates[0])
+        self.upload(uploader, 250, 10)
+        self.assertTrue(uploader.Flush())
+        self.assertEqual(1, FakeThingspeakHandler.connections)
+        self.assertFalse(os.path.exists(self.spool))
+
+    def testSpoolWhileOffline(self):
+        uploader = self.createUploader(host='localhost:%d' % _UnusedPort(),
+                                       buffer_size=10, batch_size=4)
+        self.upload(uploader, 0, 35)
+        self.assertFalse(uploader.Flush())
+        self.assertEqual(30, uploader.stats.spilled)
+        self.assertEqual(30, len(open(self.spool).readlines()))
+        # Back online.
+        uploader._host = self.host
+        uploader._retry_time = 0
+        self.assertTrue(uploader.Flush())
+        self.assertReceived(35)
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertEqual(0, uploader.stats.dropped)
+
+    def testSpillWhileFlushingSpool(self):
+        uploader = self.createUploader(host='localhost:%d' % _UnusedPort(),
+                                       buffer_size=4, batch_size=3)
+        self.upload(uploader, 0, 12)
+        uploader._host = self.host
+        send = uploader._Send
+
+        def SpillingSend(batch):
+            if not uploader.stats.batches:
+                # The control loop keeps uploading while the spool is sent.
+                self.upload(uploader, 12, 8)
+            return send(batch)
+        uploader._Send = SpillingSend
+        self.assertTrue(uploader.Flush())
+        self.assertReceived(20)
+        self.assertFalse(os.path.exists(self.spool))
+
+    def testBackoff(self):
+        FakeThingspeakHandler.status = 503
+        uploader = self.createUploader(min_backoff=1, max_backoff=4)
+        self.upload(uploader, 0, 5)
+        self.assertFalse(uploader.Flush())
+        self.assertEqual(1, uploader._backoff)
+        # Within the backoff nothing is sent.
+        failures = uploader.stats.failures
+        self.assertFalse(uploader.Flush())
+        self.assertEqual(failures, uploader.stats.failures)
+        for backoff in [2, 4, 4]:
+            uploader._retry_time = 0
+            self.assertFalse(uploader.Flush())
+            self.assertEqual(backoff, uploader._backoff)
+        FakeThingspeakHandler.status = 202
+        uploader._retry_time = 0
+        self.assertTrue(uploader.Flush())
+        self.assertEqual(0, uploader._backoff)
+        self.assertReceived(5)
+
+    def testRejectedBatchIsDropped(self):
+        FakeThingspeakHandler.status = 400
+        uploader = self.createUploader(batch_size=4)
+        self.upload(uploader, 0, 10)
+        self.assertTrue(uploader.Flush())
+        self.assertEqual(10, uploader.stats.rejected)
+        self.assertEqual(0, uploader.stats.failures)
+        self.assertEqual(0, uploader._backoff)
+        FakeThingspeakHandler.status = 429
+        self.upload(uploader, 10, 1)
+        self.assertFalse(uploader.Flush())
+        self.assertEqual(1, uploader.stats.failures)
+
+    def testRestartResumesSpool(self):
+        uploader = self.createUploader(host='localhost:%d' % _UnusedPort(),
+                                       buffer_size=10, batch_size=4)
+        self.upload(uploader, 0, 20)
+        uploader.Stop()
+        self.assertEqual(20, len(open(self.spool).readlines()))
+        # The controller dies after 8 of the spooled samples were sent.
+        FakeThingspeakHandler.status = 503
+        partial = self.createUploader(batch_size=4)
+        sent = []
+        send = partial._Send
+
+        def SendTwice(batch):
+            if len(sent) == 2:
+                return False
+            sent.append(batch)
+            FakeThingspeakHandler.status = 202
+            return send(batch)
+        partial._Send = SendTwice
+        self.assertFalse(partial.Flush())
+        self.assertReceived(8)
+        restarted = self.createUploader(batch_size=4)
+        self.assertTrue(restarted.Flush())
+        self.assertReceived(20)
+        self.assertFalse(os.path.exists(self.spool))
+        self.assertFalse(os.path.exists(self.spool + '.offset'))
+
+    def testThreadSurvivesErrorsAndSendsFullBatches(self):
+        uploader = self.createUploader(batch_size=5, flush_period=3600)
+        flushes = []
+        flush = uploader.Flush
+
+        def FailingFlush():
+            flushes.append(1)
+            if len(flushes) == 1:
+                raise OSError('spool vanished')
+            return flush()
+        uploader.Flush = FailingFlush
+        uploader.Start()
+        self.upload(uploader, 0, 5)
+        end = time.time() + 5
+        while len(flushes) < 1 and time.time() < end:
+            time.sleep(0.01)
+        # A full batch wakes the thread up long before flush_period.
+        self.upload(uploader, 5, 5)
+        while len(FakeThingspeakHandler.updates) < 10 and time.time() < end:
+            time.sleep(0.01)
+        self.assertReceived(10)
+
+    def testStopSpoolsUnsent(self):
+        uploader = self.createUploader(host='localhost:%d' % _UnusedPort())
+        self.upload(uploader, 0, 7)
+        uploader.Stop()
+        self.assertEqual(7, len(open(self.spool).readlines()))
+        restarted = self.createUploader()
+        self.assertTrue(restarted.Flush())
+        self.assertReceived(7)
+
+
+    def testStopDoesNotWaitForAHungSend(self):
+        uploader = self.createUploader(batch_size=5, timeout=0.1)
+        sending = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def HungSend(batch):
+            sending.set()
+            release.wait(5)
+            return False
+        uploader._Send = HungSend
+        uploader.Start()
+        self.upload(uploader, 0, 7)
+        self.assertTrue(sending.wait(5))
+        start = time.time()
+        uploader.Stop()
+        self.assertLess(time.time() - start, 1)
+        # The samples of the hung batch are still buffered and spooled.
+        self.assertEqual(7, len(open(self.spool).readlines()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,264 @@
+'''
+Forecast driven pre-cooling plans.
+
+The Thermostat only reacts to the current outside temperature. On a cool
+night before a hot day it stops once the house reached target_temp, and the
+next afternoon the house heats up while the air outside is too warm to
+help. The Planner looks ahead 24 hours: it simulates a ThermalModel of the
+house against the forecast for a few hundred candidate schedules at once,
+each lowering the target by an offset over a window of hours, and keeps the
+cheapest one. The resulting Plan maps time to a target in O(1), the
+Thermostat uses it instead of target_temp when it is lower.
+
+ThermalModel.Fit() estimates the model from the history store, per hour:
+
+  d indoor / dt = leak * (outdoor - indoor) + gain + fan * on * (outdoor - indoor)
+
+The plan is recomputed when a new forecast arrives, every REPLAN_PERIOD and
+when the measured indoor temperature drifts more than drift from the plan's
+prediction.
+'''
+import logging
+
+import numpy as np
+
+# Resolution of plans, in seconds.
+PLAN_STEP = 600
+HORIZON = 24 * 3600
+REPLAN_PERIOD = 3600
+# Degrees the measured indoor temperature may differ from the plan.
+DRIFT = 1.0
+# Largest target reduction considered, in degrees.
+MAX_OFFSET = 3.0
+OFFSET_STEP = 0.5
+# Lengths of the pre-cooling windows considered, in hours.
+WINDOW_HOURS = (2, 4, 6, 8, 12)
+# Cost per degree hour above the comfort band, per hour of fan time and per
+# degree hour below target_temp.
+DISCOMFORT_WEIGHT = 1.0
+FAN_WEIGHT = 0.05
+UNDERCOOL_WEIGHT = 0.1
+# Records are resampled to this interval for the fit, in seconds.
+FIT_STEP = 600
+MIN_FIT_SAMPLES = 36
+
+
+class ThermalModel(object):
+    """First order thermal model of the house, rates per hour."""
+
+    def __init__(self, leak=0.1, gain=0.3, fan=0.8):
+        self.leak = leak
+        self.gain = gain
+        self.fan = fan
+
+    def Rate(self, indoor, outdoor, on):
+        """Returns d indoor / dt in degrees per hour, element-wise."""
+        diff = outdoor - indoor
+        return self.leak * diff + self.gain + self.fan * on * diff
+
+    @staticmethod
+    def Fit(records, zone=0, pwm=False):
+        """Fits a model to fancontroller.history records of zone.
+
+        The fan term is per unit of fan speed, the pid output, with pwm and
+        on/off otherwise. Returns None if there are not enough usable samples
+        or the fit is not physical (the fan or the walls heating the house
+        when it is warmer inside).
+        """
+        resampled = ResampleForFit(records, zone, pwm)
+        if resampled is None:
+            return None
+        return ThermalModel.FitResampled(*resampled)
+
+    @staticmethod
+    def FitResampled(times, indoor, outdoor, speed):
+        """Fits a model to the arrays returned by ResampleForFit(), see Fit()."""
+        diff, speed, rate = FitSamples(times, indoor, outdoor, speed)
+        if len(rate) < MIN_FIT_SAMPLES:
+            return None
+        x = np.column_stack([diff, np.ones(len(diff)), speed * diff])
+        (leak, gain, fan), _, rank, _ = np.linalg.lstsq(x, rate, rcond=None)
+        if rank < 3 or leak < 0 or fan < 0:
+            return None
+        return ThermalModel(leak, gain, fan)
+
+
+def ResampleForFit(records, zone=0, pwm=False):
+    """Returns (times, indoor, outdoor, fan speed) of zone's records in every FIT_STEP.
+
+    The temperatures are the first of each bin, the speed the mean over the
+    bin as the fan may switch within it: the pid output with pwm, the fan
+    state otherwise. None if fewer than 2 records have both temperatures.
+    """
+    records = records[records['zone'] == zone]
+    ok = (np.isfinite(records['indoor_median']) &
+          np.isfinite(records['outdoor_median']))
+    records = records[ok]
+    if len(records) < 2:
+        return None
+    times = records['timestamp']
+    bins = np.floor(times / FIT_STEP)
+    first = np.concatenate([[True], bins[1:] != bins[:-1]])
+    starts = np.flatnonzero(first)
+    speed = (records['pid'] if pwm else records['state']).astype(float)
+    speed = np.add.reduceat(speed, starts) / np.diff(np.append(starts, len(speed)))
+    return (times[first], records['indoor_median'][first].astype(float),
+            records['outdoor_median'][first].astype(float), speed)
+
+
+def FitSamples(times, indoor, outdoor, speed):
+    """Returns (outdoor - indoor, fan speed, indoor rate) of the intervals between consecutive bins.
+
+    The difference is the mean of both ends of the interval: the indoor
+    temperature moves towards the outdoor one within a bin, its start
+    alone underestimates the rates' dependency on it.
+    """
+    dt, ok = Intervals(times)
+    diff = outdoor - indoor
+    return ((diff[:-1] + diff[1:])[ok] / 2.0, speed[:-1][ok], (np.diff(indoor) / dt)[ok])
+
+
+def Intervals(times):
+    """Returns the hours between consecutive times and which of them are one FIT_STEP apart.
+
+    A gap in the records is not one interval, its hours are set to 1 to
+    keep divisions finite.
+    """
+    dt = np.diff(times) / 3600.0
+    ok = (dt > 0) & (dt <= 1.5 * FIT_STEP / 3600.0)
+    return np.where(ok, dt, 1.0), ok
+
+
+class Plan(object):
+    """Targets and predicted indoor temperatures every PLAN_STEP seconds from start."""
+
+    def __init__(self, start, targets, indoor, offset=0.0, window=None):
+        self.start = start
+        self.targets = targets
+        self.indoor = indoor
+        self.offset = offset
+        # (first hour, last hour + 1) of the pre-cooling, None without one.
+        self.window = window
+
+    def _Index(self, now):
+        i = int((now - self.start) // PLAN_STEP)
+        if 0 <= i < len(self.targets):
+            return i
+        return None
+
+    def GetTarget(self, now):
+        """The planned target at now, None outside of the plan."""
+        i = self._Index(now)
+        return None if i is None else self.targets[i]
+
+    def GetIndoor(self, now):
+        """The predicted indoor temperature at now, None outside of the plan."""
+        i = self._Index(now)
+        return None if i is None else self.indoor[i]
+
+
+class Planner(object):
+    """Keeps a pre-cooling Plan for one zone up to date, see the module doc."""
+
+    def __init__(self, target_temp, hysteresis, min_outside_diff, model=None,
+                 horizon=HORIZON, max_offset=MAX_OFFSET, drift=DRIFT):
+        self.model = model or ThermalModel()
+        self._steps = int(horizon // PLAN_STEP)
+        self._max_offset = max_offset
+        self._drift = drift
+        self.plan = None
+        self.replans = 0
+        self._index = None
+        self.SetTargets(target_temp, hysteresis, min_outside_diff)
+        self._BuildCandidates()
+
+    def SetTargets(self, target_temp, hysteresis, min_outside_diff):
+        """Changes the thermostat settings planned for, the next Update() re-plans."""
+        self._target_temp = target_temp
+        self._hysteresis = hysteresis
+        self._min_outside_diff = min_outside_diff
+        self.plan = None
+
+    def _BuildCandidates(self):
+        # The candidate target reductions, (candidates, steps), only depend
+        # on the horizon: build them once.
+        offsets = np.arange(OFFSET_STEP, self._max_offset + OFFSET_STEP / 2, OFFSET_STEP)
+        steps_per_hour = 3600 // PLAN_STEP
+        hours = self._steps // steps_per_hour
+        grid = [(0.0, 0, 0)]
+        for offset in offsets:
+            for length in WINDOW_HOURS:
+                for first in range(0, hours - length + 1):
+                    grid.append((offset, first, first + length))
+        grid = np.array(grid)
+        hour = np.arange(self._steps) // steps_per_hour
+        in_window = ((hour[np.newaxis, :] >= grid[:, 1:2]) &
+                     (hour[np.newaxis, :] < grid[:, 2:3]))
+        self._candidates = grid
+        self._reductions = in_window * grid[:, 0:1]
+
+    def _Simulate(self, indoor, outdoor):
+        """Simulates all candidates, returns (indoor, fan on), each (candidates, steps)."""
+        n, steps = self._reductions.shape
+        targets = self._target_temp - self._reductions
+        half_hysteresis = self._hysteresis / 2.0
+        dt = PLAN_STEP / 3600.0
+        model = self.model
+        temps = np.empty((n, steps))
+        fans = np.empty((n, steps))
+        t = np.full(n, float(indoor))
+        on = np.zeros(n)
+        for i in range(steps):
+            temps[:, i] = t
+            # Thermostat._RecomputeState: never cool below the outside air.
+            target = np.maximum(targets[:, i], outdoor[i] + self._min_outside_diff)
+            on = np.where(on > 0, t > target - half_hysteresis,
+                          t > target + half_hysteresis).astype(float)
+            fans[:, i] = on
+            t = t + dt * model.Rate(t, outdoor[i], on)
+        return temps, fans
+
+    def Plan(self, now, indoor, index):
+        """Returns the cheapest Plan from now for the forecast index, None without a forecast."""
+        start = now - now % PLAN_STEP
+        hourly = index.GetHourlySeries(start, self._steps // (3600 // PLAN_STEP) + 1)
+        if not hourly:
+            return None
+        outdoor = np.interp(start + PLAN_STEP * np.arange(self._steps),
+                            start + 3600.0 * np.arange(len(hourly)), hourly)
+        temps, fans = self._Simulate(indoor, outdoor)
+        dt = PLAN_STEP / 3600.0
+        comfort = self._target_temp + self._hysteresis / 2.0
+        cost = (DISCOMFORT_WEIGHT * np.maximum(0, temps - comfort).sum(axis=1) +
+                FAN_WEIGHT * fans.sum(axis=1) +
+                UNDERCOOL_WEIGHT * np.maximum(0, self._target_temp - temps).sum(axis=1)) * dt
+        best = int(np.argmin(cost))
+        offset, first, end = self._candidates[best]
+        window = (int(first), int(end)) if offset else None
+        return Plan(start, (self._target_temp - self._reductions[best]).tolist(),
+                    temps[best].tolist(), offset, window)
+
+    def Update(self, now, indoor, index):
+        """Re-plans if needed, returns the current Plan (None if there is none).
+
+        index is a fancontroller.forecast.ForecastIndex, a new object counts as
+        a new forecast.
+        """
+        if index is None or indoor is None:
+            return self.plan
+        plan = self.plan
+        if index is not self._index:
+            reason = 'new forecast'
+        elif plan is None or now - plan.start >= REPLAN_PERIOD:
+            reason = 'plan expired'
+        elif abs(plan.GetIndoor(now) - indoor) > self._drift:
+            reason = 'indoor %.1f drifted from %.1f' % (indoor, plan.GetIndoor(now))
+        else:
+            return plan
+        self._index = index
+        self.plan = self.Plan(now, indoor, index)
+        self.replans += 1
+        if self.plan is not None:
+            logging.info('re-planned (%s): pre-cool by %.1f in hours %s',
+                         reason, self.plan.offset, self.plan.window)
+        return self.plan
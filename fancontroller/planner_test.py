@@ -0,0 +1,119 @@
+'''
+Tests for the forecast driven planner.
+'''
+import unittest
+
+import numpy as np
+
+from fancontroller import Thermostat, STATE_ON
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.forecast import ForecastIndex
+from fancontroller.history import RecordDtype
+from fancontroller.planner import Planner, Plan, ThermalModel
+
+# Midnight UTC.
+START = 1435104000.0
+
+
+def _Forecast(night=12.0, day=32.0):
+    # Lows at 5am, highs at 3pm.
+    extremes = []
+    for day_offset in range(3):
+        extremes.append((START + day_offset * 86400 + 5 * 3600, night))
+        extremes.append((START + day_offset * 86400 + 15 * 3600, day))
+    return ForecastIndex(None, [], extremes)
+
+
+class ThermalModelTest(unittest.TestCase):
+
+    def testFitRecoversModel(self):
+        model = ThermalModel(leak=0.08, gain=0.4, fan=1.2)
+        step = 60.0
+        n = 3 * 24 * 60
+        times = START + step * np.arange(n)
+        outdoor = 20 + 8 * np.sin(2 * np.pi * np.arange(n) / (24 * 60.0))
+        records = np.zeros(n, dtype=RecordDtype())
+        indoor = 24.0
+        state = 0
+        for i in range(n):
+            # The fan runs in 2 hour blocks, every other block.
+            state = (i // 120) % 2
+            records[i]['indoor_median'] = indoor
+            records[i]['outdoor_median'] = outdoor[i]
+            records[i]['state'] = state
+            indoor += step / 3600.0 * model.Rate(indoor, outdoor[i], state)
+        records['timestamp'] = times
+        fitted = ThermalModel.Fit(records)
+        self.assertAlmostEqual(model.leak, fitted.leak, delta=0.02)
+        self.assertAlmostEqual(model.gain, fitted.gain, delta=0.05)
+        self.assertAlmostEqual(model.fan, fitted.fan, delta=0.1)
+        # Other zones and too little data give no model.
+        self.assertIsNone(ThermalModel.Fit(records, zone=1))
+        self.assertIsNone(ThermalModel.Fit(records[:100]))
+
+
+class PlannerTest(unittest.TestCase):
+
+    def testPreCoolsBeforeHotDay(self):
+        # A well insulated house that does not cool down by itself at night.
+        model = ThermalModel(leak=0.03, gain=0.4, fan=1.0)
+        planner = Planner(22.5, 0.5, 0.5, model=model)
+        plan = planner.Update(START, 23.0, _Forecast())
+        self.assertIsNotNone(plan)
+        self.assertGreater(plan.offset, 0)
+        first, end = plan.window
+        # Pre-cooling happens while it is cool outside, before the afternoon.
+        self.assertLess(end, 15)
+        self.assertEqual(22.5 - plan.offset, plan.GetTarget(START + first * 3600))
+        self.assertEqual(22.5, plan.GetTarget(START + 16 * 3600))
+        # And keeps the afternoon cooler than just following target_temp.
+        baseline = Planner(22.5, 0.5, 0.5, model=model, max_offset=0).Update(
+            START, 23.0, _Forecast())
+        self.assertEqual(0, baseline.offset)
+        self.assertLess(max(plan.indoor) + 1, max(baseline.indoor))
+
+    def testNoPreCoolingOnMildDays(self):
+        plan = Planner(22.5, 0.5, 0.5).Update(START, 22.5, _Forecast(night=15, day=20))
+        self.assertEqual(0, plan.offset)
+        self.assertEqual(set([22.5]), set(plan.targets))
+
+    def testReplans(self):
+        planner = Planner(22.5, 0.5, 0.5)
+        forecast = _Forecast()
+        self.assertIsNone(planner.Update(START, 23.0, None))
+        plan = planner.Update(START, 23.0, forecast)
+        self.assertIs(plan, planner.Update(START + 60, plan.GetIndoor(START + 60), forecast))
+        self.assertEqual(1, planner.replans)
+        # The house is much warmer than predicted.
+        self.assertIsNot(plan, planner.Update(START + 120, plan.GetIndoor(START + 120) + 2,
+                                              forecast))
+        plan = planner.plan
+        # A new forecast.
+        self.assertIsNot(plan, planner.Update(START + 180, plan.GetIndoor(START + 180),
+                                              _Forecast()))
+        self.assertEqual(3, planner.replans)
+        self.assertIsNone(plan.GetTarget(START - 1))
+        self.assertIsNone(plan.GetTarget(START + 2 * 86400))
+
+
+class ThermostatPlanTest(unittest.TestCase):
+
+    def testFollowsLowerPlannedTarget(self):
+        gpio = FakeFanGpio()
+        thermostat = Thermostat(22.5, outside_window=1, inside_window=1, hysteresis=0.5,
+                                min_outside_diff=0.5, gpio=gpio)
+        thermostat._fc._GetTime = lambda: START + 60
+        thermostat.RecordIndoorMeasurement(22.5)
+        thermostat.RecordOutdoorMeasurement(12)
+        self.assertEqual(0, thermostat.ControlLoop())
+        thermostat.SetPlan(Plan(START, [20.5] * 6, [22.5] * 6))
+        self.assertEqual(STATE_ON, thermostat.ControlLoop())
+        # A plan above target_temp is ignored.
+        thermostat.SetPlan(Plan(START, [30] * 6, [22.5] * 6))
+        thermostat.RecordIndoorMeasurement(22.6)
+        thermostat.ControlLoop()
+        self.assertEqual(22.25, thermostat.p.getPoint())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+'''
+Record real sensor traces and replay them through a Thermostat.
+
+RecordingSensorBus wraps the live SensorBus and appends every read to a
+trace file (timestamp, sensor name, temperature; one line per sensor read).
+Replay feeds a trace back into a Thermostat driving a FakeFanGpio, with the
+fan controller's clock following the trace timestamps instead of the wall
+clock, so a week of production data re-runs in seconds and the same trace
+and settings always give the same result.
+
+  python -m fancontroller.replay /var/tmp/fancontroller-trace.csv --target_temp 22
+'''
+import argparse
+import logging
+import sys
+
+from fancontroller.fan_controller import Thermostat
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.sensors import SensorBatch
+
+TRACE_FILE = '/var/tmp/fancontroller-trace.csv'
+# Seconds of reads kept in memory between trace file writes.
+FLUSH_PERIOD = 300
+
+
+class TraceRecorder(object):
+    """Appends sensor batches to a trace file, writing every flush_period seconds."""
+
+    def __init__(self, path, flush_period=FLUSH_PERIOD):
+        self.path = path
+        self._flush_period = flush_period
+        self._lines = []
+        self._last_flush = None
+
+    def Record(self, batch):
+        for name, temp in sorted(batch.values.items()):
+            self._lines.append('%r,%s,%s\n' % (
+                batch.timestamp, name, '' if temp is None else repr(temp)))
+        if self._last_flush is None:
+            self._last_flush = batch.timestamp
+        elif batch.timestamp - self._last_flush >= self._flush_period:
+            self.Flush()
+            self._last_flush = batch.timestamp
+
+    def Flush(self):
+        if not self._lines:
+            return
+        with open(self.path, 'a') as f:
+            f.writelines(self._lines)
+        self._lines = []
+
+
+class RecordingSensorBus(object):
+    """A SensorBus that records every batch it reads."""
+
+    def __init__(self, bus, recorder):
+        self._bus = bus
+        self._recorder = recorder
+
+    def ReadAll(self):
+        batch = self._bus.ReadAll()
+        self._recorder.Record(batch)
+        return batch
+
+    def GetFailureCount(self):
+        return self._bus.GetFailureCount()
+
+    def Close(self):
+        self._recorder.Flush()
+        self._bus.Close()
+
+
+def ReadTrace(lines):
+    """Yields the SensorBatches of a trace, given as an iterable of lines.
+
+    Malformed lines, such as a last line cut short by a power loss, are
+    skipped.
+    """
+    timestamp = None
+    values = {}
+    for line in lines:
+        try:
+            t, name, temp = line.rstrip('\n').split(',')
+            t = float(t)
+            temp = float(temp) if temp else None
+        except ValueError:
+            logging.warn('Skipping malformed trace line %r', line)
+            continue
+        if t != timestamp:
+            if values:
+                yield SensorBatch(timestamp, values)
+            timestamp = t
+            values = {}
+        values[name] = temp
+    if values:
+        yield SensorBatch(timestamp, values)
+
+
+class ReplayClock(object):
+    """Stand-in for the wall clock, set to the time of the batch being replayed."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ReplayResult(object):
+    """Per batch traces of a replay, plain lists in trace order."""
+
+    def __init__(self):
+        self.timestamp = []
+        self.indoor = []
+        self.outdoor = []
+        self.state = []
+        self.pid = []
+        self.target = []
+        self.state_changes = 0
+
+    def GetSummary(self, band=1.0):
+        """Returns a dict of aggregate statistics of the replay.
+
+        band is the width of the acceptable range around the target.
+        """
+        steps = len(self.timestamp)
+        if not steps:
+            return {'steps': 0}
+        hours = (self.timestamp[-1] - self.timestamp[0]) / 3600.0
+        measured = [(indoor, target) for indoor, target in zip(self.indoor, self.target)
+                    if indoor is not None]
+        out_of_band = sum(1 for indoor, target in measured
+                          if abs(indoor - target) > band / 2.0)
+        return {'steps': steps,
+                'hours': hours,
+                'state_changes': self.state_changes,
+                'changes_per_hour': self.state_changes / hours if hours else 0.0,
+                'fan_on': sum(self.state) / float(steps),
+                'out_of_band': out_of_band / float(len(measured)) if measured else 0.0}
+
+
+def Replay(batches, target_temp, indoor_sensor='indoor_temp',
+           outdoor_sensor='outdoor_temp', **thermostat_kwargs):
+    """Runs a Thermostat over batches (an iterable of SensorBatch).
+
+    Every batch is recorded and followed by one ControlLoop, as the sensor
+    and control tasks alternate in the live runtime. Returns a ReplayResult.
+    """
+    gpio = FakeFanGpio()
+    thermostat = Thermostat(target_temp, gpio=gpio, **thermostat_kwargs)
+    clock = ReplayClock()
+    thermostat._fc._GetTime = clock
+    result = ReplayResult()
+    for batch in batches:
+        clock.now = batch.timestamp
+        indoor = batch.Get(indoor_sensor)
+        outdoor = batch.Get(outdoor_sensor)
+        if indoor is not None:
+            thermostat.RecordIndoorMeasurement(indoor)
+        if outdoor is not None:
+            thermostat.RecordOutdoorMeasurement(outdoor)
+        result.timestamp.append(batch.timestamp)
+        result.indoor.append(indoor)
+        result.outdoor.append(outdoor)
+        result.state.append(thermostat.ControlLoop())
+        result.pid.append(thermostat.pid)
+        result.target.append(thermostat.p.getPoint())
+    result.state_changes = thermostat.GetStateChangeCount()
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('trace', nargs='+', help='trace files, replayed in order')
+    parser.add_argument('--target_temp', type=float, default=22.5)
+    parser.add_argument('--hysteresis', type=float, default=Thermostat.HYSTERESIS)
+    parser.add_argument('--min_outside_diff', type=float, default=Thermostat.MIN_OUTSIDE_DIFF)
+    parser.add_argument('--inside_window', type=int, default=1)
+    parser.add_argument('--outside_window', type=int, default=1)
+    parser.add_argument('--kp', type=float, default=Thermostat.PID_GAINS[0])
+    parser.add_argument('--ki', type=float, default=Thermostat.PID_GAINS[1])
+    parser.add_argument('--kd', type=float, default=Thermostat.PID_GAINS[2])
+    parser.add_argument('--indoor_sensor', default='indoor_temp')
+    parser.add_argument('--outdoor_sensor', default='outdoor_temp')
+    parser.add_argument('--band', type=float, default=1.0,
+                        help='width of the acceptable band around the target')
+    args = parser.parse_args(argv)
+
+    def Lines():
+        for path in args.trace:
+            with open(path) as f:
+                for line in f:
+                    yield line
+    result = Replay(ReadTrace(Lines()), args.target_temp,
+                    indoor_sensor=args.indoor_sensor,
+                    outdoor_sensor=args.outdoor_sensor,
+                    outside_window=args.outside_window,
+                    inside_window=args.inside_window,
+                    hysteresis=args.hysteresis,
+                    min_outside_diff=args.min_outside_diff,
+                    pid_gains=(args.kp, args.ki, args.kd))
+    for name, value in sorted(result.GetSummary(args.band).items()):
+        print '%s: %s' % (name, value)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+'''
+Tests for trace recording and replay.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fancontroller.replay import ReadTrace, RecordingSensorBus, Replay, TraceRecorder
+from fancontroller.sensors import SensorBatch
+
+
+class FakeSensorBus(object):
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.closed = False
+
+    def ReadAll(self):
+        return self.batches.pop(0)
+
+    def GetFailureCount(self):
+        return 0
+
+    def Close(self):
+        self.closed = True
+
+
+def _Trace(indoor, outdoor=10.0, period=5, start=0):
+    return [SensorBatch(start + i * period, {'indoor_temp': temp, 'outdoor_temp': outdoor})
+            for i, temp in enumerate(indoor)]
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRecordAndRead(self):
+        batches = _Trace([20.5, None, 21.25])
+        bus = RecordingSensorBus(FakeSensorBus(batches),
+                                 TraceRecorder(self.path, flush_period=10))
+        bus.ReadAll()
+        bus.ReadAll()
+        # Nothing is written until flush_period has passed.
+        self.assertFalse(os.path.exists(self.path))
+        bus.ReadAll()
+        with open(self.path) as f:
+            self.assertEqual(6, len(f.readlines()))
+        bus.Close()
+        self.assertTrue(bus._bus.closed)
+        with open(self.path) as f:
+            read = list(ReadTrace(f))
+        self.assertEqual([0, 5, 10], [batch.timestamp for batch in read])
+        self.assertEqual([batch.values for batch in batches],
+                         [batch.values for batch in read])
+
+    def testMalformedLinesAreSkipped(self):
+        read = list(ReadTrace(['0.0,indoor_temp,20.0\n', 'garbage\n',
+                               '5.0,indoor_temp,21.0\n', '10.0,indoo']))
+        self.assertEqual([20.0, 21.0], [batch.Get('indoor_temp') for batch in read])
+
+    def testReplayIsDeterministic(self):
+        # Warm inside, cold outside: the fan should turn on.
+        trace = _Trace([25.0] * 20, start=1435000000)
+        result = Replay(trace, 22.5, hysteresis=0, min_outside_diff=0,
+                        outside_window=1, inside_window=1)
+        self.assertEqual(1, result.state_changes)
+        self.assertEqual(20, len(result.state))
+        again = Replay(trace, 22.5, hysteresis=0, min_outside_diff=0,
+                       outside_window=1, inside_window=1)
+        self.assertEqual(result.pid, again.pid)
+        self.assertEqual(result.target, again.target)
+        summary = result.GetSummary()
+        self.assertEqual(20, summary['steps'])
+        self.assertEqual(1.0, summary['out_of_band'])
+
+
+if __name__ == "__main__":
+    unittest.main()
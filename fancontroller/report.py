@@ -0,0 +1,351 @@
+'''
+Headless reports of simulated or recorded thermostat traces.
+
+A trace is streamed through in chunks: every series goes through a
+MinMaxDecimator into fixed size buffers of min, max and mean per time
+bucket, and Summary accumulates the statistics, so a year of 10 second
+steps takes as much memory as a day. The report is written as HTML with
+inline SVG charts, or as PNG through matplotlib's Agg backend, which needs
+no display and is only imported for PNG output.
+
+  python -m fancontroller.report simulate --days 365 --output year.html
+  python -m fancontroller.report history --days 7 --target-temp 22.5 --output week.png
+'''
+import argparse
+import cgi
+import sys
+
+import numpy as np
+
+from fancontroller.simulation import Simulator, PlantModel
+
+# Buckets per chart, about one per pixel column.
+BUCKETS = 1000
+# Samples simulated or read per chunk.
+CHUNK = 8640
+SERIES = ['outdoor', 'indoor', 'target', 'state']
+_COLORS = {'outdoor': '#d62728', 'indoor': '#1f77b4', 'target': '#333333',
+           'state': '#2ca02c'}
+
+
+class MinMaxDecimator(object):
+    """Min, max and mean of a series per time bucket, in fixed size buffers.
+
+    Buckets are span seconds wide from the first sample on. A sample past
+    the last bucket merges pairs of buckets and doubles span, so a trace of
+    any length fits in the same buffers and its spikes survive as the
+    bucket extremes. NaN values are skipped.
+    """
+
+    def __init__(self, buckets=BUCKETS, span=None):
+        if buckets % 2:
+            raise ValueError('buckets must be even')
+        self.buckets = buckets
+        self.span = span
+        self.start = None
+        self.min = np.full(buckets, np.inf)
+        self.max = np.full(buckets, -np.inf)
+        self.sum = np.zeros(buckets)
+        self.count = np.zeros(buckets, dtype=np.int64)
+
+    def Add(self, times, values):
+        """Adds a chunk of samples, times ascending and after those of earlier chunks."""
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if not len(times):
+            return
+        if self.start is None:
+            self.start = times[0]
+            if self.span is None:
+                self.span = times[1] - times[0] if len(times) > 1 else 1.0
+        while times[-1] >= self.start + self.span * self.buckets:
+            self._Merge()
+        index = ((times - self.start) // self.span).astype(np.int64)
+        # The chunk's runs of samples in the same bucket.
+        starts = np.flatnonzero(np.concatenate([[True], index[1:] != index[:-1]]))
+        buckets = index[starts]
+        valid = ~np.isnan(values)
+        # fmin and fmax ignore NaN unless the whole run is NaN.
+        self.min[buckets] = np.fmin(self.min[buckets], np.fmin.reduceat(values, starts))
+        self.max[buckets] = np.fmax(self.max[buckets], np.fmax.reduceat(values, starts))
+        self.sum[buckets] += np.add.reduceat(np.where(valid, values, 0.0), starts)
+        self.count[buckets] += np.add.reduceat(valid.astype(np.int64), starts)
+
+    def _Merge(self):
+        half = self.buckets // 2
+        self.min[:half] = np.minimum(self.min[0::2], self.min[1::2])
+        self.max[:half] = np.maximum(self.max[0::2], self.max[1::2])
+        self.sum[:half] = self.sum[0::2] + self.sum[1::2]
+        self.count[:half] = self.count[0::2] + self.count[1::2]
+        self.min[half:] = np.inf
+        self.max[half:] = -np.inf
+        self.sum[half:] = 0
+        self.count[half:] = 0
+        self.span *= 2
+
+    def GetSeries(self):
+        """Returns (bucket start times, min, max, mean) of the buckets with samples."""
+        used = np.flatnonzero(self.count)
+        if self.start is None:
+            used = used[:0]
+        times = (self.start or 0) + self.span * used if len(used) else np.zeros(0)
+        return (times, self.min[used], self.max[used],
+                self.sum[used] / self.count[used])
+
+
+class Summary(object):
+    """Statistics of a trace, accumulated chunk by chunk.
+
+    Like fancontroller.sweep, the band is band / 2 around target_temp.
+    """
+
+    def __init__(self, target_temp, step, band=1.0):
+        self.target_temp = target_temp
+        self.step = step
+        self.band = band
+        self.samples = 0
+        self.state_changes = 0
+        self.on = 0
+        self.in_band = 0
+        self._last_state = None
+
+    def Add(self, indoor, state):
+        indoor = np.asarray(indoor, dtype=float)
+        state = np.asarray(state)
+        if not len(state):
+            return
+        self.samples += len(state)
+        self.on += int(np.count_nonzero(state))
+        self.in_band += int(np.count_nonzero(
+            np.abs(indoor - self.target_temp) <= self.band / 2.0))
+        self.state_changes += int(np.count_nonzero(state[1:] != state[:-1]))
+        if self._last_state is not None and state[0] != self._last_state:
+            self.state_changes += 1
+        self._last_state = state[-1]
+
+    def GetHours(self):
+        return self.samples * self.step / 3600.0
+
+    def GetStats(self):
+        """Returns a list of (name, value) of the statistics."""
+        hours = self.GetHours()
+        samples = float(max(1, self.samples))
+        return [('hours', hours),
+                ('state_changes', self.state_changes),
+                ('changes_per_hour', self.state_changes / hours if hours else 0.0),
+                ('time_in_band', self.in_band / samples),
+                ('duty_cycle', self.on / samples)]
+
+
+class Report(object):
+    """Decimated series and Summary of one trace, see the module doc."""
+
+    def __init__(self, target_temp, step, band=1.0, buckets=BUCKETS, title='Thermostat'):
+        self.title = title
+        self.summary = Summary(target_temp, step, band)
+        self.series = dict((name, MinMaxDecimator(buckets)) for name in SERIES)
+
+    def Add(self, times, outdoor, indoor, target, state):
+        """Adds a chunk of the trace, one value per time in each array."""
+        for name, values in zip(SERIES, [outdoor, indoor, target, state]):
+            self.series[name].Add(times, values)
+        self.summary.Add(indoor, state)
+
+    def WriteHtml(self, out):
+        """Writes the report as a standalone HTML page."""
+        out.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                  '<title>%s</title></head><body>\n' % cgi.escape(self.title))
+        out.write('<h1>%s</h1>\n<table>\n' % cgi.escape(self.title))
+        for name, value in self.summary.GetStats():
+            out.write('<tr><th>%s</th><td>%s</td></tr>\n' % (name, _Format(value)))
+        out.write('</table>\n')
+        out.write(_Svg([self.series[name] for name in ['outdoor', 'indoor', 'target']],
+                       ['outdoor', 'indoor', 'target'], 'temperature'))
+        out.write(_Svg([self.series['state']], ['state'], 'fan on (fraction of bucket)'))
+        out.write('</body></html>\n')
+
+    def WritePng(self, path):
+        """Writes the report as a PNG image, needs matplotlib."""
+        # Only reports need matplotlib; Agg renders without a display.
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        figure, (temperatures, fan) = plt.subplots(
+            2, 1, sharex=True, figsize=(12, 7), gridspec_kw={'height_ratios': [3, 1]})
+        for name in ['outdoor', 'indoor', 'target']:
+            times, low, high, mean = self.series[name].GetSeries()
+            hours = (times - times[0]) / 3600.0 if len(times) else times
+            temperatures.fill_between(hours, low, high, color=_COLORS[name], alpha=0.3,
+                                      linewidth=0)
+            temperatures.plot(hours, mean, color=_COLORS[name], label=name)
+        temperatures.legend(loc='upper right')
+        temperatures.grid(True)
+        temperatures.set_title('%s: %s' % (self.title, ', '.join(
+            '%s %s' % (name, _Format(value)) for name, value in self.summary.GetStats())),
+            fontsize=9)
+        times, _, _, duty = self.series['state'].GetSeries()
+        fan.plot((times - times[0]) / 3600.0 if len(times) else times, duty,
+                 color=_COLORS['state'])
+        fan.set_ylim((-0.05, 1.05))
+        fan.set_ylabel('fan on')
+        fan.set_xlabel('hours')
+        figure.savefig(path, dpi=100)
+        plt.close(figure)
+
+    def Write(self, path):
+        """Writes the report to path, PNG if it ends in .png and HTML otherwise."""
+        if path.lower().endswith('.png'):
+            self.WritePng(path)
+        else:
+            with open(path, 'w') as out:
+                self.WriteHtml(out)
+
+
+def _Format(value):
+    return '%.3f' % value if isinstance(value, float) else str(value)
+
+
+def _Svg(decimators, names, label, width=1000, height=300):
+    """An inline SVG chart of the decimators: a min/max band and a mean line each."""
+    series = [decimator.GetSeries() for decimator in decimators]
+    series = [(name, s) for name, s in zip(names, series) if len(s[0])]
+    if not series:
+        return '<p>no data for %s</p>\n' % cgi.escape(label)
+    t0 = min(s[0][0] for _, s in series)
+    t1 = max(s[0][-1] for _, s in series)
+    low = min(float(np.nanmin(s[1])) for _, s in series)
+    high = max(float(np.nanmax(s[2])) for _, s in series)
+    if high <= low:
+        high = low + 1
+    span = max(t1 - t0, 1e-9)
+
+    def X(t):
+        return (t - t0) / span * width
+
+    def Y(v):
+        return height - (v - low) / (high - low) * height
+
+    parts = ['<h2>%s</h2>\n<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+             'viewBox="0 0 %d %d">\n' % (cgi.escape(label), width, height, width, height)]
+    for name, (times, mins, maxs, means) in series:
+        color = _COLORS.get(name, '#000000')
+        ok = np.isfinite(mins) & np.isfinite(maxs)
+        xs = X(times[ok])
+        band = (['%.1f,%.1f' % p for p in zip(xs, Y(maxs[ok]))] +
+                ['%.1f,%.1f' % p for p in zip(xs[::-1], Y(mins[ok])[::-1])])
+        parts.append('<polygon points="%s" fill="%s" fill-opacity="0.3"/>\n' %
+                     (' '.join(band), color))
+        parts.append('<polyline points="%s" fill="none" stroke="%s"><title>%s</title>'
+                     '</polyline>\n' % (' '.join('%.1f,%.1f' % p for p in zip(xs, Y(means[ok]))),
+                                        color, name))
+    parts.append('<text x="2" y="12" font-size="12">%.1f</text>'
+                 '<text x="2" y="%d" font-size="12">%.1f</text>\n' % (high, height - 2, low))
+    parts.append('</svg>\n')
+    return ''.join(parts)
+
+
+def SyntheticOutdoorChunks(days, step, chunk=CHUNK, seed=None):
+    """fancontroller.sweep.SyntheticOutdoor in chunks of at most chunk samples."""
+    rand = np.random.RandomState(seed)
+    n = int(days * 24 * 3600 // step)
+    for first in range(0, n, chunk):
+        t = step * np.arange(first, min(n, first + chunk))
+        noise = rand.randint(-5, 5, len(t)) / 10.0
+        yield 70 + 13 * np.cos(2 * np.pi * t / (24 * 3600)) + noise
+
+
+def ReportSimulation(outdoor_chunks, target_temp, step=10.0, band=1.0, buckets=BUCKETS,
+                     title='Simulation', **kwargs):
+    """Simulates the outdoor chunks with one Simulator, kwargs are its arguments."""
+    simulator = Simulator(target_temp, step=step, **kwargs)
+    report = Report(target_temp, step, band, buckets, title)
+    offset = 0
+    for outdoor in outdoor_chunks:
+        outdoor = np.asarray(outdoor, dtype=float)
+        result = simulator.Run(outdoor)
+        times = step * np.arange(offset, offset + len(outdoor))
+        report.Add(times, outdoor, result.indoor, result.target, result.fan)
+        offset += len(outdoor)
+    return report
+
+
+def ReportHistory(store, target_temp, zone=0, start=None, end=None, band=1.0,
+                  buckets=BUCKETS, chunk=CHUNK, title='History'):
+    """Reports the records of zone in a fancontroller.history.HistoryStore.
+
+    The step of the statistics is the median interval of the first chunk.
+    """
+    report = None
+    for segment in store.GetSegments():
+        timestamps = segment['timestamp']
+        lo = 0 if start is None else np.searchsorted(timestamps, start, 'left')
+        hi = len(segment) if end is None else np.searchsorted(timestamps, end, 'left')
+        for first in range(lo, hi, chunk):
+            records = segment[first:min(hi, first + chunk)]
+            records = records[records['zone'] == zone]
+            if not len(records):
+                continue
+            if report is None:
+                step = float(np.median(np.diff(records['timestamp']))) if len(records) > 1 else 1.0
+                report = Report(target_temp, step, band, buckets, title)
+            report.Add(records['timestamp'], records['outdoor_median'],
+                       records['indoor_median'], records['target'], records['state'])
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    commands = parser.add_subparsers(dest='command')
+    simulate = commands.add_parser('simulate', help='report a simulation')
+    simulate.add_argument('--days', type=float, default=3)
+    simulate.add_argument('--step', type=float, default=10.0)
+    simulate.add_argument('--target-temp', type=float, default=72.0)
+    simulate.add_argument('--hysteresis', type=float, default=0.5)
+    simulate.add_argument('--min-outside-diff', type=float, default=2.0)
+    simulate.add_argument('--seed', type=int, default=None)
+    history = commands.add_parser('history', help='report the recorded history')
+    history.add_argument('--history', default=None, help='history file')
+    history.add_argument('--days', type=float, default=7)
+    history.add_argument('--zone', type=int, default=0)
+    history.add_argument('--target-temp', type=float, default=22.5)
+    for command in (simulate, history):
+        command.add_argument('--band', type=float, default=1.0,
+                             help='width of the acceptable band around target_temp')
+        command.add_argument('--buckets', type=int, default=BUCKETS)
+        command.add_argument('--output', required=True, help='.png or .html file to write')
+    args = parser.parse_args(argv)
+    if args.command == 'simulate':
+        if args.step <= 0:
+            parser.error('--step must be positive')
+        report = ReportSimulation(
+            SyntheticOutdoorChunks(args.days, args.step, seed=args.seed), args.target_temp,
+            step=args.step, band=args.band, buckets=args.buckets,
+            title='Simulation of %g days' % args.days,
+            initial_indoor=80,
+            # 10 and 1 minute median windows, at least one sample each.
+            outside_window=max(1, int(600 // args.step)),
+            inside_window=max(1, int(60 // args.step)),
+            hysteresis=args.hysteresis, min_outside_diff=args.min_outside_diff,
+            plant=PlantModel())
+    else:
+        import time
+        from fancontroller.history import HistoryStore, HISTORY_FILE
+        store = HistoryStore(args.history or HISTORY_FILE, readonly=True)
+        try:
+            report = ReportHistory(store, args.target_temp, args.zone,
+                                   start=time.time() - args.days * 86400, band=args.band,
+                                   buckets=args.buckets,
+                                   title='Zone %d, last %g days' % (args.zone, args.days))
+        finally:
+            store.Close()
+        if report is None:
+            sys.stderr.write('no records of zone %d\n' % args.zone)
+            return 1
+    report.Write(args.output)
+    for name, value in report.summary.GetStats():
+        print '%s: %s' % (name, _Format(value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
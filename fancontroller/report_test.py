@@ -0,0 +1,129 @@
+'''
+Tests for the headless simulation reports.
+'''
+import StringIO
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from fancontroller.history import HistoryStore
+from fancontroller.report import (MinMaxDecimator, Summary, ReportSimulation, ReportHistory,
+                                  SyntheticOutdoorChunks, main)
+from fancontroller.simulation import Simulate
+
+
+class MinMaxDecimatorTest(unittest.TestCase):
+
+    def testKeepsSpikesInBoundedBuffers(self):
+        decimator = MinMaxDecimator(buckets=10)
+        values = np.zeros(1000)
+        values[537] = 50.0
+        values[3] = -7.0
+        values[800] = np.nan
+        for first in range(0, 1000, 64):
+            decimator.Add(np.arange(first, min(1000, first + 64)), values[first:first + 64])
+        times, mins, maxs, means = decimator.GetSeries()
+        self.assertLessEqual(len(times), 10)
+        self.assertEqual(10, len(decimator.min))
+        self.assertEqual(50.0, maxs.max())
+        self.assertEqual(-7.0, mins.min())
+        self.assertEqual(999, decimator.count.sum())
+        self.assertAlmostEqual(43.0 / 999, np.sum(means * decimator.count[decimator.count > 0])
+                               / 999)
+        self.assertEqual(0, times[0])
+        self.assertTrue(np.all(np.diff(times) == decimator.span))
+
+    def testEmpty(self):
+        self.assertEqual(0, len(MinMaxDecimator().GetSeries()[0]))
+
+
+class SummaryTest(unittest.TestCase):
+
+    def testChunksMatchWholeTrace(self):
+        rand = np.random.RandomState(1)
+        state = rand.rand(1000) < 0.3
+        indoor = 72 + rand.randn(1000)
+        summary = Summary(72, step=10, band=1.0)
+        for first in range(0, 1000, 77):
+            summary.Add(indoor[first:first + 77], state[first:first + 77])
+        stats = dict(summary.GetStats())
+        self.assertEqual(np.count_nonzero(np.diff(state)), stats['state_changes'])
+        self.assertAlmostEqual(np.mean(np.abs(indoor - 72) <= 0.5), stats['time_in_band'])
+        self.assertAlmostEqual(np.mean(state), stats['duty_cycle'])
+        self.assertAlmostEqual(10000 / 3600.0, stats['hours'])
+
+
+class ReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testChunkedSimulationMatchesSimulate(self):
+        outdoor = list(SyntheticOutdoorChunks(2, 10.0, chunk=5000, seed=3))
+        report = ReportSimulation(outdoor, 72, step=10.0, buckets=100, initial_indoor=80)
+        result = Simulate(np.concatenate(outdoor), 72, step=10.0, initial_indoor=80)
+        stats = dict(report.summary.GetStats())
+        self.assertEqual(result.state_changes, stats['state_changes'])
+        self.assertAlmostEqual(np.mean(result.fan), stats['duty_cycle'])
+        times, mins, maxs, _ = report.series['indoor'].GetSeries()
+        self.assertEqual(result.indoor.max(), maxs.max())
+        self.assertEqual(result.indoor.min(), mins.min())
+        self.assertLessEqual(len(times), 100)
+        out = StringIO.StringIO()
+        report.WriteHtml(out)
+        html = out.getvalue()
+        self.assertEqual(2, html.count('<svg'))
+        self.assertIn('<th>changes_per_hour</th>', html)
+
+    def testSimulationDutyCycleCountsTheAppliedState(self):
+        # Without hysteresis some changes are suppressed as flapping.
+        kwargs = dict(initial_indoor=80, outside_window=1, inside_window=1,
+                      hysteresis=0, min_outside_diff=0)
+        outdoor = list(SyntheticOutdoorChunks(0.5, 10.0, chunk=1000, seed=3))
+        report = ReportSimulation(outdoor, 72, step=10.0, **kwargs)
+        result = Simulate(np.concatenate(outdoor), 72, step=10.0, **kwargs)
+        self.assertGreater(result.flapping_suppressed, 0)
+        self.assertNotEqual(np.mean(result.state), np.mean(result.fan))
+        stats = dict(report.summary.GetStats())
+        self.assertAlmostEqual(np.mean(result.fan), stats['duty_cycle'])
+        self.assertEqual(result.state_changes, stats['state_changes'])
+
+    def testHistory(self):
+        store = HistoryStore(os.path.join(self.dir, 'history.bin'), capacity=100)
+        for i in range(150):
+            store.Append(1000.0 + 10 * i, None, None, 22.0 + i % 3, 15.0, 0.0, 22.5, i % 2)
+        report = ReportHistory(store, 22.5, start=1000.0, buckets=10)
+        self.assertIsNone(ReportHistory(store, 22.5, zone=1))
+        stats = dict(report.summary.GetStats())
+        # The ring only holds the last 100 records.
+        self.assertAlmostEqual(100 * 10 / 3600.0, stats['hours'])
+        self.assertEqual(99, stats['state_changes'])
+        self.assertEqual(1500.0, report.series['indoor'].GetSeries()[0][0])
+        report = ReportHistory(store, 22.5, start=2000.0, chunk=7)
+        self.assertEqual(50, report.summary.samples)
+        self.assertEqual(49, report.summary.state_changes)
+        store.Close()
+
+    def testMain(self):
+        output = os.path.join(self.dir, 'report.html')
+        self.assertEqual(0, main(['simulate', '--days', '1', '--seed', '1', '--output', output]))
+        with open(output) as f:
+            self.assertIn('<th>duty_cycle</th>', f.read())
+
+    def testMain_Step(self):
+        output = os.path.join(self.dir, 'report.html')
+        # Neither window is a whole number of 7s or 900s steps.
+        for step in ('7', '900'):
+            self.assertEqual(0, main(['simulate', '--days', '0.5', '--step', step,
+                                      '--seed', '1', '--output', output]))
+        self.assertRaises(SystemExit, main, ['simulate', '--step', '0', '--output', output])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,477 @@
+'''
+Concurrent runtime for the fan controller.
+
+Sensor reads (one SensorBus.ReadAll pass), the control step, metric uploads
+and forecast refreshes each run in their own task so that a slow sensor or
+a stalled upload never delays Thermostat.ControlLoop. The control step runs
+as soon as the sensor task delivered new measurements rather than on its
+own timer. Every task keeps latency statistics.
+
+With a snapshot path the state of all zones is saved every snapshot_period
+seconds for a warm restart, see fancontroller.snapshot. With a HistoryStore
+every control step is recorded, with
+fancontroller.instrumentation.Instruments the stages of a cycle are timed
+and the task, sensor and fan counters are exported.
+
+With planners (fancontroller.planner.Planner per zone name) the zones
+follow a pre-cooling plan made from the forecast, updated every
+plan_period seconds.
+
+With spike_threshold every sensor's readings go through a
+fancontroller.filters.FilterBank first and readings it rejects as spikes
+(glitched 1-Wire reads) never reach the thermostats.
+
+Tasks are scheduled on the monotonic clock with a per task catch-up policy,
+see fancontroller.scheduler; Runtime takes a FakeClock in tests. Reconfigure() changes
+the zone settings and task periods of a running runtime, see
+fancontroller.config.
+'''
+import contextlib
+import logging
+import threading
+import time
+
+from fancontroller import snapshot
+from fancontroller.filters import FilterBank
+from fancontroller.forecast import RETRY_DELAY
+from fancontroller.scheduler import MonotonicClock, Schedule, Wakeup, SKIP, RESET
+
+
+@contextlib.contextmanager
+def _NoBatch():
+    yield
+
+
+class TaskStats(object):
+    """Latency statistics of a periodic task, in seconds."""
+
+    def __init__(self):
+        self.runs = 0
+        self.errors = 0
+        # Deadlines that passed while the previous run was still going, and
+        # of those the ones whose run was skipped.
+        self.missed = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def Record(self, latency):
+        self.runs += 1
+        self.last_latency = latency
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    def RecordLateness(self, lateness):
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+    def GetMeanLatency(self):
+        if not self.runs:
+            return 0.0
+        return self.total_latency / self.runs
+
+    def __str__(self):
+        return ('runs: %d errors: %d missed: %d overruns: %d mean: %.1fms '
+                'max: %.1fms max late: %.1fms' % (
+                    self.runs, self.errors, self.missed, self.overruns,
+                    self.GetMeanLatency() * 1000, self.max_latency * 1000,
+                    self.max_lateness * 1000))
+
+
+class PeriodicTask(object):
+    """Calls fn every period seconds on its own thread.
+
+    Runs are scheduled on a fixed grid from the start time. If a run takes
+    longer than period the missed deadlines are counted and handled by
+    policy, see fancontroller.scheduler; skipped runs are counted as
+    overruns. With retry_delay a run that raised is retried every
+    retry_delay seconds until one succeeds or the next run is due.
+    """
+
+    def __init__(self, name, fn, period, policy=SKIP, clock=None, retry_delay=None):
+        self.name = name
+        self.period = period
+        self.retry_delay = retry_delay
+        self.stats = TaskStats()
+        self._fn = fn
+        self._clock = clock or MonotonicClock()
+        self._schedule = Schedule(period, policy)
+        self._stop = Wakeup()
+        self._thread = threading.Thread(target=self._Run, name=name)
+        self._thread.daemon = True
+
+    def Start(self):
+        self._thread.start()
+
+    def Stop(self):
+        self._stop.Set()
+
+    def Join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def SetPeriod(self, period):
+        """Changes the period, from the run after the next one on."""
+        self.period = period
+        self._schedule.period = period
+
+    def _RunOnce(self):
+        """Runs fn once, returns the time it finished and whether fn succeeded."""
+        start = self._clock.Now()
+        ok = True
+        try:
+            self._fn()
+        except Exception as e:
+            self.stats.errors += 1
+            ok = False
+            logging.exception(e)
+        end = self._clock.Now()
+        self.stats.Record(end - start)
+        return end, ok
+
+    def _Run(self):
+        schedule = self._schedule
+        schedule.Start(self._clock.Now())
+        while not self._stop.IsSet():
+            self.stats.RecordLateness(schedule.GetLateness(self._clock.Now()))
+            end, ok = self._RunOnce()
+            missed, skipped = schedule.Finished(end)
+            self.stats.missed += missed
+            self.stats.overruns += skipped
+            # Retries are off the grid, the next deadline stays where it is.
+            while (not ok and self.retry_delay and
+                   end + self.retry_delay < schedule.deadline):
+                if self._clock.Wait(self._stop, end + self.retry_delay - self._clock.Now()):
+                    return
+                end, ok = self._RunOnce()
+            self._clock.Wait(self._stop, schedule.deadline - self._clock.Now())
+
+
+class TriggeredTask(PeriodicTask):
+    """Calls fn on its own thread after Trigger() was called.
+
+    Triggers that arrive while fn runs are coalesced into one more run. If
+    period is set fn also runs when no trigger arrived for period seconds.
+    With min_interval runs start at least min_interval seconds apart, the
+    triggers in between are coalesced into one run at its end.
+    """
+
+    def __init__(self, name, fn, period=None, clock=None, min_interval=None):
+        PeriodicTask.__init__(self, name, fn, period, clock=clock)
+        self.min_interval = min_interval
+        self._triggered = Wakeup()
+
+    def Trigger(self):
+        self._triggered.Set()
+
+    def Stop(self):
+        PeriodicTask.Stop(self)
+        self._triggered.Set()
+
+    def _Run(self):
+        last_start = None
+        while True:
+            self._clock.Wait(self._triggered, self.period)
+            if self._stop.IsSet():
+                break
+            if self.min_interval and last_start is not None:
+                remaining = last_start + self.min_interval - self._clock.Now()
+                if remaining > 0 and self._clock.Wait(self._stop, remaining):
+                    break
+            self._triggered.Clear()
+            last_start = self._clock.Now()
+            self._RunOnce()
+
+
+class Runtime(object):
+    """Runs the zones' Thermostats with their sensors, uploader and forecast as separate tasks.
+
+    zones is a list of objects with name, thermostat, indoor and outdoor
+    (sensor names) attributes, see fancontroller.zones.Zone. All zones share
+    one sensor read pass, one uploader and one forecast. history is an
+    optional fancontroller.history.HistoryStore, instruments optional
+    fancontroller.instrumentation.Instruments. With events, a
+    fancontroller.eventlog.EventLog, the zones record their decisions to it
+    instead of logging them, by their index in zones. gpio is the optional
+    fancontroller.fan_gpio.GpioBackend of the fans, the fan changes of one
+    control step are written to it as one bank.
+
+    The sensors are read every sample_period seconds, period if None. The
+    control task runs whenever the sensor task recorded new measurements,
+    at most every period seconds when the sensors are read faster, or every
+    period seconds if event_driven is False. policies maps task
+    names to their catch-up policy, see DEFAULT_POLICIES.
+    """
+
+    STATS_PERIOD = 600
+    # A forecast refresh missed during a stall is done right away, the others
+    # wait for their next slot.
+    DEFAULT_POLICIES = {'forecast': RESET}
+    # Readings a sensor's spike filter compares new readings to.
+    SPIKE_WINDOW = 9
+
+    def __init__(self, zones, sensors,
+                 uploader=None, forecast=None, history=None, instruments=None,
+                 period=5, report_period=60, forecast_period=3600,
+                 event_driven=True, snapshot_path=None, snapshot_period=60,
+                 sample_period=None, policies=None, clock=None,
+                 planners=None, plan_period=300, gpio=None, spike_threshold=None,
+                 events=None):
+        self.zones = zones
+        self._sensors = sensors
+        self._history = history
+        self._instruments = instruments
+        self._last_batch = None
+        self._snapshot_path = snapshot_path
+        self.start_time = None
+        self.first_control_time = None
+        self._first_control = Wakeup()
+        self._uploader = uploader
+        self._forecast = forecast
+        self._planners = planners or {}
+        self._gpio = gpio
+        # Guards the thermostats, the sensor task and the control task both
+        # touch their filters.
+        self._lock = threading.Lock()
+        self._sample_period = sample_period
+        self._spike_threshold = spike_threshold
+        # Sensor name -> FilterBank, created on the first reading.
+        self._spike_filters = {}
+        policies = dict(Runtime.DEFAULT_POLICIES, **(policies or {}))
+
+        def Task(name, fn, task_period, retry_delay=None):
+            return PeriodicTask(name, fn, task_period, policies.get(name, SKIP), clock,
+                                retry_delay)
+        if event_driven:
+            # Sampling faster than period does not make control run faster.
+            min_interval = period if sample_period and sample_period < period else None
+            self._control_task = TriggeredTask('control', self._Control, clock=clock,
+                                               min_interval=min_interval)
+        else:
+            self._control_task = Task('control', self._Control, period)
+        self.tasks = [
+            Task('sensors', self._ReadSensors, sample_period or period),
+            self._control_task,
+        ]
+        if uploader is not None:
+            self.tasks.append(Task('upload', self._Upload, report_period))
+        if forecast is not None:
+            # Planning goes on with the stale forecast until a failed download
+            # is retried, like ForecastCache.Start() does.
+            self.tasks.append(Task('forecast', forecast.Download, forecast_period,
+                                   RETRY_DELAY))
+        if forecast is not None and self._planners:
+            self.tasks.append(Task('plan', self._Plan, plan_period))
+        if snapshot_path is not None:
+            self.tasks.append(Task('snapshot', self.SaveSnapshot, snapshot_period))
+        self.tasks.append(Task('stats', self.LogStats, Runtime.STATS_PERIOD))
+        if instruments is not None:
+            self._RegisterCounters(instruments.registry)
+            if gpio is not None:
+                # Times the writes that reach the pins, batched ones included.
+                gpio.instruments = instruments
+        if events is not None:
+            for i, zone in enumerate(zones):
+                zone.thermostat.SetEventLog(events, i)
+
+    def _RegisterCounters(self, registry):
+        for task in self.tasks:
+            labels = {'task': task.name}
+            registry.AddCounter('fancontroller_task_overruns_total',
+                                'Periodic task runs skipped because the previous run overran.',
+                                lambda stats=task.stats: stats.overruns, labels)
+            registry.AddCounter('fancontroller_task_missed_deadlines_total',
+                                'Periodic task deadlines that passed while the previous run was going.',
+                                lambda stats=task.stats: stats.missed, labels)
+            registry.AddCounter('fancontroller_task_errors_total',
+                                'Periodic task runs that raised.',
+                                lambda stats=task.stats: stats.errors, labels)
+        for zone in self.zones:
+            registry.AddCounter('fancontroller_flapping_suppressed_total',
+                                'Fan changes suppressed because the last change was too recent.',
+                                zone.thermostat.GetFlappingSuppressedCount,
+                                {'zone': zone.name})
+            registry.AddCounter('fancontroller_fan_changes_total',
+                                'Fan state changes.',
+                                zone.thermostat.GetStateChangeCount,
+                                {'zone': zone.name})
+            registry.AddCounter('fancontroller_skipped_recomputes_total',
+                                'Control steps skipped because no input changed.',
+                                lambda thermostat=zone.thermostat: thermostat.skipped_recomputes,
+                                {'zone': zone.name})
+        if hasattr(self._sensors, 'GetFailureCount'):
+            registry.AddCounter('fancontroller_sensor_failures_total',
+                                'Sensor reads that returned no temperature.',
+                                self._sensors.GetFailureCount)
+        if self._spike_threshold:
+            registry.AddCounter('fancontroller_sensor_spikes_rejected_total',
+                                'Sensor readings rejected as spikes.',
+                                self.GetRejectedSpikeCount)
+
+    def GetRejectedSpikeCount(self):
+        return sum(bank.rejected for bank in self._spike_filters.values())
+
+    def _Filter(self, batch, name):
+        """Returns the reading of sensor name in batch, None if missing or a spike."""
+        value = batch.Get(name)
+        if value is None or not self._spike_threshold:
+            return value
+        bank = self._spike_filters.get(name)
+        if bank is None:
+            bank = self._spike_filters[name] = FilterBank(
+                [Runtime.SPIKE_WINDOW], spike_threshold=self._spike_threshold)
+        return value if bank.add(value) else None
+
+    def _ReadSensors(self):
+        start = time.time()
+        batch = self._sensors.ReadAll()
+        read = time.time()
+        with self._lock:
+            update = time.time()
+            self._last_batch = batch
+            recorded = False
+            # Zones may share a sensor, it is filtered once per batch.
+            readings = {}
+            for zone in self.zones:
+                for name in (zone.indoor, zone.outdoor):
+                    if name not in readings:
+                        readings[name] = self._Filter(batch, name)
+                indoor = readings[zone.indoor]
+                outdoor = readings[zone.outdoor]
+                if indoor is not None:
+                    zone.thermostat.RecordIndoorMeasurement(indoor)
+                    recorded = True
+                if outdoor is not None:
+                    zone.thermostat.RecordOutdoorMeasurement(outdoor)
+                    recorded = True
+            if self._instruments is not None:
+                self._instruments.sensor_read.Observe(read - start)
+                self._instruments.filter_update.Observe(time.time() - update)
+        if recorded and isinstance(self._control_task, TriggeredTask):
+            self._control_task.Trigger()
+
+    def _Control(self):
+        with self._lock:
+            instruments = self._instruments
+            # The fan changes of all zones go out as one bank write.
+            with self._gpio.Batch() if self._gpio is not None else _NoBatch():
+                for zone in self.zones:
+                    start = time.time()
+                    zone.thermostat.ControlLoop()
+                    if instruments is not None:
+                        instruments.control.Observe(time.time() - start)
+            if self.first_control_time is None:
+                self.first_control_time = time.time()
+                self._first_control.Set()
+            if self._history is not None:
+                self._Record()
+
+    def _Record(self):
+        now = time.time()
+        batch = self._last_batch
+        for i, zone in enumerate(self.zones):
+            thermostat = zone.thermostat
+            measurements = thermostat.GetMeasurements()
+            self._history.Append(now,
+                                 batch.Get(zone.indoor) if batch else None,
+                                 batch.Get(zone.outdoor) if batch else None,
+                                 measurements['indoor_temp'],
+                                 measurements['outdoor_temp'],
+                                 measurements['pid'],
+                                 measurements['target_temp'],
+                                 thermostat.GetState(),
+                                 zone=i)
+
+    def _Plan(self):
+        index = self._forecast.GetIndex()
+        with self._lock:
+            indoor = dict((zone.name, zone.thermostat.GetMeasurements()['indoor_temp'])
+                          for zone in self.zones)
+        # Planning takes a few milliseconds, only the plan is set under the
+        # lock.
+        now = time.time()
+        for zone in self.zones:
+            planner = self._planners.get(zone.name)
+            if planner is not None:
+                plan = planner.Update(now, indoor[zone.name], index)
+                with self._lock:
+                    zone.thermostat.SetPlan(plan)
+
+    def _Upload(self):
+        with self._lock:
+            reports = []
+            for zone in self.zones:
+                measurements = zone.thermostat.GetMeasurements()
+                if len(self.zones) > 1:
+                    measurements['zone'] = zone.name
+                reports.append(measurements)
+        # Only the snapshot is taken under the lock, the upload itself may
+        # take as long as it likes.
+        start = time.time()
+        for measurements in reports:
+            self._uploader.Upload(measurements)
+        if self._instruments is not None:
+            self._instruments.upload.Observe(time.time() - start)
+
+    def Reconfigure(self, settings):
+        """Applies settings validated by fancontroller.config.Validate().
+
+        The zones keep their filter windows and PID state, the tasks their
+        threads.
+        """
+        with self._lock:
+            for zone in self.zones:
+                zone_settings = settings['zones'][zone.name]
+                zone.thermostat.Reconfigure(**zone_settings)
+                if zone.name in self._planners:
+                    self._planners[zone.name].SetTargets(
+                        zone_settings['target_temp'], zone_settings['hysteresis'],
+                        zone_settings['min_outside_diff'])
+        for task in self.tasks:
+            if task.name == 'sensors' and self._sample_period is None:
+                task.SetPeriod(settings['period'])
+            elif task is self._control_task and task.period is not None:
+                task.SetPeriod(settings['period'])
+            elif task is self._control_task and task.min_interval:
+                task.min_interval = settings['period']
+            elif task.name == 'upload':
+                task.SetPeriod(settings['report_period'])
+        if hasattr(self._uploader, 'SetFlushPeriod'):
+            self._uploader.SetFlushPeriod(settings['upload_period'])
+
+    def SaveSnapshot(self):
+        with self._lock:
+            states = snapshot.Capture(self.zones)
+        snapshot.Write(self._snapshot_path, states)
+
+    def WaitForFirstControl(self, timeout=None):
+        """Waits for the first control step, returns its delay after Start() in seconds.
+
+        None if there was no control step within timeout.
+        """
+        if not self._first_control.Wait(timeout):
+            return None
+        return self.first_control_time - self.start_time
+
+    def Start(self):
+        self.start_time = time.time()
+        for task in self.tasks:
+            task.Start()
+
+    def Stop(self):
+        for task in self.tasks:
+            task.Stop()
+
+    def Join(self, timeout=None):
+        for task in self.tasks:
+            task.Join(timeout)
+
+    def GetStats(self):
+        """Returns a dict of task name to TaskStats."""
+        return dict((task.name, task.stats) for task in self.tasks)
+
+    def LogStats(self):
+        for task in self.tasks:
+            logging.info('task %s: %s', task.name, task.stats)
@@ -0,0 +1,137 @@
+'''
+Tests for the concurrent runtime.
+'''
+import BaseHTTPServer
+import threading
+import time
+import unittest
+
+from fancontroller import Thermostat
+from fancontroller.fan_controller import MetricsUploader
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.runtime import Runtime, PeriodicTask, TriggeredTask, Wakeup
+from fancontroller.sensors import SensorBatch
+from fancontroller.zones import Zone
+
+
+class FakeSensorBus(object):
+    def __init__(self, **temperatures):
+        self.temperatures = temperatures
+        self.reads = 0
+
+    def ReadAll(self):
+        self.reads += 1
+        return SensorBatch(time.time(), dict(self.temperatures))
+
+
+class StallingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Local stand-in for thingspeak that blocks until released."""
+    release = threading.Event()
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        StallingHandler.requests.append(body)
+        StallingHandler.release.wait(5)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('1')
+
+    def log_message(self, *args):
+        pass
+
+
+class PeriodicTaskTest(unittest.TestCase):
+
+    def testOverrunsAreCounted(self):
+        task = PeriodicTask('slow', lambda: time.sleep(0.05), 0.01)
+        task.Start()
+        time.sleep(0.2)
+        task.Stop()
+        task.Join()
+        self.assertGreater(task.stats.runs, 0)
+        self.assertGreater(task.stats.overruns, task.stats.runs)
+        self.assertGreaterEqual(task.stats.max_latency, 0.05)
+
+    def testErrorsAreCounted(self):
+        def Fail():
+            raise IOError('sensor gone')
+        task = PeriodicTask('failing', Fail, 0.01)
+        task.Start()
+        time.sleep(0.05)
+        task.Stop()
+        task.Join()
+        self.assertGreater(task.stats.errors, 0)
+        self.assertEqual(task.stats.errors, task.stats.runs)
+
+
+class TriggeredTaskTest(unittest.TestCase):
+
+    def testRunsOnTrigger(self):
+        ran = Wakeup()
+        task = TriggeredTask('triggered', ran.Set)
+        task.Start()
+        self.assertFalse(ran.Wait(0.05))
+        task.Trigger()
+        self.assertTrue(ran.Wait(1))
+        task.Stop()
+        task.Join(1)
+        self.assertFalse(task._thread.is_alive())
+        self.assertEqual(1, task.stats.runs)
+
+
+class RuntimeTest(unittest.TestCase):
+
+    def setUp(self):
+        StallingHandler.release.clear()
+        StallingHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('localhost', 0), StallingHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        StallingHandler.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testStalledUploadDoesNotDelayControl(self):
+        gpio = FakeFanGpio()
+        thermostat = Thermostat(20, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0, gpio=gpio)
+        uploader = MetricsUploader(host='localhost:%d' % self.server.server_port)
+        runtime = Runtime([Zone('default', thermostat, 'indoor_temp', 'outdoor_temp')],
+                          FakeSensorBus(indoor_temp=25, outdoor_temp=10),
+                          uploader=uploader, period=0.01, report_period=0.01)
+        runtime.Start()
+        time.sleep(0.3)
+        # The upload task is stuck in its first request...
+        stats = runtime.GetStats()
+        self.assertEqual(1, len(StallingHandler.requests))
+        self.assertEqual(0, stats['upload'].runs)
+        # ... while the control loop keeps running and turned on the fan.
+        self.assertGreater(stats['control'].runs, 10)
+        self.assertEqual(1, gpio.level)
+        StallingHandler.release.set()
+        time.sleep(0.1)
+        runtime.Stop()
+        runtime.Join()
+        self.assertGreater(runtime.GetStats()['upload'].runs, 0)
+        self.assertIn('field1=', StallingHandler.requests[0])
+
+    def testSpikesAreDropped(self):
+        thermostat = Thermostat(22, outside_window=1, inside_window=1,
+                                hysteresis=0, min_outside_diff=0, gpio=FakeFanGpio())
+        sensors = FakeSensorBus(indoor_temp=22.0, outdoor_temp=15.0)
+        runtime = Runtime([Zone('default', thermostat, 'indoor_temp', 'outdoor_temp')],
+                          sensors, spike_threshold=5)
+        for _ in range(Runtime.SPIKE_WINDOW):
+            runtime._ReadSensors()
+        sensors.temperatures['indoor_temp'] = 85.0
+        runtime._ReadSensors()
+        self.assertEqual(22.0, thermostat.GetMeasurements()['indoor_temp'])
+        self.assertEqual(1, runtime.GetRejectedSpikeCount())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+'''
+Deadline scheduling on the monotonic clock.
+
+A Schedule keeps the deadlines of one periodic task on a fixed grid, so its
+runs do not drift by the time each run takes. When a run ends after the next
+deadline, e.g. because the CPU or the SD card stalled, the missed deadlines
+are counted and handled by the task's catch-up policy:
+
+  SKIP      skip the missed runs and continue on the grid
+  CATCH_UP  run the missed runs back to back, at most max_catch_up of them
+  RESET     run once right away and restart the grid from there
+
+Time comes from a clock: MonotonicClock, which wall clock steps (NTP,
+setting the date on a Pi without RTC) do not affect, or FakeClock, which
+only moves when a test advances it.
+'''
+import ctypes
+import ctypes.util
+import logging
+import math
+import os
+import select
+import threading
+import time
+
+SKIP = 'skip'
+CATCH_UP = 'catch_up'
+RESET = 'reset'
+POLICIES = (SKIP, CATCH_UP, RESET)
+# Missed runs CATCH_UP runs late at most, older ones are skipped.
+MAX_CATCH_UP = 3
+
+_CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _MonotonicFunction():
+    """Returns a function returning monotonic seconds, time.time if there is none."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                    use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        logging.warn('no monotonic clock, scheduling on the wall clock')
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def Monotonic():
+        ts = _Timespec()
+        if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return Monotonic
+
+
+Monotonic = _MonotonicFunction()
+
+
+class Wakeup(object):
+    """An event whose timed wait blocks in select() on a pipe.
+
+    threading.Event.wait(timeout) in Python 2 polls, waking the thread up to
+    every 50ms while it waits; this sleeps until the timeout or Set().
+    """
+
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        self._set = False
+        self._lock = threading.Lock()
+
+    def Set(self):
+        with self._lock:
+            if not self._set:
+                self._set = True
+                os.write(self._write, b'x')
+
+    def Clear(self):
+        with self._lock:
+            if self._set:
+                self._set = False
+                os.read(self._read, 1)
+
+    def IsSet(self):
+        return self._set
+
+    def fileno(self):
+        """The pipe's read end, readable while set; for select() next to other files."""
+        return self._read
+
+    def Wait(self, timeout=None):
+        """Waits until set or timeout seconds passed, returns IsSet()."""
+        if not self._set:
+            select.select([self._read], [], [],
+                          None if timeout is None else max(0, timeout))
+        return self._set
+
+    def Close(self):
+        """Closes the pipe, the Wakeup can not be used afterwards."""
+        os.close(self._read)
+        os.close(self._write)
+
+
+class MonotonicClock(object):
+    """Seconds since an arbitrary point, never going backwards."""
+
+    def Now(self):
+        return Monotonic()
+
+    def Wait(self, wakeup, timeout=None):
+        """Waits until wakeup is set or timeout seconds passed, returns wakeup.IsSet()."""
+        return wakeup.Wait(timeout)
+
+
+class FakeClock(object):
+    """A clock that only moves on Advance(), for tests.
+
+    Threads waiting in Wait() wake up once Advance() moved the time past
+    their timeout; BlockUntil() lets a test wait until its threads are idle
+    before advancing.
+    """
+
+    def __init__(self, now=0.0):
+        self._now = now
+        # (deadline, timer) of the threads in Wait().
+        self._waiters = []
+        self._cond = threading.Condition()
+
+    def Now(self):
+        with self._cond:
+            return self._now
+
+    def Advance(self, seconds):
+        """Moves the time forward, waking the waiters whose timeout passed."""
+        with self._cond:
+            self._now += seconds
+            for waiter in list(self._waiters):
+                if waiter[0] <= self._now:
+                    self._waiters.remove(waiter)
+                    waiter[1].Set()
+
+    def Wait(self, wakeup, timeout=None):
+        with self._cond:
+            if wakeup.IsSet() or (timeout is not None and timeout <= 0):
+                return wakeup.IsSet()
+            deadline = float('inf') if timeout is None else self._now + timeout
+            waiter = (deadline, Wakeup())
+            self._waiters.append(waiter)
+            self._cond.notify_all()
+        select.select([wakeup, waiter[1]], [], [])
+        with self._cond:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            # Advance() only sets waiters in the list, and under the lock.
+            waiter[1].Close()
+        return wakeup.IsSet()
+
+    def BlockUntil(self, waiters, timeout=5):
+        """Waits until at least waiters threads are in Wait(), returns False on timeout."""
+        end = time.time() + timeout
+        with self._cond:
+            while len(self._waiters) < waiters:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+class Schedule(object):
+    """The deadlines of a task that runs every period seconds, see the module doc."""
+
+    def __init__(self, period, policy=SKIP, max_catch_up=MAX_CATCH_UP):
+        if policy not in POLICIES:
+            raise ValueError('unknown catch-up policy %r' % policy)
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.deadline = None
+
+    def Start(self, now):
+        """Sets the first deadline, the first run is due right away."""
+        self.deadline = now
+
+    def GetLateness(self, now):
+        """Seconds a run starting at now is behind its deadline."""
+        return max(0.0, now - self.deadline)
+
+    def Finished(self, end):
+        """Moves to the deadline of the next run after a run that ended at end.
+
+        Returns (missed, skipped): the deadlines that passed during the run
+        and of those, the ones that will not be run.
+        """
+        self.deadline += self.period
+        if self.deadline >= end:
+            return 0, 0
+        late = int(math.ceil((end - self.deadline) / float(self.period)))
+        if self.policy == SKIP:
+            self.deadline += late * self.period
+            return late, late
+        if self.policy == RESET:
+            self.deadline = end
+            return late, late - 1
+        # CATCH_UP: the next run is late, the ones beyond max_catch_up are
+        # dropped. The remaining late runs are counted when they are next.
+        skipped = max(0, late - self.max_catch_up)
+        self.deadline += skipped * self.period
+        return skipped + 1, skipped
@@ -0,0 +1,196 @@
+'''
+Tests for the deadline scheduler.
+'''
+import os
+import threading
+import time
+import unittest
+
+from fancontroller import scheduler
+from fancontroller.runtime import PeriodicTask, Runtime, TriggeredTask
+from fancontroller.scheduler import FakeClock, Schedule, Wakeup, SKIP, CATCH_UP, RESET
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def testOnTimeRunsDoNotDrift(self):
+        schedule = Schedule(5)
+        schedule.Start(100)
+        for i in range(1, 1000):
+            # Every run takes a bit of its slot.
+            self.assertEqual((0, 0), schedule.Finished(schedule.deadline + 0.3))
+        self.assertEqual(100 + 999 * 5, schedule.deadline)
+
+    def testSkip(self):
+        schedule = Schedule(5, SKIP)
+        schedule.Start(0)
+        # The first run stalled for 23s: deadlines 5, 10, 15 and 20 passed.
+        self.assertEqual((4, 4), schedule.Finished(23))
+        self.assertEqual(25, schedule.deadline)
+        self.assertEqual(2, schedule.GetLateness(27))
+
+    def testCatchUp(self):
+        schedule = Schedule(5, CATCH_UP, max_catch_up=3)
+        schedule.Start(0)
+        # 5 deadlines passed, the oldest 2 are dropped.
+        self.assertEqual((3, 2), schedule.Finished(27))
+        self.assertEqual(15, schedule.deadline)
+        self.assertEqual((1, 0), schedule.Finished(27.1))
+        self.assertEqual((1, 0), schedule.Finished(27.2))
+        # Back on the grid.
+        self.assertEqual((0, 0), schedule.Finished(27.3))
+        self.assertEqual(30, schedule.deadline)
+
+    def testReset(self):
+        schedule = Schedule(3600, RESET)
+        schedule.Start(0)
+        self.assertEqual((2, 1), schedule.Finished(9000))
+        self.assertEqual(9000, schedule.deadline)
+        self.assertEqual((0, 0), schedule.Finished(9001))
+        self.assertEqual(12600, schedule.deadline)
+
+    def testMonotonic(self):
+        times = [scheduler.Monotonic() for _ in range(1000)]
+        self.assertEqual(sorted(times), times)
+
+
+class FakeClockTest(unittest.TestCase):
+
+    def testStalledTask(self):
+        clock = FakeClock(1000)
+        starts = []
+
+        def Run():
+            starts.append(clock.Now())
+            if len(starts) == 3:
+                # An SD card stall, this run takes 3 periods.
+                clock.Advance(3)
+        task = PeriodicTask('sensors', Run, 1, clock=clock)
+        task.Start()
+        for _ in range(6):
+            self.assertTrue(clock.BlockUntil(1))
+            clock.Advance(1)
+        self.assertTrue(clock.BlockUntil(1))
+        task.Stop()
+        task.Join(1)
+        self.assertFalse(task._thread.is_alive())
+        # Deadlines 1003 and 1004 are skipped, the grid is kept.
+        self.assertEqual([1000, 1001, 1002, 1005, 1006, 1007, 1008, 1009], starts)
+        self.assertEqual(2, task.stats.missed)
+        self.assertEqual(2, task.stats.overruns)
+        self.assertEqual(8, task.stats.runs)
+        self.assertEqual(3, task.stats.max_latency)
+
+    def testFailedRunIsRetried(self):
+        clock = FakeClock()
+        starts = []
+
+        def Run():
+            starts.append(clock.Now())
+            if len(starts) <= 2 or clock.Now() >= 300:
+                raise IOError('forecast server down')
+        task = PeriodicTask('forecast', Run, 100, clock=clock, retry_delay=30)
+        task.Start()
+        for _ in range(40):
+            self.assertTrue(clock.BlockUntil(1))
+            clock.Advance(10)
+        self.assertTrue(clock.BlockUntil(1))
+        task.Stop()
+        task.Join(1)
+        self.assertFalse(task._thread.is_alive())
+        # Retries stop at the next deadline, which does not move.
+        self.assertEqual([0, 30, 60, 100, 200, 300, 330, 360, 390, 400], starts)
+        self.assertEqual(7, task.stats.errors)
+        self.assertEqual(0, task.stats.missed)
+
+    def testRuntimeTasksRunAtTheirOwnRates(self):
+        clock = FakeClock()
+
+        class Sensors(object):
+            reads = 0
+
+            def ReadAll(self):
+                Sensors.reads += 1
+                return None
+
+        class Uploader(object):
+            uploads = 0
+
+            def Upload(self, measurements):
+                Uploader.uploads += 1
+
+        runtime = Runtime([], Sensors(), uploader=Uploader(), period=5,
+                          sample_period=1, report_period=60, event_driven=False,
+                          clock=clock)
+        runtime.Start()
+        for _ in range(120):
+            self.assertTrue(clock.BlockUntil(len(runtime.tasks)))
+            clock.Advance(1)
+        self.assertTrue(clock.BlockUntil(len(runtime.tasks)))
+        runtime.Stop()
+        runtime.Join(1)
+        stats = runtime.GetStats()
+        self.assertEqual(121, stats['sensors'].runs)
+        self.assertEqual(25, stats['control'].runs)
+        self.assertEqual(3, stats['upload'].runs)
+        self.assertEqual(0, sum(s.missed for s in stats.values()))
+
+    def _WaitFor(self, condition):
+        end = time.time() + 5
+        while not condition() and time.time() < end:
+            time.sleep(0.001)
+        return condition()
+
+    def _Idle(self, clock, task):
+        """Whether task waits for its next slot, or ran and waits for a trigger."""
+        with clock._cond:
+            deadlines = [deadline for deadline, _ in clock._waiters]
+        if any(deadline < float('inf') for deadline in deadlines):
+            return True
+        return bool(deadlines) and not task._triggered.IsSet()
+
+    def testTriggeredTaskMinInterval(self):
+        clock = FakeClock()
+        starts = []
+        task = TriggeredTask('control', lambda: starts.append(clock.Now()),
+                             clock=clock, min_interval=5)
+        task.Start()
+        task.Trigger()
+        self.assertTrue(self._WaitFor(lambda: len(starts) == 1))
+        # Sensor reads every second trigger it, the runs stay 5s apart.
+        for _ in range(12):
+            clock.Advance(1)
+            task.Trigger()
+            self.assertTrue(self._WaitFor(lambda: self._Idle(clock, task)))
+        task.Stop()
+        task.Join(1)
+        self.assertFalse(task._thread.is_alive())
+        self.assertEqual([0, 5, 10], starts)
+
+    def testWaitDoesNotLeakDescriptors(self):
+        clock = FakeClock()
+        wakeup = Wakeup()
+        before = len(os.listdir('/proc/self/fd'))
+        for _ in range(100):
+            waiter = threading.Thread(target=clock.Wait, args=(wakeup, 1))
+            waiter.start()
+            self.assertTrue(clock.BlockUntil(1))
+            clock.Advance(1)
+            waiter.join(1)
+        self.assertEqual(before, len(os.listdir('/proc/self/fd')))
+
+    def testWaitReturnsWhenSet(self):
+        clock = FakeClock()
+        wakeup = Wakeup()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(clock.Wait(wakeup, 10)))
+        thread.start()
+        self.assertTrue(clock.BlockUntil(1))
+        wakeup.Set()
+        thread.join(1)
+        self.assertEqual([True], result)
+        self.assertEqual(0, clock.Now())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+'''
+1-Wire temperature sensors.
+
+A DS18B20 conversion takes ~750ms. Instead of letting every w1_slave read
+start its own conversion one sensor after the other, SensorBus triggers one
+bulk conversion for the whole bus through the w1_therm therm_bulk_read
+attribute and then reads all sensors concurrently. Sensor files are kept
+open and read into a reused buffer.
+'''
+import io
+import logging
+import threading
+import time
+
+BULK_READ_PATH = '/sys/bus/w1/devices/w1_bus_master1/therm_bulk_read'
+SENSOR_DIR = '/sensors/'
+# therm_bulk_read reads -1 while a conversion is in progress.
+_CONVERSION_POLL = 0.05
+_CONVERSION_TIMEOUT = 2.0
+
+
+class SensorBatch(object):
+    """Temperatures read in one pass, name -> C or None if the read failed."""
+
+    def __init__(self, timestamp, values):
+        self.timestamp = timestamp
+        self.values = values
+
+    def Get(self, name):
+        return self.values.get(name)
+
+
+class W1Sensor(object):
+    """Reads a w1_slave style file through a persistent handle."""
+    _BUFFER_SIZE = 128
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.failures = 0
+        self._file = None
+        self._buffer = bytearray(W1Sensor._BUFFER_SIZE)
+
+    def _Open(self):
+        if self._file is None:
+            self._file = io.FileIO(self.path, 'r')
+        return self._file
+
+    def Close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def Read(self):
+        """Returns the temperature in C, None if the sensor did not return a valid read."""
+        try:
+            sensor_file = self._Open()
+            sensor_file.seek(0)
+            size = sensor_file.readinto(self._buffer)
+        except (IOError, OSError) as e:
+            # The device may have gone away, reopen on the next read.
+            self.Close()
+            self.failures += 1
+            logging.warn('Failed to read sensor %s: %s', self.name, e)
+            return None
+        buf = self._buffer
+        newline = buf.find(b'\n', 0, size)
+        if newline < 3 or buf[newline - 3:newline] != b'YES':
+            self.failures += 1
+            logging.warn('Got non YES from sensor %s: %r', self.name,
+                         bytes(buf[:max(newline, 0)]))
+            return None
+        temp_pos = buf.find(b't=', newline, size)
+        if temp_pos == -1:
+            self.failures += 1
+            logging.warn('No t= in sensor %s read: %r', self.name, bytes(buf[newline:size]))
+            return None
+        end = buf.find(b'\n', temp_pos, size)
+        if end == -1:
+            end = size
+        temp_c = int(buf[temp_pos + 2:end]) / 1000.0
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('sensor %s=%f C', self.name, temp_c)
+        return temp_c
+
+
+class SensorBus(object):
+    """All the sensors on one 1-Wire bus.
+
+    sensors: dict of name -> w1_slave path.
+    bulk_read_path: the bus master's therm_bulk_read attribute, None to let
+      every read do its own conversion.
+    """
+
+    def __init__(self, sensors, bulk_read_path=BULK_READ_PATH):
+        self.sensors = [W1Sensor(name, path) for name, path in sorted(sensors.items())]
+        self._bulk_read_path = bulk_read_path
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def FromNames(names, sensor_dir=SENSOR_DIR, bulk_read_path=BULK_READ_PATH):
+        """Creates a bus for sensors linked as <sensor_dir>/<name>."""
+        return SensorBus(dict((name, sensor_dir + name) for name in names),
+                         bulk_read_path=bulk_read_path)
+
+    def TriggerConversion(self):
+        """Starts one conversion on all sensors and waits for it to finish.
+
+        Returns False if bulk reads are not available.
+        """
+        if not self._bulk_read_path:
+            return False
+        try:
+            with open(self._bulk_read_path, 'w') as bulk:
+                bulk.write('trigger\n')
+            deadline = time.time() + _CONVERSION_TIMEOUT
+            while time.time() < deadline:
+                with open(self._bulk_read_path, 'r') as bulk:
+                    if bulk.read().strip() != '-1':
+                        return True
+                time.sleep(_CONVERSION_POLL)
+            logging.warn('Bulk conversion timed out')
+        except IOError as e:
+            logging.warn('Bulk conversion not available: %s', e)
+            self._bulk_read_path = None
+        return False
+
+    def ReadAll(self):
+        """Reads all sensors, returns a SensorBatch."""
+        with self._lock:
+            timestamp = time.time()
+            self.TriggerConversion()
+            if len(self.sensors) == 1:
+                temperatures = [self.sensors[0].Read()]
+            else:
+                if self._pool is None:
+                    from multiprocessing.pool import ThreadPool
+                    self._pool = ThreadPool(len(self.sensors))
+                temperatures = self._pool.map(W1Sensor.Read, self.sensors)
+            return SensorBatch(timestamp, dict(
+                (sensor.name, temp) for sensor, temp in zip(self.sensors, temperatures)))
+
+    def GetFailureCount(self):
+        return sum(sensor.failures for sensor in self.sensors)
+
+    def Close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        for sensor in self.sensors:
+            sensor.Close()
@@ -0,0 +1,81 @@
+'''
+Tests for the 1-Wire sensor subsystem against a fake sysfs tree.
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from fancontroller.sensors import SensorBus, W1Sensor
+
+_GOOD = ('72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n'
+         '72 01 4b 46 7f ff 0e 10 57 t=%d\n')
+_BAD_CRC = ('72 01 4b 46 7f ff 0e 10 57 : crc=57 NO\n'
+            '72 01 4b 46 7f ff 0e 10 57 t=23125\n')
+
+
+class SensorBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'w1_bus_master1'))
+        self.bulk_read = os.path.join(self.root, 'w1_bus_master1', 'therm_bulk_read')
+        open(self.bulk_read, 'w').write('0\n')
+        self.sensors = {}
+        for name, serial in [('indoor_temp', '28-000001'), ('outdoor_temp', '28-000002')]:
+            os.mkdir(os.path.join(self.root, serial))
+            self.sensors[name] = os.path.join(self.root, serial, 'w1_slave')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        with open(self.sensors[name], 'w') as f:
+            f.write(content)
+
+    def testReadAll(self):
+        self.write('indoor_temp', _GOOD % 23125)
+        self.write('outdoor_temp', _GOOD % -1250)
+        bus = SensorBus(self.sensors, bulk_read_path=self.bulk_read)
+        self.addCleanup(bus.Close)
+        batch = bus.ReadAll()
+        self.assertEqual(23.125, batch.Get('indoor_temp'))
+        self.assertEqual(-1.25, batch.Get('outdoor_temp'))
+        self.assertEqual('trigger\n', open(self.bulk_read).read())
+        # Handles stay open and are re-read from the start.
+        handles = [sensor._file for sensor in bus.sensors]
+        self.write('indoor_temp', _GOOD % 5000)
+        batch = bus.ReadAll()
+        self.assertEqual(5.0, batch.Get('indoor_temp'))
+        self.assertEqual(handles, [sensor._file for sensor in bus.sensors])
+        self.assertEqual(0, bus.GetFailureCount())
+
+    def testBadReads(self):
+        self.write('indoor_temp', _BAD_CRC)
+        self.write('outdoor_temp', '72 01 : crc=57 YES\n72 01 4b\n')
+        bus = SensorBus(self.sensors, bulk_read_path=None)
+        self.addCleanup(bus.Close)
+        batch = bus.ReadAll()
+        self.assertIsNone(batch.Get('indoor_temp'))
+        self.assertIsNone(batch.Get('outdoor_temp'))
+        self.assertEqual(2, bus.GetFailureCount())
+
+    def testMissingSensorReopens(self):
+        sensor = W1Sensor('indoor_temp', self.sensors['indoor_temp'])
+        self.assertIsNone(sensor.Read())
+        self.write('indoor_temp', _GOOD % 21000)
+        self.assertEqual(21.0, sensor.Read())
+        self.assertEqual(1, sensor.failures)
+        sensor.Close()
+
+    def testMissingBulkReadFallsBack(self):
+        self.write('indoor_temp', _GOOD % 23125)
+        bus = SensorBus({'indoor_temp': self.sensors['indoor_temp']},
+                        bulk_read_path=os.path.join(self.root, 'missing', 'therm_bulk_read'))
+        self.addCleanup(bus.Close)
+        self.assertEqual(23.125, bus.ReadAll().Get('indoor_temp'))
+        self.assertIsNone(bus._bulk_read_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
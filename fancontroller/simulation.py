@@ -0,0 +1,257 @@
+'''
+Simulation engine for running the Thermostat against a thermal model of the
+house.
+
+The per-step path (Thermostat + MedianFilter + PID) is what runs on the Pi,
+but it is far too slow for long or high resolution runs. Simulator runs the
+same decision logic as Thermostat._RecomputeState over whole NumPy arrays of
+outdoor temperature: everything that does not depend on the indoor
+temperature (outside median, outside based target) is computed up front and
+only the closed loop part is stepped.
+'''
+import bisect
+from collections import deque
+from math import ceil
+
+import numpy as np
+
+from fancontroller.fan_controller import Thermostat, _FanController, STATE_OFF, STATE_ON
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.filters import MedianFilter
+
+
+class PlantModel(object):
+    """Thermal model of the house.
+
+    Without the fan the inside warms up at a constant rate, with the fan on it
+    cools down proportionally to the fan speed (the pid value the fan runs at).
+    """
+
+    def __init__(self, temp_increase_per_minute=0.03,
+                 fan_temp_decrease_per_minute=0.1):
+        self.temp_increase_per_minute = temp_increase_per_minute
+        self.fan_temp_decrease_per_minute = fan_temp_decrease_per_minute
+
+    def Step(self, indoor, fan_speed, step):
+        """Returns the indoor temperature step seconds later."""
+        steps_per_minute = 60.0 / step
+        if fan_speed:
+            return indoor - (fan_speed * self.fan_temp_decrease_per_minute) / steps_per_minute
+        return indoor + self.temp_increase_per_minute / steps_per_minute
+
+
+class SimulationResult(object):
+    """Traces produced by a simulation, one entry per outdoor sample.
+
+    outdoor_median is NaN until the outside window has filled up. state is
+    the state the thermostat asked for, which the fan does not follow while
+    a change is suppressed as flapping; fan is the state the fan was in and
+    drives the plant.
+    """
+
+    def __init__(self, indoor, outdoor_median, state, pid, target, state_changes,
+                 flapping_suppressed=0, fan=None):
+        self.indoor = indoor
+        self.outdoor_median = outdoor_median
+        self.state = state
+        self.pid = pid
+        self.target = target
+        self.state_changes = state_changes
+        self.flapping_suppressed = flapping_suppressed
+        self.fan = state if fan is None else fan
+
+
+class Simulator(object):
+    """Runs a Thermostat against a PlantModel.
+
+    Run() can be called repeatedly with consecutive chunks of outdoor
+    temperatures, all filter, PID and fan state carries over between calls.
+    """
+
+    def __init__(self, target_temp,
+                 step=10.0,
+                 initial_indoor=80.0,
+                 outside_window=Thermostat.WINDOW,
+                 inside_window=Thermostat.WINDOW,
+                 hysteresis=Thermostat.HYSTERESIS,
+                 min_outside_diff=Thermostat.MIN_OUTSIDE_DIFF,
+                 pid_gains=Thermostat.PID_GAINS,
+                 plant=None,
+                 min_update_delay=_FanController._MIN_UPDATE_DELAY):
+        self._target_temp = target_temp
+        self._step = step
+        self._hysteresis = hysteresis
+        self._min_outside_diff = min_outside_diff
+        self._plant = plant or PlantModel()
+        self._outside = MedianFilter(outside_window)
+        # The inside window is fed back through the plant so it is stepped
+        # inline, same semantics as MedianFilter.
+        self._inside_window = int(inside_window)
+        self._inside_queue = deque()
+        self._inside_sorted = []
+        self.indoor = initial_indoor
+        # Mirrors discretepid.PID after Thermostat.__init__.
+        self._kp, self._ki, self._kd = pid_gains
+        self._integrator_max = 500
+        self._integrator_min = -500
+        self._set_point = target_temp
+        self._integrator = 0
+        self._derivator = 0
+        self._fan_state = STATE_OFF
+        # Speed the fan runs at, 0 while it is off.
+        self._fan_speed = 0
+        self.pid = 0
+        self.state_changes = 0
+        # Seconds simulated so far and of the last fan change, for the
+        # flapping check of _FanController.
+        self._min_update_delay = min_update_delay
+        self._time = 0.0
+        self._last_update = float('-inf')
+        self.flapping_suppressed = 0
+
+    def Run(self, outdoor):
+        """Simulates one sample per outdoor temperature, returns a SimulationResult."""
+        outdoor = np.asarray(outdoor, dtype=float)
+        n = len(outdoor)
+        outdoor_median = self._outside.rollingMedian(outdoor)
+        # Target temp depends on outside temp, see Thermostat._RecomputeState.
+        base_target = np.maximum(self._target_temp,
+                                 outdoor_median + self._min_outside_diff)
+        ready = (~np.isnan(base_target)).tolist()
+        base_target = base_target.tolist()
+
+        indoor_trace = [0.0] * n
+        state_trace = [STATE_OFF] * n
+        fan_trace = [STATE_OFF] * n
+        pid_trace = [0] * n
+        target_trace = [0.0] * n
+
+        half_hysteresis = self._hysteresis / 2.0
+        steps_per_minute = 60.0 / self._step
+        increase = self._plant.temp_increase_per_minute / steps_per_minute
+        decrease = self._plant.fan_temp_decrease_per_minute
+        kp, ki, kd = self._kp, self._ki, self._kd
+        integrator_max, integrator_min = self._integrator_max, self._integrator_min
+        set_point = self._set_point
+        integrator = self._integrator
+        derivator = self._derivator
+        fan_state = self._fan_state
+        fan_speed = self._fan_speed
+        pid = self.pid
+        state_changes = self.state_changes
+        indoor = self.indoor
+        step = self._step
+        start_time = self._time
+        min_update_delay = self._min_update_delay
+        last_update = self._last_update
+        flapping_suppressed = self.flapping_suppressed
+
+        inside_window = self._inside_window
+        inside_queue = self._inside_queue
+        inside_sorted = self._inside_sorted
+        insort = bisect.insort
+        bisect_left = bisect.bisect_left
+
+        for i in range(n):
+            if len(inside_queue) == inside_window:
+                del inside_sorted[bisect_left(inside_sorted, inside_queue.popleft())]
+            inside_queue.append(indoor)
+            insort(inside_sorted, indoor)
+            indoor_trace[i] = indoor
+            if ready[i] and len(inside_queue) == inside_window:
+                inside = inside_sorted[inside_window // 2]
+                if fan_state == STATE_OFF:
+                    target = base_target[i] + half_hysteresis
+                else:
+                    target = base_target[i] - half_hysteresis
+                if target != set_point:
+                    set_point = target
+                    integrator = 0
+                    derivator = 0
+                # Same operation order as PID.update.
+                error = set_point - inside
+                p_value = kp * error
+                d_value = kd * (error - derivator)
+                derivator = error
+                integrator = integrator + error
+                if integrator > integrator_max:
+                    integrator = integrator_max
+                elif integrator < integrator_min:
+                    integrator = integrator_min
+                pid = max(0, min(1, ceil((p_value + integrator * ki + d_value) * 10) / 10.0))
+                new_state = STATE_ON if pid else STATE_OFF
+                if new_state != fan_state:
+                    now = start_time + i * step
+                    if now - last_update < min_update_delay:
+                        flapping_suppressed += 1
+                    else:
+                        fan_state = new_state
+                        fan_speed = pid
+                        state_changes += 1
+                        last_update = now
+                elif fan_state == STATE_ON:
+                    # Speed changes of a running fan are never suppressed.
+                    fan_speed = pid
+                state_trace[i] = new_state
+            fan_trace[i] = fan_state
+            pid_trace[i] = pid
+            target_trace[i] = set_point
+            if fan_speed:
+                indoor = indoor - (fan_speed * decrease) / steps_per_minute
+            else:
+                indoor = indoor + increase
+
+        self._set_point = set_point
+        self._integrator = integrator
+        self._derivator = derivator
+        self._fan_state = fan_state
+        self._fan_speed = fan_speed
+        self.pid = pid
+        self.state_changes = state_changes
+        self.indoor = indoor
+        self._time = start_time + n * step
+        self._last_update = last_update
+        self.flapping_suppressed = flapping_suppressed
+        return SimulationResult(np.array(indoor_trace), outdoor_median,
+                                np.array(state_trace), np.array(pid_trace, dtype=float),
+                                np.array(target_trace, dtype=float), state_changes,
+                                flapping_suppressed, np.array(fan_trace))
+
+
+def Simulate(outdoor, target_temp, **kwargs):
+    """Runs a single simulation over outdoor, see Simulator for the arguments."""
+    return Simulator(target_temp, **kwargs).Run(outdoor)
+
+
+def SimulatePerStep(outdoor, target_temp, step=10.0, initial_indoor=80.0,
+                    plant=None, **thermostat_kwargs):
+    """Reference implementation stepping a real Thermostat one sample at a time."""
+    plant = plant or PlantModel()
+    thermostat = Thermostat(target_temp, gpio=FakeFanGpio(), **thermostat_kwargs)
+    # The fan's flapping check runs on simulated time, starting long after
+    # the fan's last change like on a real clock.
+    clock = [_FanController._MIN_UPDATE_DELAY]
+    thermostat._fc._GetTime = lambda: clock[0]
+    n = len(outdoor)
+    indoor = np.zeros(n)
+    outdoor_median = np.zeros(n)
+    state = np.zeros(n, dtype=int)
+    fan = np.zeros(n, dtype=int)
+    pid = np.zeros(n)
+    target = np.zeros(n)
+    current = initial_indoor
+    for i in range(n):
+        indoor[i] = current
+        thermostat.RecordIndoorMeasurement(current)
+        thermostat.RecordOutdoorMeasurement(outdoor[i])
+        median = thermostat._outside_temp.getMedian()
+        outdoor_median[i] = np.nan if median is None else median
+        state[i] = thermostat.ControlLoop()
+        pid[i] = thermostat.pid
+        target[i] = thermostat.p.getPoint()
+        fan[i] = thermostat.GetState()
+        current = plant.Step(current, thermostat._fc._speed if fan[i] else 0, step)
+        clock[0] += step
+    return SimulationResult(indoor, outdoor_median, state, pid, target,
+                            thermostat.GetStateChangeCount(),
+                            thermostat.GetFlappingSuppressedCount(), fan)
@@ -0,0 +1,88 @@
+'''
+Tests for the vectorized simulation engine.
+'''
+import unittest
+
+import numpy as np
+
+from fancontroller.simulation import Simulate, SimulatePerStep, Simulator, PlantModel
+
+
+def _Outdoor(hours, step, seed=0):
+    t = np.arange(0, hours * 3600, step)
+    noise = np.random.RandomState(seed).randint(-5, 5, len(t)) / 10.0
+    return 70 + 13 * np.cos(2 * np.pi * t / (24 * 3600)) + noise
+
+
+class SimulatorTest(unittest.TestCase):
+    KWARGS = dict(step=60.0, initial_indoor=80.0, outside_window=10,
+                  inside_window=3, hysteresis=0.5, min_outside_diff=2)
+
+    def assertSameTraces(self, expected, actual):
+        np.testing.assert_array_equal(expected.indoor, actual.indoor)
+        np.testing.assert_array_equal(expected.outdoor_median, actual.outdoor_median)
+        np.testing.assert_array_equal(expected.state, actual.state)
+        np.testing.assert_array_equal(expected.fan, actual.fan)
+        np.testing.assert_array_equal(expected.pid, actual.pid)
+        np.testing.assert_array_equal(expected.target, actual.target)
+        self.assertEqual(expected.state_changes, actual.state_changes)
+        self.assertEqual(expected.flapping_suppressed, actual.flapping_suppressed)
+
+    def testMatchesPerStep(self):
+        outdoor = _Outdoor(48, 60.0)
+        expected = SimulatePerStep(outdoor, 72, **self.KWARGS)
+        actual = Simulate(outdoor, 72, **self.KWARGS)
+        self.assertGreater(actual.state_changes, 0)
+        self.assertSameTraces(expected, actual)
+
+    def testMatchesPerStep_WindowOfOne(self):
+        outdoor = _Outdoor(24, 60.0, seed=1)
+        kwargs = dict(self.KWARGS, outside_window=1, inside_window=1,
+                      plant=PlantModel(0.05, 0.2))
+        self.assertSameTraces(SimulatePerStep(outdoor, 72, **kwargs),
+                              Simulate(outdoor, 72, **kwargs))
+
+    def testMatchesPerStep_PidGains(self):
+        outdoor = _Outdoor(24, 60.0, seed=2)
+        kwargs = dict(self.KWARGS, pid_gains=(-1.0, -0.03, -1.0))
+        self.assertSameTraces(SimulatePerStep(outdoor, 72, **kwargs),
+                              Simulate(outdoor, 72, **kwargs))
+
+    def testMatchesPerStep_Flapping(self):
+        # Changes less than a minute apart are suppressed.
+        outdoor = _Outdoor(12, 10.0, seed=3)
+        kwargs = dict(self.KWARGS, step=10.0, outside_window=1, inside_window=1,
+                      hysteresis=0, min_outside_diff=0)
+        expected = SimulatePerStep(outdoor, 72, **kwargs)
+        self.assertGreater(expected.flapping_suppressed, 0)
+        self.assertSameTraces(expected, Simulate(outdoor, 72, **kwargs))
+
+    def testSuppressedChangeDoesNotDriveThePlant(self):
+        outdoor = _Outdoor(12, 10.0, seed=3)
+        kwargs = dict(self.KWARGS, step=10.0, outside_window=1, inside_window=1,
+                      hysteresis=0, min_outside_diff=0)
+        result = Simulate(outdoor, 72, **kwargs)
+        warming = np.diff(result.indoor) > 0
+        suppressed_on = (result.state[:-1] == 1) & (result.fan[:-1] == 0)
+        self.assertTrue(suppressed_on.any())
+        # The fan stayed off, so the house kept warming up.
+        self.assertTrue(warming[suppressed_on].all())
+        np.testing.assert_array_equal(warming, result.fan[:-1] == 0)
+
+    def testChunkedRun(self):
+        outdoor = _Outdoor(48, 60.0)
+        expected = Simulate(outdoor, 72, **self.KWARGS)
+        simulator = Simulator(72, **self.KWARGS)
+        chunks = [simulator.Run(chunk) for chunk in np.array_split(outdoor, 7)]
+        self.assertEqual(expected.state_changes, simulator.state_changes)
+        self.assertEqual(expected.flapping_suppressed, simulator.flapping_suppressed)
+        np.testing.assert_array_equal(expected.indoor,
+                                      np.concatenate([c.indoor for c in chunks]))
+        np.testing.assert_array_equal(expected.pid,
+                                      np.concatenate([c.pid for c in chunks]))
+        np.testing.assert_array_equal(expected.fan,
+                                      np.concatenate([c.fan for c in chunks]))
+
+
+if __name__ == "__main__":
+    unittest.main()
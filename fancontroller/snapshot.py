@@ -0,0 +1,137 @@
+'''
+Snapshots of the controller state for warm restarts.
+
+The runtime periodically writes every zone's median filter windows, PID
+state, fan state and last fan update to a small binary file, replacing it
+atomically. On startup a snapshot that is recent enough is restored, so the
+controller does not run blind until the filter windows refill and the fan
+is not switched off and on again by the restart.
+'''
+import logging
+import os
+import struct
+import time
+import zlib
+
+SNAPSHOT_FILE = '/var/tmp/fancontroller-snapshot.bin'
+# Snapshots older than this are ignored, in seconds.
+MAX_AGE = 900
+PERIOD = 60
+
+MAGIC = b'FCSNAP01'
+VERSION = 1
+# magic, version, timestamp, zone count.
+_HEADER = struct.Struct('<8sHdI')
+# fan state, last update, state changes, set point, integrator, derivator,
+# pid, inside sum, outside sum.
+_ZONE = struct.Struct('<BdIdddddd')
+_LENGTH = struct.Struct('<I')
+_CRC = struct.Struct('<I')
+
+
+def Capture(zones):
+    """Returns the state of zones as a dict of zone name to Thermostat.GetSnapshot()."""
+    return dict((zone.name, zone.thermostat.GetSnapshot()) for zone in zones)
+
+
+def Encode(states, timestamp):
+    parts = [_HEADER.pack(MAGIC, VERSION, timestamp, len(states))]
+    for name in sorted(states):
+        state = states[name]
+        encoded_name = name.encode('utf-8')
+        parts.append(_LENGTH.pack(len(encoded_name)))
+        parts.append(encoded_name)
+        parts.append(_ZONE.pack(state['fan_state'], state['last_update'],
+                                state['state_changes'], state['set_point'],
+                                state['integrator'], state['derivator'],
+                                state['pid'], state['inside_sum'],
+                                state['outside_sum']))
+        for values in (state['inside'], state['outside']):
+            parts.append(_LENGTH.pack(len(values)))
+            parts.append(struct.pack('<%dd' % len(values), *values))
+    data = b''.join(parts)
+    return data + _CRC.pack(zlib.crc32(data) & 0xffffffff)
+
+
+def Decode(data):
+    """Returns (timestamp, states), raises ValueError if data is not a valid snapshot."""
+    if len(data) < _HEADER.size + _CRC.size:
+        raise ValueError('snapshot too short')
+    body, crc = data[:-_CRC.size], _CRC.unpack(data[-_CRC.size:])[0]
+    if zlib.crc32(body) & 0xffffffff != crc:
+        raise ValueError('snapshot checksum mismatch')
+    magic, version, timestamp, count = _HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a version %d snapshot' % VERSION)
+    offset = _HEADER.size
+    states = {}
+    try:
+        for _ in range(count):
+            length = _LENGTH.unpack_from(body, offset)[0]
+            offset += _LENGTH.size
+            name = body[offset:offset + length].decode('utf-8')
+            offset += length
+            (fan_state, last_update, state_changes, set_point, integrator,
+             derivator, pid, inside_sum, outside_sum) = _ZONE.unpack_from(body, offset)
+            offset += _ZONE.size
+            windows = []
+            for _ in range(2):
+                length = _LENGTH.unpack_from(body, offset)[0]
+                offset += _LENGTH.size
+                windows.append(list(struct.unpack_from('<%dd' % length, body, offset)))
+                offset += length * 8
+            states[name] = {'fan_state': fan_state,
+                            'last_update': last_update,
+                            'state_changes': state_changes,
+                            'set_point': set_point,
+                            'integrator': integrator,
+                            'derivator': derivator,
+                            'pid': pid,
+                            'inside': windows[0],
+                            'inside_sum': inside_sum,
+                            'outside': windows[1],
+                            'outside_sum': outside_sum}
+    except struct.error as e:
+        raise ValueError('truncated snapshot: %s' % e)
+    return timestamp, states
+
+
+def Write(path, states, timestamp=None):
+    """Atomically replaces path with a snapshot of states (see Capture())."""
+    if timestamp is None:
+        timestamp = time.time()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(Encode(states, timestamp))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def Load(path, max_age=MAX_AGE, now=None):
+    """Returns the states saved in path, None if there is no valid, recent snapshot."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            timestamp, states = Decode(f.read())
+    except (IOError, ValueError) as e:
+        logging.warn('Ignoring bad snapshot %s: %s', path, e)
+        return None
+    age = (time.time() if now is None else now) - timestamp
+    # A snapshot from the future means the clock is not set yet (no RTC on
+    # the Pi), its age can not be trusted.
+    if not 0 <= age <= max_age:
+        logging.warn('Ignoring snapshot %s, %.0f seconds old', path, age)
+        return None
+    return states
+
+
+def Restore(zones, states):
+    """Restores the zones found in states, returns the names of the restored zones."""
+    restored = []
+    for zone in zones:
+        if zone.name in states:
+            zone.thermostat.RestoreSnapshot(states[zone.name])
+            restored.append(zone.name)
+    return restored
@@ -0,0 +1,93 @@
+'''
+Tests for controller snapshots.
+'''
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from fancontroller import Thermostat, STATE_ON
+from fancontroller import snapshot
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.runtime import Runtime
+from fancontroller.zones import Zone
+
+
+def _Zone(name='default', gpio=None, fan_state=0):
+    thermostat = Thermostat(22.5, outside_window=5, inside_window=5, hysteresis=0.5,
+                            min_outside_diff=0.5, pid_gains=(-1.5, -0.03, -1),
+                            gpio=gpio or FakeFanGpio(), fan_state=fan_state)
+    return Zone(name, thermostat, 'indoor_temp', 'outdoor_temp')
+
+
+def _Step(thermostat, rand):
+    thermostat.RecordIndoorMeasurement(rand.uniform(20, 26))
+    thermostat.RecordOutdoorMeasurement(rand.uniform(10, 25))
+    thermostat.ControlLoop()
+    return (thermostat.pid, thermostat.p.getPoint(), thermostat.GetState(),
+            thermostat._inside_temp.getAverage())
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testRestoredThermostatContinuesExactly(self):
+        rand = random.Random(3)
+        original = _Zone()
+        for _ in range(50):
+            _Step(original.thermostat, rand)
+        snapshot.Write(self.path, snapshot.Capture([original]))
+        states = snapshot.Load(self.path)
+        restored = _Zone(fan_state=states['default']['fan_state'])
+        self.assertEqual(['default'], snapshot.Restore([restored], states))
+        # Both see the same measurements from here on.
+        state = rand.getstate()
+        expected = [_Step(original.thermostat, rand) for _ in range(50)]
+        rand.setstate(state)
+        actual = [_Step(restored.thermostat, rand) for _ in range(50)]
+        self.assertEqual(expected, actual)
+
+    def testFanIsNotSwitchedOffOnRestart(self):
+        gpio = FakeFanGpio()
+        zone = _Zone(gpio=gpio, fan_state=STATE_ON)
+        self.assertEqual(1, gpio.level)
+        self.assertEqual(STATE_ON, zone.thermostat.GetState())
+        states = {'default': zone.thermostat.GetSnapshot()}
+        snapshot.Restore([zone], states)
+        self.assertEqual(1, gpio.writes)
+
+    def testStaleOrBadSnapshotsAreIgnored(self):
+        zone = _Zone()
+        snapshot.Write(self.path, snapshot.Capture([zone]), timestamp=time.time() - 1000)
+        self.assertIsNone(snapshot.Load(self.path, max_age=900))
+        self.assertIsNotNone(snapshot.Load(self.path, max_age=1100))
+        # From the future, the clock is not set yet.
+        snapshot.Write(self.path, snapshot.Capture([zone]), timestamp=time.time() + 1000)
+        self.assertIsNone(snapshot.Load(self.path))
+        snapshot.Write(self.path, snapshot.Capture([zone]))
+        with open(self.path, 'r+b') as f:
+            f.seek(20)
+            f.write(b'\xff')
+        self.assertIsNone(snapshot.Load(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'short')
+        self.assertIsNone(snapshot.Load(self.path))
+        self.assertIsNone(snapshot.Load(os.path.join(self.dir, 'missing')))
+
+    def testRuntimeSavesSnapshot(self):
+        zones = [_Zone('living'), _Zone('bedroom')]
+        runtime = Runtime(zones, None, snapshot_path=self.path)
+        runtime.SaveSnapshot()
+        self.assertEqual(['bedroom', 'living'], sorted(snapshot.Load(self.path)))
+
+
+if __name__ == "__main__":
+    unittest.main()
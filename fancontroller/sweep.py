@@ -0,0 +1,198 @@
+'''
+Parameter sweep tuner for the Thermostat.
+
+Runs the simulation engine for every combination of a grid (or for random
+samples from ranges) of thermostat parameters across a process pool, scores
+each run and writes a ranked results table.
+
+Example:
+  PYTHONPATH=. python fancontroller/sweep.py \
+      --grid hysteresis=0.25,0.5,1 --grid kp=-1,-1.5,-3 \
+      --output sweep.csv
+'''
+import argparse
+import csv
+import itertools
+import logging
+import multiprocessing
+import random
+import sys
+
+import numpy as np
+
+from fancontroller.fan_controller import Thermostat
+from fancontroller.simulation import Simulate, PlantModel
+
+# Parameter name -> type, default. Windows are in samples like Thermostat.
+PARAMETERS = [
+    ('target_temp', float, 72.0),
+    ('hysteresis', float, 0.5),
+    ('min_outside_diff', float, 2.0),
+    ('outside_window', int, 60),
+    ('inside_window', int, 6),
+    ('kp', float, Thermostat.PID_GAINS[0]),
+    ('ki', float, Thermostat.PID_GAINS[1]),
+    ('kd', float, Thermostat.PID_GAINS[2]),
+]
+_TYPES = dict((name, kind) for name, kind, _ in PARAMETERS)
+DEFAULTS = dict((name, default) for name, _, default in PARAMETERS)
+
+METRICS = ['changes_per_hour', 'out_of_band', 'fan_runtime', 'score']
+
+
+class Weights(object):
+    """Weights of the individual metrics in the combined score (lower is better)."""
+
+    def __init__(self, changes_per_hour=1.0, out_of_band=10.0, fan_runtime=1.0):
+        self.changes_per_hour = changes_per_hour
+        self.out_of_band = out_of_band
+        self.fan_runtime = fan_runtime
+
+
+def GridSearch(grid):
+    """Yields one parameter dict per combination of the values in grid."""
+    names = sorted(grid)
+    for values in itertools.product(*[grid[name] for name in names]):
+        params = dict(DEFAULTS)
+        params.update(zip(names, values))
+        yield params
+
+
+def RandomSearch(ranges, samples, seed=None):
+    """Yields samples parameter dicts drawn uniformly from ranges (name -> (low, high))."""
+    rng = random.Random(seed)
+    for _ in range(samples):
+        params = dict(DEFAULTS)
+        for name, (low, high) in ranges.items():
+            if _TYPES[name] is int:
+                params[name] = rng.randint(int(low), int(high))
+            else:
+                params[name] = rng.uniform(low, high)
+        yield params
+
+
+def Evaluate(params, outdoor, step, initial_indoor, band, plant, weights):
+    """Simulates one parameter set and returns params extended with its metrics.
+
+    out_of_band is the fraction of time the indoor temperature is more than
+    band / 2 away from target_temp, fan_runtime the fraction of time the fan
+    is on.
+    """
+    result = Simulate(outdoor, params['target_temp'],
+                      step=step,
+                      initial_indoor=initial_indoor,
+                      outside_window=params['outside_window'],
+                      inside_window=params['inside_window'],
+                      hysteresis=params['hysteresis'],
+                      min_outside_diff=params['min_outside_diff'],
+                      pid_gains=(params['kp'], params['ki'], params['kd']),
+                      plant=plant)
+    hours = len(outdoor) * step / 3600.0
+    row = dict(params)
+    row['changes_per_hour'] = result.state_changes / hours
+    row['out_of_band'] = float(np.mean(
+        np.abs(result.indoor - params['target_temp']) > band / 2.0))
+    row['fan_runtime'] = float(np.mean(result.fan))
+    row['score'] = (weights.changes_per_hour * row['changes_per_hour'] +
+                    weights.out_of_band * row['out_of_band'] +
+                    weights.fan_runtime * row['fan_runtime'])
+    return row
+
+
+# Per worker process state, set once by _InitWorker so the outdoor trace is
+# not pickled with every task.
+_worker_args = None
+
+
+def _InitWorker(*args):
+    global _worker_args
+    _worker_args = args
+
+
+def _EvaluateInWorker(params):
+    return Evaluate(params, *_worker_args)
+
+
+def RunSweep(param_sets, outdoor, step, initial_indoor=80.0, band=1.0,
+             plant=None, weights=None, processes=None):
+    """Evaluates all param_sets on a process pool, returns rows ranked by score."""
+    args = (np.asarray(outdoor, dtype=float), step, initial_indoor, band,
+            plant or PlantModel(), weights or Weights())
+    pool = multiprocessing.Pool(processes, initializer=_InitWorker, initargs=args)
+    try:
+        rows = list(pool.imap_unordered(_EvaluateInWorker, param_sets, chunksize=4))
+    finally:
+        pool.close()
+        pool.join()
+    rows.sort(key=lambda row: row['score'])
+    return rows
+
+
+def WriteTable(rows, out):
+    """Writes the ranked rows as csv."""
+    writer = csv.writer(out)
+    writer.writerow(['rank'] + [name for name, _, _ in PARAMETERS] + METRICS)
+    for rank, row in enumerate(rows, 1):
+        writer.writerow([rank] + [row[name] for name, _, _ in PARAMETERS] +
+                        ['%.4f' % row[metric] for metric in METRICS])
+
+
+def SyntheticOutdoor(days, step, seed=None):
+    """Daily cosine outdoor temperature with noise, as in fan_controller_testplot."""
+    t = np.arange(0, days * 24 * 3600, step)
+    noise = np.random.RandomState(seed).randint(-5, 5, len(t)) / 10.0
+    return 70 + 13 * np.cos(2 * np.pi * t / (24 * 3600)) + noise
+
+
+def _ParseAssignment(text):
+    name, _, values = text.partition('=')
+    if name not in _TYPES:
+        raise argparse.ArgumentTypeError('unknown parameter %s' % name)
+    return name, values
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--grid', action='append', default=[], type=_ParseAssignment,
+                        help='name=v1,v2,... values to sweep over')
+    parser.add_argument('--range', action='append', default=[], type=_ParseAssignment,
+                        help='name=low:high range for random search')
+    parser.add_argument('--samples', type=int, default=0,
+                        help='number of random samples, enables random search')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--days', type=float, default=3)
+    parser.add_argument('--step', type=float, default=10.0)
+    parser.add_argument('--outdoor', help='text file with one outdoor temp per step')
+    parser.add_argument('--band', type=float, default=1.0,
+                        help='width of the acceptable band around target_temp')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes, default is one per core')
+    parser.add_argument('--output', help='csv file for the ranked table, default stdout')
+    args = parser.parse_args(argv)
+
+    if args.samples:
+        ranges = dict((name, tuple(float(v) for v in values.split(':')))
+                      for name, values in args.range)
+        param_sets = list(RandomSearch(ranges, args.samples, seed=args.seed))
+    else:
+        grid = dict((name, [_TYPES[name](v) for v in values.split(',')])
+                    for name, values in args.grid)
+        param_sets = list(GridSearch(grid))
+    if args.outdoor:
+        outdoor = np.loadtxt(args.outdoor)
+    else:
+        outdoor = SyntheticOutdoor(args.days, args.step, seed=args.seed)
+
+    logging.info('Running %d simulations of %d steps', len(param_sets), len(outdoor))
+    rows = RunSweep(param_sets, outdoor, args.step, band=args.band,
+                    processes=args.processes)
+    if args.output:
+        with open(args.output, 'wb') as out:
+            WriteTable(rows, out)
+    else:
+        WriteTable(rows, sys.stdout)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,65 @@
+'''
+Tests for the parameter sweep tuner.
+'''
+import StringIO
+import unittest
+
+import numpy as np
+
+from fancontroller import sweep
+from fancontroller.simulation import Simulate, PlantModel
+
+
+class SweepTest(unittest.TestCase):
+
+    def testGridSearch(self):
+        param_sets = list(sweep.GridSearch({'hysteresis': [0.5, 1],
+                                            'kp': [-1, -2, -3]}))
+        self.assertEqual(6, len(param_sets))
+        self.assertEqual(sweep.DEFAULTS['target_temp'], param_sets[0]['target_temp'])
+        self.assertEqual(set([(0.5, -1), (0.5, -2), (0.5, -3), (1, -1), (1, -2), (1, -3)]),
+                         set((p['hysteresis'], p['kp']) for p in param_sets))
+
+    def testRandomSearch(self):
+        param_sets = list(sweep.RandomSearch({'inside_window': (1, 10),
+                                              'hysteresis': (0, 2)}, 20, seed=1))
+        self.assertEqual(20, len(param_sets))
+        for params in param_sets:
+            self.assertIsInstance(params['inside_window'], int)
+            self.assertTrue(1 <= params['inside_window'] <= 10)
+            self.assertTrue(0 <= params['hysteresis'] <= 2)
+
+    def testRunSweep(self):
+        outdoor = sweep.SyntheticOutdoor(1, 60.0, seed=0)
+        param_sets = list(sweep.GridSearch({'hysteresis': [0.0, 0.5, 2.0]}))
+        rows = sweep.RunSweep(param_sets, outdoor, 60.0, processes=2)
+        self.assertEqual(3, len(rows))
+        self.assertEqual(sorted(row['score'] for row in rows),
+                         [row['score'] for row in rows])
+        for row in rows:
+            self.assertTrue(0 <= row['fan_runtime'] <= 1)
+            self.assertTrue(0 <= row['out_of_band'] <= 1)
+        out = StringIO.StringIO()
+        sweep.WriteTable(rows, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[1].startswith('1,'))
+
+    def testEvaluate_FanRuntimeCountsTheAppliedState(self):
+        # Without hysteresis on a 10s step some changes are suppressed as
+        # flapping, so the fan is not always in the requested state.
+        params = dict(sweep.DEFAULTS, hysteresis=0.0, min_outside_diff=0.0,
+                      outside_window=1, inside_window=1)
+        outdoor = sweep.SyntheticOutdoor(0.5, 10.0, seed=3)
+        row = sweep.Evaluate(params, outdoor, 10.0, 80.0, 1.0, PlantModel(),
+                             sweep.Weights())
+        result = Simulate(outdoor, params['target_temp'], step=10.0,
+                          outside_window=1, inside_window=1, hysteresis=0.0,
+                          min_outside_diff=0.0)
+        self.assertGreater(result.flapping_suppressed, 0)
+        self.assertNotEqual(np.mean(result.state), np.mean(result.fan))
+        self.assertEqual(np.mean(result.fan), row['fan_runtime'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+'''
+System identification and thermostat tuning from the recorded history.
+
+Fits the thermal model of fancontroller.planner to the history store by
+least squares over FIT_STEP bins,
+
+  d indoor / dt = leak * (outdoor - indoor) + gain + fan * speed * (outdoor - indoor)
+
+so both the heat gain with the fan off and the fan's cooling depend on how
+much cooler it is outside. speed is the fan state, or the pid output for PWM
+fans. From the model at the typical outdoor differences of the history it
+derives:
+
+  kp              the fan speed of a proportional controller that closes
+                  the loop with a closed_loop time constant
+  hysteresis      a full fan cycle (cool down, warm up) takes at least min_cycle
+  inside_window   the median filter's lag costs at most a quarter of hysteresis
+                  while the fan cools
+  outside_window  the lag costs at most half of min_outside_diff while the
+                  outside temperature changes at its 95th percentile rate
+
+ki and kd stay 0: the house integrates the fan's cooling, so a P controller
+settles without an integrator, and with only a P term the Thermostat skips
+control steps whose inputs did not change. The result is written as a config
+file to review and merge into config.txt:
+
+  python -m fancontroller.sysid [--history FILE] [--days 28] [--zone 0]
+      [--section "zone bedroom"] [--pwm] [--output tuned.txt]
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from fancontroller.history import HistoryStore, HISTORY_FILE
+from fancontroller.planner import ThermalModel, FitSamples, ResampleForFit, Intervals
+
+# Closed loop time constant of the fan speed control, in hours.
+CLOSED_LOOP = 0.5
+# Shortest full fan cycle, in hours.
+MIN_CYCLE = 0.5
+MIN_HYSTERESIS = 0.1
+MAX_HYSTERESIS = 3.0
+HYSTERESIS_STEP = 0.05
+MAX_WINDOW = 720
+DAYS = 28
+
+
+class Identification(object):
+    """A fitted ThermalModel and how well it explains the history.
+
+    rmse is the root mean square error of the fitted rates in degrees per
+    hour, diff_on and diff_off the median outdoor - indoor difference while
+    the fan ran and while it was off, outdoor_rate the 95th percentile of
+    the outdoor temperature's rate of change in degrees per hour and
+    sample_period the median seconds between records.
+    """
+
+    def __init__(self, model, rmse, samples, diff_on, diff_off, outdoor_rate, sample_period):
+        self.model = model
+        self.rmse = rmse
+        self.samples = samples
+        self.diff_on = diff_on
+        self.diff_off = diff_off
+        self.outdoor_rate = outdoor_rate
+        self.sample_period = sample_period
+
+    def GetRates(self):
+        """Returns the indoor rates (degrees per hour) with the fan on at full speed and off."""
+        model = self.model
+        return (model.gain + (model.leak + model.fan) * self.diff_on,
+                model.gain + model.leak * self.diff_off)
+
+
+def Identify(records, zone=0, pwm=False):
+    """Fits the model to fancontroller.history records of zone.
+
+    Returns None if there are too few records or the fit is not physical,
+    see ThermalModel.Fit().
+    """
+    resampled = ResampleForFit(records, zone, pwm)
+    if resampled is None:
+        return None
+    model = ThermalModel.FitResampled(*resampled)
+    if model is None:
+        return None
+    times, indoor, outdoor, speed = resampled
+    diff, running, rate = FitSamples(times, indoor, outdoor, speed)
+    predicted = model.leak * diff + model.gain + model.fan * running * diff
+    on = running > 0
+    dt, ok = Intervals(times)
+    outdoor_rate = np.abs(np.diff(outdoor) / dt)[ok]
+    zone_times = records['timestamp'][records['zone'] == zone]
+    return Identification(model,
+                          rmse=float(np.sqrt(np.mean((rate - predicted) ** 2))),
+                          samples=len(rate),
+                          diff_on=float(np.median(diff[on])),
+                          diff_off=float(np.median(diff[~on])) if (~on).any() else 0.0,
+                          outdoor_rate=float(np.percentile(outdoor_rate, 95)),
+                          sample_period=float(np.median(np.diff(zone_times))))
+
+
+class Tuning(object):
+    """Thermostat settings derived from an Identification, see the module doc."""
+
+    def __init__(self, kp, ki, kd, hysteresis, inside_window, outside_window):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.hysteresis = hysteresis
+        self.inside_window = inside_window
+        self.outside_window = outside_window
+
+
+def _Window(lag_hours, sample_period):
+    # A median over n samples lags by half of them.
+    return int(max(1, min(MAX_WINDOW, round(2 * lag_hours * 3600 / sample_period))))
+
+
+def Tune(identification, min_outside_diff, closed_loop=CLOSED_LOOP, min_cycle=MIN_CYCLE):
+    """Returns the Tuning for identification, raises ValueError if the fan can not cool."""
+    cooling, warming = identification.GetRates()
+    if cooling >= 0:
+        raise ValueError('the fan does not cool the house at the typical outdoor '
+                         'difference (%.1f degrees/hour)' % cooling)
+    # The indoor temperature's response to the fan speed.
+    fan_gain = identification.model.fan * identification.diff_on
+    kp = 1.0 / (fan_gain * closed_loop)
+    # The warm up only counts if the house warms up by itself.
+    hours_per_degree = 1.0 / -cooling + (1.0 / warming if warming > 0 else 0.0)
+    hysteresis = min_cycle / hours_per_degree
+    hysteresis = round(hysteresis / HYSTERESIS_STEP) * HYSTERESIS_STEP
+    hysteresis = max(MIN_HYSTERESIS, min(MAX_HYSTERESIS, hysteresis))
+    inside_lag = hysteresis / 4.0 / -cooling
+    outside_lag = (min_outside_diff / 2.0 / identification.outdoor_rate
+                   if identification.outdoor_rate > 0 else float('inf'))
+    period = identification.sample_period
+    return Tuning(round(kp, 3), 0.0, 0.0, hysteresis,
+                  _Window(inside_lag, period), _Window(outside_lag, period))
+
+
+def WriteConfig(out, tuning, identification, section='DEFAULT'):
+    """Writes tuning as a config file section, with the model in comments."""
+    model = identification.model
+    cooling, warming = identification.GetRates()
+    out.write('# Tuned by fancontroller.sysid from %d samples.\n' % identification.samples)
+    out.write('# Model per hour: leak %.4f, gain %.3f, fan %.4f, rmse %.3f degrees/hour.\n' %
+              (model.leak, model.gain, model.fan, identification.rmse))
+    out.write('# The fan cools by %.2f degrees/hour, the house warms by %.2f without it.\n' %
+              (-cooling, warming))
+    out.write('[%s]\n' % section)
+    for option in ['kp', 'ki', 'kd', 'hysteresis']:
+        out.write('%s=%s\n' % (option, repr(getattr(tuning, option))))
+    for option in ['inside_window', 'outside_window']:
+        out.write('%s=%d\n' % (option, getattr(tuning, option)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--history', default=HISTORY_FILE)
+    parser.add_argument('--days', type=float, default=DAYS, help='days of history to fit')
+    parser.add_argument('--zone', type=int, default=0, help='index of the zone to fit')
+    parser.add_argument('--section', default='DEFAULT',
+                        help='config section to write, e.g. "zone bedroom"')
+    parser.add_argument('--pwm', action='store_true',
+                        help='the fan speed follows the pid output')
+    parser.add_argument('--min-outside-diff', type=float, default=0.5)
+    parser.add_argument('--closed-loop', type=float, default=CLOSED_LOOP * 60,
+                        help='closed loop time constant in minutes')
+    parser.add_argument('--min-cycle', type=float, default=MIN_CYCLE * 60,
+                        help='shortest full fan cycle in minutes')
+    parser.add_argument('--output', help='config file to write, default stdout')
+    args = parser.parse_args(argv)
+    store = HistoryStore(args.history, readonly=True)
+    try:
+        records = store.Query(time.time() - args.days * 86400)
+        identification = Identify(records, args.zone, args.pwm)
+    finally:
+        store.Close()
+    if identification is None:
+        sys.stderr.write('not enough usable history to fit a model\n')
+        return 1
+    try:
+        tuning = Tune(identification, args.min_outside_diff,
+                      args.closed_loop / 60.0, args.min_cycle / 60.0)
+    except ValueError as e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    if args.output:
+        with open(args.output, 'w') as out:
+            WriteConfig(out, tuning, identification, args.section)
+    else:
+        WriteConfig(sys.stdout, tuning, identification, args.section)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+'''
+Tests for the system identification and tuning.
+'''
+import ConfigParser
+import StringIO
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from fancontroller.history import HistoryStore, RecordDtype
+from fancontroller.planner import ThermalModel
+from fancontroller.sysid import Identify, Tune, WriteConfig, main
+from fancontroller.zones import LoadZones
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.config import DEFAULTS
+
+START = 1435104000.0
+
+
+def History(model, days, step=5.0, start=START, pwm=False):
+    """Records of a house following model, with a thermostat switching the fan at 24/21 degrees."""
+    bin_step = 60.0
+    n = int(days * 86400 / bin_step)
+    outdoor = 20 + 8 * np.sin(2 * np.pi * np.arange(n) / (86400 / bin_step))
+    indoor = np.empty(n)
+    speed = np.empty(n)
+    t = 24.0
+    on = 0.0
+    for i in range(n):
+        if t > 24 and outdoor[i] < t - 0.5:
+            on = 0.5 if pwm else 1.0
+        elif t < 21 or outdoor[i] >= t:
+            on = 0.0
+        indoor[i] = t
+        speed[i] = on
+        t += bin_step / 3600.0 * model.Rate(t, outdoor[i], on)
+    # Every bin's value repeated at the record step.
+    repeat = int(bin_step / step)
+    records = np.zeros(n * repeat, dtype=RecordDtype())
+    records['timestamp'] = start + step * np.arange(n * repeat)
+    records['indoor_median'] = np.repeat(indoor, repeat)
+    records['outdoor_median'] = np.repeat(outdoor, repeat)
+    records['state'] = np.repeat(speed > 0, repeat)
+    records['pid'] = np.repeat(speed, repeat)
+    return records
+
+
+class SysIdTest(unittest.TestCase):
+
+    def testRecoversModelAndTunes(self):
+        model = ThermalModel(leak=0.05, gain=0.5, fan=1.0)
+        records = History(model, days=7)
+        start = time.time()
+        identification = Identify(records)
+        # A week of 5 second records.
+        self.assertLess(time.time() - start, 2)
+        fitted = identification.model
+        self.assertAlmostEqual(model.leak, fitted.leak, delta=0.01)
+        self.assertAlmostEqual(model.gain, fitted.gain, delta=0.05)
+        self.assertAlmostEqual(model.fan, fitted.fan, delta=0.05)
+        self.assertLess(identification.rmse, 0.1)
+        self.assertAlmostEqual(5.0, identification.sample_period)
+        self.assertIsNone(Identify(records, zone=1))
+        tuning = Tune(identification, min_outside_diff=0.5)
+        cooling, warming = identification.GetRates()
+        self.assertLess(cooling, 0)
+        self.assertGreater(warming, 0)
+        # kp makes the fan's effect on the indoor rate 1 / closed loop time.
+        self.assertAlmostEqual(2.0, tuning.kp * model.fan * identification.diff_on, delta=0.05)
+        self.assertLess(tuning.kp, 0)
+        self.assertEqual((0.0, 0.0), (tuning.ki, tuning.kd))
+        cycle = tuning.hysteresis * (1 / -cooling + 1 / warming)
+        self.assertAlmostEqual(0.5, cycle, delta=0.05 * (1 / -cooling + 1 / warming) / 2 + 0.01)
+        self.assertGreater(tuning.inside_window, 1)
+        self.assertGreater(tuning.outside_window, tuning.inside_window)
+
+    def testPwmSpeed(self):
+        model = ThermalModel(leak=0.05, gain=0.5, fan=1.0)
+        records = History(model, days=3, pwm=True)
+        # The fan only ran at half speed.
+        self.assertAlmostEqual(1.0, Identify(records, pwm=True).model.fan, delta=0.05)
+        self.assertAlmostEqual(0.5, Identify(records).model.fan, delta=0.05)
+
+    def testFanThatCanNotCool(self):
+        identification = Identify(History(ThermalModel(leak=0.05, gain=0.5, fan=1.0), days=3))
+        identification.diff_on = 0.0
+        self.assertRaises(ValueError, Tune, identification, 0.5)
+
+    def testWritesLoadableConfig(self):
+        identification = Identify(History(ThermalModel(leak=0.05, gain=0.5, fan=1.0), days=3))
+        tuning = Tune(identification, 0.5)
+        out = StringIO.StringIO()
+        WriteConfig(out, tuning, identification, section='zone attic')
+        config = ConfigParser.RawConfigParser(DEFAULTS)
+        config.readfp(StringIO.StringIO(out.getvalue()))
+        zone, = LoadZones(config, gpio_factory=FakeFanGpio)
+        self.assertEqual('attic', zone.name)
+        self.assertEqual(tuning.kp, zone.thermostat.p.Kp)
+        self.assertEqual(tuning.hysteresis, zone.thermostat._hysteresis)
+        self.assertEqual(tuning.inside_window, zone.thermostat._inside_temp.window)
+
+
+class SysIdMainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testMain(self):
+        history = os.path.join(self.dir, 'history.bin')
+        output = os.path.join(self.dir, 'tuned.txt')
+        records = History(ThermalModel(leak=0.05, gain=0.5, fan=1.0), days=3, step=60,
+                          start=time.time() - 3 * 86400)
+        store = HistoryStore(history, capacity=len(records))
+        for record in records:
+            store.Append(record['timestamp'], None, None, record['indoor_median'],
+                         record['outdoor_median'], record['pid'], 22.5, record['state'])
+        store.Close()
+        self.assertEqual(0, main(['--history', history, '--output', output]))
+        with open(output) as f:
+            text = f.read()
+        self.assertIn('[DEFAULT]\nkp=', text)
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            self.assertEqual(1, main(['--history', history, '--zone', '1']))
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == "__main__":
+    unittest.main()
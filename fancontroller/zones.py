@@ -0,0 +1,99 @@
+'''
+Multiple fan zones driven from one controller process.
+
+Each [zone <name>] section of the config describes one room with its own
+sensors, GPIO port, targets and filter windows; options missing from a
+section fall back to [DEFAULT]. A config without zone sections is a single
+zone built from [DEFAULT], which is the original one fan setup.
+
+  [zone bedroom]
+  indoor_sensor=bedroom_temp
+  gpio_port=18
+  target_temp=21
+'''
+from fancontroller.fan_controller import Thermostat, STATE_OFF
+from fancontroller.fan_gpio import FanGpio
+
+ZONE_PREFIX = 'zone '
+
+# Zone options and their defaults, merged into the config defaults.
+ZONE_DEFAULTS = {
+    'indoor_sensor': 'indoor_temp',
+    'outdoor_sensor': 'outdoor_temp',
+    'gpio_port': 17,
+    'inside_window': 1,
+    'outside_window': 1,
+    'pwm': 0,
+    'kp': Thermostat.PID_GAINS[0],
+    'ki': Thermostat.PID_GAINS[1],
+    'kd': Thermostat.PID_GAINS[2],
+}
+
+
+class Zone(object):
+    """One Thermostat and the names of the sensors that feed it."""
+
+    def __init__(self, name, thermostat, indoor, outdoor):
+        self.name = name
+        self.thermostat = thermostat
+        self.indoor = indoor
+        self.outdoor = outdoor
+
+
+def GetZoneSections(config):
+    """Returns a list of (zone name, config section) for the zones in config.
+
+    Raises ValueError if a zone name contains a comma, the uploaded samples'
+    field separator.
+    """
+    sections = [s for s in config.sections() if s.startswith(ZONE_PREFIX)]
+    if not sections:
+        return [('default', 'DEFAULT')]
+    for section in sections:
+        if ',' in section:
+            raise ValueError('invalid zone name %r, it must not contain a comma' %
+                             section[len(ZONE_PREFIX):])
+    return [(section[len(ZONE_PREFIX):], section) for section in sections]
+
+
+def GetZoneOption(config, section, option):
+    """Returns option of a zone section, falling back to [DEFAULT] and ZONE_DEFAULTS."""
+    if config.has_option(section, option):
+        return config.get(section, option)
+    return ZONE_DEFAULTS[option]
+
+
+def LoadZones(config, gpio_factory=None, fan_states=None, backend=None):
+    """Creates one Zone per zone section of config (a RawConfigParser).
+
+    gpio_factory is called with the zone's gpio port, by default the zones
+    get a FanGpio on backend (a fancontroller.fan_gpio.GpioBackend, the
+    shared pigpio one if None). fan_states optionally maps zone names to the
+    fan state to start in, zones not in it start off.
+    """
+    fan_states = fan_states or {}
+    zones = []
+    for name, section in GetZoneSections(config):
+        def get(option):
+            return GetZoneOption(config, section, option)
+        if gpio_factory is None:
+            gpio = FanGpio(int(get('gpio_port')), backend=backend, pwm=bool(int(get('pwm'))))
+        else:
+            gpio = gpio_factory(int(get('gpio_port')))
+        thermostat = Thermostat(target_temp=float(get('target_temp')),
+                                outside_window=int(get('outside_window')),
+                                inside_window=int(get('inside_window')),
+                                hysteresis=float(get('hysteresis')),
+                                min_outside_diff=float(get('min_outside_diff')),
+                                pid_gains=(float(get('kp')), float(get('ki')),
+                                           float(get('kd'))),
+                                gpio=gpio,
+                                fan_state=fan_states.get(name, STATE_OFF))
+        zones.append(Zone(name, thermostat, get('indoor_sensor'), get('outdoor_sensor')))
+    return zones
+
+
+def GetSensorNames(zones):
+    """All sensors the zones read, each once."""
+    return sorted(set([zone.indoor for zone in zones] +
+                      [zone.outdoor for zone in zones]))
@@ -0,0 +1,78 @@
+'''
+Benchmark of the CPU and memory cost of running many zones in one process.
+
+For each zone count, builds the zones with in-memory sensors and GPIOs,
+runs control cycles (one sensor pass plus ControlLoop for every zone) and
+reports CPU time per cycle and the memory the zones add to the process.
+One process per zone would instead pay a whole interpreter per zone.
+
+  PYTHONPATH=. python fancontroller/zones_benchmark.py
+'''
+import ConfigParser
+import gc
+import logging
+import random
+import resource
+import time
+
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.runtime import Runtime
+from fancontroller.sensors import SensorBatch
+from fancontroller.zones import LoadZones, ZONE_DEFAULTS
+
+ZONE_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+CYCLES = 2000
+WINDOW = 60
+
+
+class _RandomSensorBus(object):
+    def __init__(self, names):
+        self._names = names
+
+    def ReadAll(self):
+        return SensorBatch(time.time(), dict(
+            (name, 20 + random.random() * 5) for name in self._names))
+
+
+def _MaxRssKb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _Zones(count):
+    config = ConfigParser.RawConfigParser(ZONE_DEFAULTS)
+    config.set('DEFAULT', 'target_temp', '22.5')
+    config.set('DEFAULT', 'hysteresis', '0.5')
+    config.set('DEFAULT', 'min_outside_diff', '0.5')
+    config.set('DEFAULT', 'inside_window', str(WINDOW))
+    config.set('DEFAULT', 'outside_window', str(WINDOW))
+    for i in range(count):
+        section = 'zone room%d' % i
+        config.add_section(section)
+        config.set(section, 'indoor_sensor', 'room%d_temp' % i)
+        config.set(section, 'gpio_port', str(i))
+    return LoadZones(config, gpio_factory=FakeFanGpio)
+
+
+def Benchmark(count):
+    """Returns (cpu seconds per cycle, bytes of max rss growth)."""
+    gc.collect()
+    rss_before = _MaxRssKb()
+    zones = _Zones(count)
+    names = ['outdoor_temp'] + ['room%d_temp' % i for i in range(count)]
+    runtime = Runtime(zones, _RandomSensorBus(names))
+    start = time.clock()
+    for _ in range(CYCLES):
+        runtime._ReadSensors()
+        runtime._Control()
+    cpu = (time.clock() - start) / CYCLES
+    return cpu, (_MaxRssKb() - rss_before) * 1024
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    print('%6s %14s %14s %14s' % ('zones', 'us/cycle', 'us/zone', 'rss growth KB'))
+    for count in ZONE_COUNTS:
+        cpu, rss = Benchmark(count)
+        print('%6d %14.1f %14.1f %14d' % (count, cpu * 1e6, cpu * 1e6 / count, rss / 1024))
+    print('interpreter baseline rss: %d KB (paid per zone with one process per zone)'
+          % _MaxRssKb())
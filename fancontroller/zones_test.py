@@ -0,0 +1,80 @@
+'''
+Tests for multi-zone configuration and control.
+'''
+import ConfigParser
+import StringIO
+import time
+import unittest
+
+from fancontroller.fan_gpio import FakeFanGpio
+from fancontroller.runtime import Runtime
+from fancontroller.sensors import SensorBatch
+from fancontroller.zones import LoadZones, GetSensorNames, ZONE_DEFAULTS
+
+_CONFIG = '''
+[DEFAULT]
+target_temp=22.5
+hysteresis=0
+min_outside_diff=0
+
+[zone living]
+gpio_port=17
+
+[zone bedroom]
+indoor_sensor=bedroom_temp
+gpio_port=18
+target_temp=30
+'''
+
+
+class FakeSensorBus(object):
+    def __init__(self, **temperatures):
+        self.temperatures = temperatures
+        self.reads = 0
+
+    def ReadAll(self):
+        self.reads += 1
+        return SensorBatch(time.time(), dict(self.temperatures))
+
+
+def _Config(text):
+    config = ConfigParser.RawConfigParser(ZONE_DEFAULTS)
+    config.readfp(StringIO.StringIO(text))
+    return config
+
+
+class ZonesTest(unittest.TestCase):
+
+    def testLoadZones(self):
+        zones = LoadZones(_Config(_CONFIG), gpio_factory=FakeFanGpio)
+        self.assertEqual(['living', 'bedroom'], [zone.name for zone in zones])
+        self.assertEqual([17, 18], [zone.thermostat._fc.gpio.port for zone in zones])
+        self.assertEqual([22.5, 30], [zone.thermostat._target_temp for zone in zones])
+        self.assertEqual(['bedroom_temp', 'indoor_temp', 'outdoor_temp'],
+                         GetSensorNames(zones))
+
+    def testCommaInZoneName(self):
+        self.assertRaises(ValueError, LoadZones, _Config('[zone living,room]\ngpio_port=17\n'),
+                          gpio_factory=FakeFanGpio)
+
+    def testSingleZoneFromDefaults(self):
+        zones = LoadZones(_Config('[DEFAULT]\ntarget_temp=20\nhysteresis=1\n'
+                                  'min_outside_diff=1\n'),
+                          gpio_factory=FakeFanGpio)
+        self.assertEqual(1, len(zones))
+        self.assertEqual('default', zones[0].name)
+        self.assertEqual(17, zones[0].thermostat._fc.gpio.port)
+
+    def testSharedSensorPass(self):
+        zones = LoadZones(_Config(_CONFIG), gpio_factory=FakeFanGpio)
+        sensors = FakeSensorBus(indoor_temp=25, bedroom_temp=25, outdoor_temp=10)
+        runtime = Runtime(zones, sensors)
+        runtime._ReadSensors()
+        runtime._Control()
+        self.assertEqual(1, sensors.reads)
+        # Living room is above its target, the bedroom below.
+        self.assertEqual([1, 0], [zone.thermostat._fc.gpio.level for zone in zones])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@
 # author: Raymond Hettinger
 from random import random
 from math import log, ceil
+from bisect import bisect_left, insort
 
 class Node(object):
     __slots__ = 'value', 'next', 'width'
@@ -89,4 +90,37 @@ class IndexableSkiplist:
         node = self.head.next[0]
         while node is not NIL:
             yield node.value
-            node = node.next[0]
\ No newline at end of file
+            node = node.next[0]
+
+
+class IndexableSortedList(object):
+    """Sorted collection on a contiguous list, same interface as IndexableSkiplist.
+
+    Insertion and removal are O(n) but the shifting is a single memmove, so for
+    the window sizes a MedianFilter uses this is several times faster than the
+    skiplist and needs no per-value nodes.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, expected_size=100):
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def insert(self, value):
+        insort(self.values, value)
+
+    def remove(self, value):
+        values = self.values
+        i = bisect_left(values, value)
+        if i == len(values) or values[i] != value:
+            raise KeyError('Not Found')
+        del values[i]
+
+    def __iter__(self):
+        'Iterate over values in sorted order'
+        return iter(self.values)